@@ -166,6 +166,30 @@ CACHES = {
     }
 }
 
+# 实例连接池配置，max_size为每个进程对单个实例保留的空闲连接数上限(设置为0则不复用连接)，idle_timeout为空闲连接的保留秒数，
+# check_interval为跳过健康检查(ping)的秒数，归还不超过该时间的连接取出时不检查，
+# reset_session为True时MySQL连接归还时使用COM_CHANGE_USER完整重置会话，默认只回滚未提交的事务
+ENGINE_CONNECTION_POOL = {
+    'max_size': 10,
+    'idle_timeout': 300,
+    'check_interval': 5,
+    'reset_session': False,
+}
+
+# 查询日志写入配置，async为False时同步写入；异步写入时按batch_size条或flush_interval秒批量写入，队列超过queue_size时转为同步写入
+QUERY_LOG_WRITER = {
+    'async': True,
+    'batch_size': 100,
+    'flush_interval': 1,
+    'queue_size': 10000,
+}
+
+# binlog2sql后台解析任务的超时时间(秒)，超时中断的任务可从检查点继续解析
+BINLOG2SQL_TIMEOUT = 3600
+
+# 阿里云RDS慢日志等查询接口的结果缓存时间(秒)，0为不缓存
+ALIYUN_API_CACHE_TIMEOUT = 60
+
 # LDAP
 ENABLE_LDAP = False
 if ENABLE_LDAP:
@@ -1,15 +1,19 @@
 import json
 import smtplib
+import threading
+import time
 from unittest.mock import patch, Mock, MagicMock, ANY
 import datetime
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
 
 from common.config import SysConfig
 from common.utils.sendmsg import MsgSender
-from sql.models import Instance, SqlWorkflow, QueryLog
+from sql.models import Instance, SqlWorkflow, QueryLog, AliyunAccessKey
 from common.utils.chart_dao import ChartDao
 from common.auth import ArcherAuth
+from common.utils.aliyun_sdk import Aliyun, client_cache
 User = get_user_model()
 
 
@@ -441,4 +445,65 @@ class AuthTest(TestCase):
         self.u1.delete()
 
     def testChallenge(self):
-        pass
\ No newline at end of file
+        pass
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AliyunSdkTest(TestCase):
+    def setUp(self):
+        AliyunAccessKey.objects.create(ak='some_ak', secret='some_secret', is_enable=1)
+        client_cache.clear()
+        cache.clear()
+        self.payload = json.dumps({'Items': {'SQLSlowLog': []}, 'TotalRecordCount': 0,
+                                   'PageRecordCount': 0, 'PageNumber': 1}).encode('utf-8')
+
+    def tearDown(self):
+        AliyunAccessKey.objects.all().delete()
+
+    @patch('common.utils.aliyun_sdk.client.AcsClient')
+    def testClientCache(self, _client):
+        """同一ak只创建一次AcsClient"""
+        Aliyun()
+        Aliyun()
+        _client.assert_called_once_with(ak='some_ak', secret='some_secret')
+
+    @patch('common.utils.aliyun_sdk.client.AcsClient')
+    def testNoAccessKey(self, _client):
+        """没有启用的ak时直接报错"""
+        AliyunAccessKey.objects.update(is_enable=0)
+        with self.assertRaisesMessage(Exception, '没有找到有效的ak信息'):
+            Aliyun()
+        _client.assert_not_called()
+
+    @patch('common.utils.aliyun_sdk.client.AcsClient')
+    def testMultipleAccessKeys(self, _client):
+        """启用了多个ak时同样报错"""
+        AliyunAccessKey.objects.create(ak='other_ak', secret='other_secret', is_enable=1)
+        with self.assertRaisesMessage(Exception, '没有找到有效的ak信息'):
+            Aliyun()
+        _client.assert_not_called()
+
+    @patch('common.utils.aliyun_sdk.client.AcsClient')
+    def testResponseCacheAndSingleFlight(self, _client):
+        """相同参数的并发请求只调用一次接口, 结果在缓存时间内复用"""
+        def do_action(request):
+            time.sleep(0.2)
+            return self.payload
+
+        _client.return_value.do_action_with_exception.side_effect = do_action
+        results = []
+        # 测试数据未提交, 其他线程的数据库连接读取不到ak, 在主线程中创建
+        aliyun = Aliyun()
+        threads = [threading.Thread(target=lambda: results.append(
+            aliyun.DescribeSlowLogs('rm-1', '2018-12-01Z', '2018-12-02Z', PageSize=30, PageNumber=1)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(_client.return_value.do_action_with_exception.call_count, 1)
+        Aliyun().DescribeSlowLogs('rm-1', '2018-12-01Z', '2018-12-02Z', PageSize=30, PageNumber=1)
+        self.assertEqual(_client.return_value.do_action_with_exception.call_count, 1)
+        Aliyun().DescribeSlowLogs('rm-1', '2018-12-01Z', '2018-12-02Z', PageSize=30, PageNumber=2)
+        self.assertEqual(_client.return_value.do_action_with_exception.call_count, 2)
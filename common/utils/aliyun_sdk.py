@@ -1,40 +1,77 @@
 # -*- coding: UTF-8 -*-
 import datetime
+import hashlib
 import traceback
 
 from aliyunsdkcore import client
 from aliyunsdkrds.request.v20140815 import DescribeSlowLogsRequest, DescribeSlowLogRecordsRequest, \
     RequestServiceOfCloudDBARequest
 import simplejson as json
+from django.conf import settings
+from django.core.cache import cache
+from common.utils.local_cache import LocalCache, SingleFlight
 from sql.models import AliyunAccessKey
 import logging
 
 logger = logging.getLogger('default')
 
+# AcsClient按ak缓存, ak修改后密文变化, 重新创建
+client_cache = LocalCache(max_size=10)
+# 相同参数的并发请求只调用一次接口
+single_flight = SingleFlight()
+
 
 class Aliyun(object):
     def __init__(self):
         try:
             auth = AliyunAccessKey.objects.get(is_enable=1)
-            ak = auth.raw_ak
-            secret = auth.raw_secret
-        except Exception:
-            logger.error(traceback.format_exc())
+        except (AliyunAccessKey.DoesNotExist, AliyunAccessKey.MultipleObjectsReturned):
+            # 没有启用或启用了多个ak时都无法确定使用哪个ak
             logger.error('没有找到有效的ak信息！')
-        else:
+            raise Exception('没有找到有效的ak信息！')
+        self.clt = client_cache.get((auth.id, auth.ak, auth.secret))
+        if self.clt is None:
             self.clt = client.AcsClient(
-                ak=ak,
-                secret=secret)
+                ak=auth.raw_ak,
+                secret=auth.raw_secret)
+            client_cache.set((auth.id, auth.ak, auth.secret), self.clt)
+        self.ak_id = auth.id
 
-    def request_api(self, request, *values):
+    def request_api(self, request, *values, cache_timeout=0):
+        """
+        cache_timeout: 查询类接口的结果缓存秒数, 缓存key为ak和全部请求参数(实例、时间范围、分页等), 0为不缓存
+        缓存的请求同时合并相同参数的并发调用
+        """
         if values:
             for value in values:
                 for k, v in value.items():
                     request.add_query_param(k, v)
         request.set_accept_format('json')
+        if not cache_timeout:
+            return self._do_action(request)
+
+        key = 'aliyun_api:' + hashlib.md5(json.dumps([self.ak_id, values], sort_keys=True).encode('utf-8')).hexdigest()
+        try:
+            result = cache.get(key)
+        except Exception:
+            logger.error(traceback.format_exc())
+            result = None
+        if result is None:
+            result = single_flight.do(key, self._do_action_and_cache, request, key, cache_timeout)
+        return result
+
+    def _do_action(self, request):
         result = self.clt.do_action_with_exception(request)
         return json.dumps(json.loads(result.decode('utf-8')), indent=4, sort_keys=False, ensure_ascii=False)
 
+    def _do_action_and_cache(self, request, key, cache_timeout):
+        result = self._do_action(request)
+        try:
+            cache.set(key, result, timeout=cache_timeout)
+        except Exception:
+            logger.error(traceback.format_exc())
+        return result
+
     # 阿里云2017-12-10T16:00:00Z时间加上8小时时区显示
     @staticmethod
     def aliyun_time_format(str_time):
@@ -58,7 +95,7 @@ class Aliyun(object):
         values = {"action_name": "DescribeSlowLogs", "DBInstanceId": DBInstanceId,
                   "StartTime": StartTime, "EndTime": EndTime, "SortKey": "TotalExecutionCounts"}
         values = dict(values, **kwargs)
-        result = self.request_api(request, values)
+        result = self.request_api(request, values, cache_timeout=getattr(settings, 'ALIYUN_API_CACHE_TIMEOUT', 60))
         return result
 
     def DescribeSlowLogRecords(self, DBInstanceId, StartTime, EndTime, **kwargs):
@@ -68,10 +105,11 @@ class Aliyun(object):
         values = {"action_name": "DescribeSlowLogRecords", "DBInstanceId": DBInstanceId,
                   "StartTime": StartTime, "EndTime": EndTime}
         values = dict(values, **kwargs)
-        result = self.request_api(request, values)
+        result = self.request_api(request, values, cache_timeout=getattr(settings, 'ALIYUN_API_CACHE_TIMEOUT', 60))
         return result
 
-    def RequestServiceOfCloudDBA(self, DBInstanceId, ServiceRequestType, ServiceRequestParam, **kwargs):
+    def RequestServiceOfCloudDBA(self, DBInstanceId, ServiceRequestType, ServiceRequestParam, cache_timeout=0,
+                                 **kwargs):
         '''
         获取统计信息：'GetTimedMonData',{"Language":"zh","KeyGroup":"mem_cpu_usage","KeyName":"","StartTime":"2018-01-15T04:03:26Z","EndTime":"2018-01-15T05:03:26Z"}
             mem_cpu_usage、iops_usage、detailed_disk_space
@@ -79,10 +117,11 @@ class Aliyun(object):
         终止进程：'ConfirmKillSessionRequest',{"Language":"zh","SQLRequestID":75865,"SQLStatement":"kill 34022786;"}
         获取表空间信息：'GetSpaceStatForTables',{"Language": "zh", "OrderType": "Data"}
         获取资源利用信息：'GetResourceUsage',{"Language":"zh"}
+        cache_timeout: 只读请求的结果缓存秒数
         '''
         request = RequestServiceOfCloudDBARequest.RequestServiceOfCloudDBARequest()
         values = {"action_name": "RequestServiceOfCloudDBA", "DBInstanceId": DBInstanceId,
                   "ServiceRequestType": ServiceRequestType, "ServiceRequestParam": ServiceRequestParam}
         values = dict(values, **kwargs)
-        result = self.request_api(request, values)
+        result = self.request_api(request, values, cache_timeout=cache_timeout)
         return result
@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+"""进程内缓存, 支持LRU淘汰和过期时间, 用于缓存热点路径上的计算结果; 以及相同请求的并发合并"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    max_size: 最多缓存的条目数, 超出后淘汰最久未使用的条目
+    timeout: 过期秒数, 为None时不过期
+    """
+
+    def __init__(self, max_size=1000, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()  # {key: (value, 过期时间)}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expire_at = item
+            if expire_at is not None and expire_at < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expire_at = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """相同key的并发调用只执行一次, 其他线程等待并共享执行结果或异常"""
+
+    def __init__(self):
+        self._calls = {}  # {key: {'event': Event, 'result': 结果, 'error': 异常}}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event()}
+        if not leader:
+            call['event'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
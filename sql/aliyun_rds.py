@@ -3,6 +3,8 @@
 import simplejson as json
 import datetime
 
+from django.conf import settings
+
 from common.utils.aliyun_sdk import Aliyun
 from .models import AliyunRdsConfig
 
@@ -33,13 +35,14 @@ def slowquery_review(request):
     slowsql = Aliyun().DescribeSlowLogs(instance_info.rds_dbinstanceid, start_time, end_time, **values)
 
     # 解决table数据丢失精度、格式化时间
-    sql_slow_log = json.loads(slowsql)['Items']['SQLSlowLog']
+    slowsql = json.loads(slowsql)
+    sql_slow_log = slowsql['Items']['SQLSlowLog']
     for SlowLog in sql_slow_log:
         SlowLog['SQLId'] = str(SlowLog['SQLHASH'])
         SlowLog['CreateTime'] = Aliyun.aliyun_time_format(SlowLog['CreateTime'])
 
-    result = {"total": json.loads(slowsql)['TotalRecordCount'], "rows": sql_slow_log,
-              "PageSize": json.loads(slowsql)['PageRecordCount'], "PageNumber": json.loads(slowsql)['PageNumber']}
+    result = {"total": slowsql['TotalRecordCount'], "rows": sql_slow_log,
+              "PageSize": slowsql['PageRecordCount'], "PageNumber": slowsql['PageNumber']}
     # 返回查询结果
     return result
 
@@ -74,14 +77,15 @@ def slowquery_review_history(request):
     slowsql = Aliyun().DescribeSlowLogRecords(instance_info.rds_dbinstanceid, start_time, end_time, **values)
 
     # 格式化时间\过滤HostAddress
-    sql_slow_record = json.loads(slowsql)['Items']['SQLSlowRecord']
+    slowsql = json.loads(slowsql)
+    sql_slow_record = slowsql['Items']['SQLSlowRecord']
     for SlowRecord in sql_slow_record:
         SlowRecord['ExecutionStartTime'] = Aliyun.aliyun_time_format(SlowRecord['ExecutionStartTime']).strftime(
             "%Y-%m-%d %H:%M:%S")
         SlowRecord['HostAddress'] = SlowRecord['HostAddress'].split('[')[0]
 
-    result = {"total": json.loads(slowsql)['TotalRecordCount'], "rows": sql_slow_record,
-              "PageSize": json.loads(slowsql)['PageRecordCount'], "PageNumber": json.loads(slowsql)['PageNumber']}
+    result = {"total": slowsql['TotalRecordCount'], "rows": sql_slow_record,
+              "PageSize": slowsql['PageRecordCount'], "PageNumber": slowsql['PageNumber']}
 
     # 返回查询结果
     return result
@@ -163,7 +167,8 @@ def sapce_status(request):
     instance_info = AliyunRdsConfig.objects.get(instance_name=instance_name)
     # 调用aliyun接口获取进程数据
     space_info = Aliyun().RequestServiceOfCloudDBA(instance_info.rds_dbinstanceid, 'GetSpaceStatForTables',
-                                                   {"Language": "zh", "OrderType": "Data"})
+                                                   {"Language": "zh", "OrderType": "Data"},
+                                                   cache_timeout=getattr(settings, 'ALIYUN_API_CACHE_TIMEOUT', 60))
 
     # 提取进程列表
     space_list = json.loads(space_info)['ListData']
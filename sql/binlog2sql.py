@@ -4,7 +4,6 @@ import os
 import time
 import traceback
 
-import pymysql
 import simplejson as json
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
@@ -13,7 +12,9 @@ from django.http import HttpResponse
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine
 from sql.utils.binlog2sql.binlog2sql import Binlog2sql
-from .models import Instance
+from sql.utils.binlog2sql.binlog2sql_util import create_unique_file
+from sql.utils.binlog2sql_job import submit_binlog2sql_job, read_binlog2sql_rows, fail_stale_jobs
+from .models import Instance, Binlog2sqlJob
 
 logger = logging.getLogger('default')
 
@@ -53,6 +54,7 @@ def binlog2sql(request):
                     'passwd': instance.raw_password, 'charset': 'utf8'}
     no_pk = True if request.POST.get('no_pk') == 'true' else False
     flashback = True if request.POST.get('flashback') == 'true' else False
+    where_pk_only = True if request.POST.get('where_pk_only') == 'true' else False
     start_file = request.POST.get('start_file')
     start_pos = request.POST.get('start_pos') if request.POST.get('start_pos') == '' else int(
         request.POST.get('start_pos'))
@@ -65,16 +67,19 @@ def binlog2sql(request):
     only_dml = True if request.POST.get('only_dml') == 'true' else False
     sql_type = ['INSERT', 'UPDATE', 'DELETE'] if request.POST.getlist('sql_type[]') == [] else request.POST.getlist(
         'sql_type[]')
+    batch_size = int(request.POST.get('batch_size') or 1)
+    back_batch = int(request.POST.get('back_batch') or 1000)
 
     # flashback=True获取DML回滚语句
     result = {'status': 0, 'msg': 'ok', 'data': ''}
+    params = {'start_file': start_file, 'start_pos': start_pos, 'end_file': end_file, 'end_pos': end_pos,
+              'start_time': start_time, 'stop_time': stop_time, 'only_schemas': ' '.join(only_schemas),
+              'only_tables': ' '.join(only_tables), 'no_pk': no_pk, 'flashback': flashback, 'stop_never': False,
+              'back_interval': 1.0, 'only_dml': only_dml, 'sql_type': sql_type,
+              'batch_size': batch_size, 'back_batch': back_batch, 'where_pk_only': where_pk_only}
     try:
-        binlog2sql = Binlog2sql(connection_settings=conn_setting, start_file=start_file, start_pos=start_pos,
-                                end_file=end_file, end_pos=end_pos, start_time=start_time,
-                                stop_time=stop_time, only_schemas=' '.join(only_schemas),
-                                only_tables=' '.join(only_tables),
-                                no_pk=no_pk, flashback=flashback, stop_never=False,
-                                back_interval=1.0, only_dml=only_dml, sql_type=sql_type)
+        # 提交前校验参数, 不连接实例, 连接和解析在后台任务中执行
+        Binlog2sql.check_params(**params)
         timestamp = int(time.time())
         path = os.path.join(settings.BASE_DIR, 'downloads/binlog2sql/')
         if flashback:
@@ -85,28 +90,10 @@ def binlog2sql(request):
             filename = os.path.join(path, '{}_{}_{}.sql'.format(conn_setting['host'],
                                                                 conn_setting['port'],
                                                                 timestamp))
-        # 获取sql语句，忽略wait_timeout的错误
-        try:
-            binlog2sql.process_binlog(filename)
-        except pymysql.err.OperationalError:
-            logger.error(traceback.format_exc())
-
-        # 读取前5000行
-        rows = []
-        n = 1
-        with open(filename) as f:
-            for row in f:
-                if n <= 5000:
-                    row_info = {}
-                    try:
-                        row_info['sql'] = row.split('; #')[0] + ";"
-                        row_info['binlog_info'] = row.split('; #')[1].rstrip('\"')
-                    except Exception:
-                        row_info['sql'] = row
-                        row_info['binlog_info'] = None
-                    rows.append(row_info)
-                    n = n + 1
-        result['data'] = rows
+        job = Binlog2sqlJob.objects.create(instance_name=instance_name, user_name=request.user.username,
+                                           params=json.dumps(params), filename=create_unique_file(filename))
+        submit_binlog2sql_job(job)
+        result['data'] = {'job_id': job.id}
     except Exception as e:
         logger.error(traceback.format_exc())
         result['status'] = 1
@@ -115,3 +102,69 @@ def binlog2sql(request):
     # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
                         content_type='application/json')
+
+
+def get_job(request):
+    """获取当前用户可访问的解析任务, 管理员可访问全部任务"""
+    jobs = Binlog2sqlJob.objects.all()
+    if not request.user.is_superuser:
+        jobs = jobs.filter(user_name=request.user.username)
+    return jobs.filter(id=request.POST.get('job_id')).first()
+
+
+# 获取解析任务进度
+@permission_required('sql.menu_binlog2sql', raise_exception=True)
+def binlog2sql_job_status(request):
+    fail_stale_jobs()
+    job = get_job(request)
+    if job is None:
+        result = {'status': 1, 'msg': '任务不存在', 'data': {}}
+    else:
+        result = {'status': 0, 'msg': 'ok',
+                  'data': {'job_id': job.id, 'status': job.status, 'progress': job.progress, 'rows': job.rows,
+                           'log_file': job.log_file, 'log_pos': job.log_pos, 'error': job.error}}
+    return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+                        content_type='application/json')
+
+
+# 取消解析任务, 执行中的任务在下一个检查点停止
+@permission_required('sql.menu_binlog2sql', raise_exception=True)
+def binlog2sql_job_cancel(request):
+    job = get_job(request)
+    if job is None:
+        result = {'status': 1, 'msg': '任务不存在', 'data': {}}
+    else:
+        Binlog2sqlJob.objects.filter(id=job.id, status='waiting').update(status='canceled')
+        Binlog2sqlJob.objects.filter(id=job.id, status='running').update(status='canceling')
+        result = {'status': 0, 'msg': 'ok', 'data': {}}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+# 从检查点继续执行失败、取消或超时中断的解析任务
+@permission_required('sql.menu_binlog2sql', raise_exception=True)
+def binlog2sql_job_resume(request):
+    # 执行超时的任务先标记为失败, 执行中的任务不可重复提交
+    fail_stale_jobs()
+    job = get_job(request)
+    if job is None:
+        result = {'status': 1, 'msg': '任务不存在', 'data': {}}
+    elif not Binlog2sqlJob.objects.filter(id=job.id, status__in=('failed', 'canceled')).update(status='waiting'):
+        result = {'status': 1, 'msg': '任务当前状态不可继续执行', 'data': {}}
+    else:
+        submit_binlog2sql_job(job)
+        result = {'status': 0, 'msg': 'ok', 'data': {'job_id': job.id}}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+# 分页获取解析结果
+@permission_required('sql.menu_binlog2sql', raise_exception=True)
+def binlog2sql_job_rows(request):
+    job = get_job(request)
+    if job is None:
+        result = {'total': 0, 'rows': []}
+    else:
+        offset = int(request.POST.get('offset', 0))
+        limit = int(request.POST.get('limit', 100))
+        result = {'total': job.rows, 'rows': read_binlog2sql_rows(job, offset=offset, limit=limit)}
+    return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+                        content_type='application/json')
@@ -1,9 +1,13 @@
 """engine base库, 包含一个``EngineBase`` class和一个get_engine函数"""
 from sql.models import Instance
+from .models import ResultSet
+from .pool import get_pool
 
 
 class EngineBase:
     """enginebase 只定义了init函数和若干方法的名字, 具体实现用mysql.py pg.py等实现"""
+    # 流式查询每批读取的行数
+    stream_batch_size = 1000
 
     def __init__(self, instance=None, workflow=None):
         self.conn = None
@@ -21,6 +25,24 @@ class EngineBase:
     def get_connection(self, db_name=None):
         """返回一个conn实例"""
 
+    def new_connection(self):
+        """新建一个conn实例, 由连接池调用"""
+
+    def check_connection(self, conn):
+        """连接池取出连接时的健康检查, 连接不可用时抛出异常"""
+
+    def reset_connection(self, conn):
+        """连接归还连接池前的重置, 如回滚未提交的事务"""
+        conn.rollback()
+
+    @property
+    def pool(self):
+        """返回当前实例的连接池, 同一进程内相同连接信息的engine共用一个连接池"""
+        return get_pool(key=(self.name, self.host, self.port, self.user, self.password),
+                        creator=self.new_connection,
+                        checker=self.check_connection,
+                        resetter=self.reset_connection)
+
     @property
     def name(self):
         """返回engine名称"""
@@ -46,14 +68,27 @@ class EngineBase:
     def query_check(self, db_name=None, sql='', limit_num=10):
         """查询语句的检查, 返回一个字典 {'bad_query': bool, 'filtered_sql': str}"""
 
-    def query(self, db_name=None, sql='', limit_num=0, close_conn=True):
-        """实际查询 返回一个ResultSet"""
+    def query(self, db_name=None, sql='', limit_num=0, close_conn=True, stream=False):
+        """实际查询 返回一个ResultSet,
+        stream=True时ResultSet.rows为逐批读取的迭代器, 迭代结束后才释放连接"""
 
     def query_masking(self, db_name=None, sql='', resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
         return resultset
 
+    def query_masking_plan(self, db_name=None, sql='', resultset=None):
+        """流式查询使用, 脱敏第一批结果集并返回(脱敏后的结果集, mask_rows),
+        mask_rows(rows)用于对后续每批数据按相同的规则脱敏, 默认逐批调用query_masking"""
+        resultset = self.query_masking(db_name=db_name, sql=sql, resultset=resultset)
+        column_list = resultset.column_list
+
+        def mask_rows(rows):
+            batch = ResultSet(full_sql=sql, rows=rows, column_list=column_list)
+            return self.query_masking(db_name=db_name, sql=sql, resultset=batch).rows
+
+        return resultset, mask_rows
+
     def execute_check(self, db_name=None, sql=''):
         """执行语句的检查 返回一个ReviewSet"""
 
@@ -66,6 +101,12 @@ class EngineBase:
     def get_rollback(self):
         """获取工单回滚语句"""
 
+    def get_rollback_page(self, offset=0, limit=None):
+        """分页获取工单回滚语句, 返回(回滚语句列表, 语句总数)"""
+
+    def get_rollback_script(self):
+        """获取工单回滚脚本, 返回逐段文本的迭代器"""
+
 
 def get_engine(instance=None, workflow=None):
     """获取数据库操作engine"""
@@ -1,10 +1,13 @@
 # -*- coding: UTF-8 -*-
+import itertools
 import logging
 import traceback
 import MySQLdb
+import MySQLdb.cursors
 import simplejson as json
 from common.config import SysConfig
 from sql.models import SqlWorkflow
+from sql.utils.execute_result import get_execute_result
 
 from . import EngineBase
 from .models import ResultSet
@@ -70,48 +73,149 @@ class InceptionEngine(EngineBase):
                                                       sql)
         return self.query(db_name=db_name, sql=sql)
 
+    rollback_batch_size = 500
+
     def get_rollback_list(self, workflow_id):
         """
         获取回滚语句，并且按照执行顺序倒序展示
         """
-        workflow_detail = SqlWorkflow.objects.get(id=workflow_id)
-        list_execute_result = json.loads(workflow_detail.execute_result)
-        list_execute_result.reverse()
-        list_backup_sql = []
+        return list(self.iter_rollback_list(workflow_id))
+
+    def get_rollback_page(self, workflow_id, offset=0, limit=None):
+        """
+        按执行顺序倒序分页获取回滚语句, 返回([[sql, 回滚语句]], 有备份的语句总数), 用于回滚页面分批加载并展示进度
+        """
+        statements = self._backup_statements(workflow_id)
+        page = statements[offset:offset + limit] if limit else statements[offset:]
+        return list(self._iter_rollback_list(page)), len(statements)
+
+    def iter_rollback_list(self, workflow_id):
+        """
+        按执行顺序倒序逐条返回[sql, 回滚语句], 每rollback_batch_size条语句按备份库分组, 使用IN批量获取表名和回滚语句
+        """
+        return self._iter_rollback_list(self._backup_statements(workflow_id))
+
+    def _iter_rollback_list(self, statements):
         # 创建连接
         conn = self.get_backup_connection()
         cur = conn.cursor()
+        try:
+            for offset in range(0, len(statements), self.rollback_batch_size):
+                batch = statements[offset:offset + self.rollback_batch_size]
+                rollback_statements = self._fetch_rollback_statements(cur, batch)
+                for backup_db_name, opid_time, sql in batch:
+                    list_backup = rollback_statements.get((backup_db_name, opid_time))
+                    if list_backup is not None:
+                        yield [sql, '\n'.join(list_backup)]
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            raise Exception(e)
+        finally:
+            cur.close()
+            conn.close()
+
+    def iter_rollback_sql(self, workflow_id):
+        """
+        按执行顺序倒序流式返回回滚脚本文本, 用于下载
+        每批语句中连续使用同一备份表的语句合并为一个服务端游标查询, 逐批读取, 不在内存中保存完整脚本
+        """
+        statements = self._backup_statements(workflow_id)
+        conn = self.get_backup_connection()
+        cur = conn.cursor()
+        try:
+            for offset in range(0, len(statements), self.rollback_batch_size):
+                batch = statements[offset:offset + self.rollback_batch_size]
+                rollback_tables = self._fetch_rollback_tables(cur, batch)
+                batch = [(backup_db_name, opid_time, sql, rollback_tables[(backup_db_name, opid_time)])
+                         for backup_db_name, opid_time, sql in batch
+                         if (backup_db_name, opid_time) in rollback_tables]
+                for (backup_db_name, table_name), run in itertools.groupby(batch, key=lambda s: (s[0], s[3])):
+                    yield from self._iter_rollback_run(conn, backup_db_name, table_name, list(run))
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            raise Exception(e)
+        finally:
+            cur.close()
+            conn.close()
+
+    def _iter_rollback_run(self, conn, backup_db_name, table_name, run):
+        """
+        使用一个服务端游标查询同一备份表的多条语句的回滚语句, 按FIELD保持语句顺序,
+        在opid_time变化时输出对应语句的注释, 没有回滚语句的语句只输出注释
+        """
+        opid_list = [opid_time for _, opid_time, _, _ in run]
+        placeholders = ','.join(['%s'] * len(opid_list))
+        pending = iter(run)
+        current = None
+        ss_cur = conn.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            ss_cur.execute("select opid_time, rollback_statement from {}.{} where opid_time in ({}) "
+                           "order by field(opid_time, {}), id".format(backup_db_name, table_name,
+                                                                      placeholders, placeholders),
+                           opid_list + opid_list)
+            while True:
+                rows = ss_cur.fetchmany(size=self.rollback_batch_size)
+                if not rows:
+                    break
+                chunk = []
+                for opid_time, rollback_statement in rows:
+                    while opid_time != current:
+                        _, current, sql, _ = next(pending)
+                        chunk.append('-- {}\n'.format(sql.replace('\n', '\n-- ')))
+                    chunk.append('{}\n'.format(rollback_statement))
+                yield ''.join(chunk)
+        finally:
+            ss_cur.close()
+        for _, _, sql, _ in pending:
+            yield '-- {}\n'.format(sql.replace('\n', '\n-- '))
+
+    @staticmethod
+    def _backup_statements(workflow_id):
+        """获取工单中有备份的语句, 按执行顺序倒序返回[(backup_db_name, opid_time, sql)]"""
+        workflow_detail = SqlWorkflow.objects.get(id=workflow_id)
+        list_execute_result = json.loads(get_execute_result(workflow_detail))
+        list_execute_result.reverse()
+        statements = []
         for row in list_execute_result:
-            try:
-                # 获取backup_db_name， 兼容旧数据'[[]]'格式
-                if isinstance(row, list):
-                    if row[8] == 'None':
-                        continue
-                    backup_db_name = row[8]
-                    sequence = row[7]
-                    sql = row[5]
-                else:
-                    if row.get('backup_dbname') == 'None':
-                        continue
-                    backup_db_name = row.get('backup_dbname')
-                    sequence = row.get('sequence')
-                    sql = row.get('sql')
-                opid_time = sequence.replace("'", "")
-                sql_table = "select tablename from {}.$_$Inception_backup_information$_$ where opid_time='{}';".format(
-                    backup_db_name, opid_time)
-                cur.execute(sql_table)
-                list_tables = cur.fetchall()
-                if list_tables:
-                    table_name = list_tables[0][0]
-                    sql_back = "select rollback_statement from {}.{} where opid_time='{}'".format(
-                        backup_db_name, table_name, opid_time)
-                    cur.execute(sql_back)
-                    list_backup = cur.fetchall()
-                    block_rollback_sql_list = [sql]
-                    block_rollback_sql = '\n'.join([back_info[0] for back_info in list_backup])
-                    block_rollback_sql_list.append(block_rollback_sql)
-                    list_backup_sql.append(block_rollback_sql_list)
-            except Exception as e:
-                logger.error(traceback.format_exc())
-                raise Exception(e)
-        return list_backup_sql
+            # 获取backup_db_name， 兼容旧数据'[[]]'格式
+            if isinstance(row, list):
+                backup_db_name, sequence, sql = row[8], row[7], row[5]
+            else:
+                backup_db_name, sequence, sql = row.get('backup_dbname'), row.get('sequence'), row.get('sql')
+            if backup_db_name == 'None':
+                continue
+            statements.append((backup_db_name, sequence.replace("'", ""), sql))
+        return statements
+
+    @staticmethod
+    def _fetch_rollback_tables(cur, batch):
+        """批量获取一批语句的备份表, 返回{(backup_db_name, opid_time): table_name}"""
+        opid_times = {}
+        for backup_db_name, opid_time, _ in batch:
+            opid_times.setdefault(backup_db_name, set()).add(opid_time)
+        rollback_tables = {}
+        for backup_db_name, opid_list in opid_times.items():
+            opid_list = list(opid_list)
+            sql_table = "select opid_time, tablename from {}.$_$Inception_backup_information$_$ " \
+                        "where opid_time in ({});".format(backup_db_name, ','.join(['%s'] * len(opid_list)))
+            cur.execute(sql_table, opid_list)
+            for opid_time, table_name in cur.fetchall():
+                rollback_tables.setdefault((backup_db_name, opid_time), table_name)
+        return rollback_tables
+
+    @classmethod
+    def _fetch_rollback_statements(cls, cur, batch):
+        """批量获取一批语句的回滚语句, 返回{(backup_db_name, opid_time): [rollback_statement]}"""
+        table_opids = {}
+        for (backup_db_name, opid_time), table_name in cls._fetch_rollback_tables(cur, batch).items():
+            table_opids.setdefault((backup_db_name, table_name), []).append(opid_time)
+        rollback_statements = {}
+        for (backup_db_name, table_name), opid_list in table_opids.items():
+            for opid_time in opid_list:
+                rollback_statements[(backup_db_name, opid_time)] = []
+            sql_back = "select opid_time, rollback_statement from {}.{} where opid_time in ({})".format(
+                backup_db_name, table_name, ','.join(['%s'] * len(opid_list)))
+            cur.execute(sql_back, opid_list)
+            for opid_time, rollback_statement in cur.fetchall():
+                rollback_statements[(backup_db_name, opid_time)].append(rollback_statement)
+        return rollback_statements
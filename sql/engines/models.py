@@ -2,6 +2,37 @@
 import json
 
 
+class StreamRows:
+    """流式查询的行迭代器, 读取完成、读取出错或调用close()时关闭游标并执行on_close释放连接,
+    close()可重复调用, 未开始遍历时也可直接close()"""
+
+    def __init__(self, rows, cursor, on_close=None):
+        self._rows = iter(rows)
+        self.cursor = cursor
+        self.on_close = on_close
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._rows)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.cursor.close()
+        finally:
+            if self.on_close:
+                self.on_close()
+
+
 class ReviewResult:
     """审核的单条结果"""
 
@@ -67,7 +98,8 @@ class ReviewSet:
 
 
 class ResultSet:
-    """查询的结果集, rows 内只有值, column_list 中的是key"""
+    """查询的结果集, rows 内只有值, column_list 中的是key
+    流式查询时rows为迭代器, 只能遍历一次"""
 
     def __init__(self, full_sql='', rows=[], status=None,
                  affected_rows=0, column_list=None, **kwargs):
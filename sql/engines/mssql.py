@@ -3,7 +3,7 @@ import traceback
 import re
 from . import EngineBase
 import pyodbc
-from .models import ResultSet, ReviewResult, ReviewSet
+from .models import ResultSet, ReviewResult, ReviewSet, StreamRows
 from sql.utils.data_masking import brute_mask
 
 logger = logging.getLogger('default')
@@ -11,12 +11,37 @@ logger = logging.getLogger('default')
 
 class MssqlEngine(EngineBase):
     def get_connection(self, db_name=None):
+        if not self.conn:
+            self.conn = self.pool.acquire()
+        # 池中的连接可能停留在其他库, 每次指定库名时重新切换
+        if db_name:
+            self.conn.execute('use {};'.format(db_name))
+        return self.conn
+
+    def new_connection(self):
         connstr = """DRIVER=ODBC Driver 17 for SQL Server;SERVER={0};PORT={1};UID={2};PWD={3};
 client charset = UTF-8;connect timeout=10;CHARSET=UTF8;""".format(self.host,
                                                                   self.port, self.user, self.password)
         conn = pyodbc.connect(connstr)
         return conn
 
+    def check_connection(self, conn):
+        conn.execute('select 1;').fetchall()
+
+    def reset_connection(self, conn):
+        """归还前回滚未提交的事务, 并切换回登录时的默认库, 避免use切换的库带到下一次db_name=None的取用"""
+        conn.rollback()
+        original_db = conn.execute('select original_db_name();').fetchone()[0]
+        conn.execute('use [{}];'.format(original_db.replace(']', ']]')))
+
+    @property
+    def name(self):
+        return 'MsSQL'
+
+    @property
+    def info(self):
+        return 'MsSQL engine'
+
     def get_all_databases(self):
         """连进指定的mssql实例里，读取所有databases并返回"""
         sql = "SELECT name FROM master.sys.databases"
@@ -94,14 +119,14 @@ order by o.name,c.colid""".format(db_name, tb_name)
                 sql = sql_lower.replace('select', 'select top {}'.format(limit_num))
         return {'filtered_sql': sql}
 
-    def query(self, db_name=None, sql='', limit_num=0, close_conn=True):
+    def query(self, db_name=None, sql='', limit_num=0, close_conn=True, stream=False):
         """返回 ResultSet """
         result_set = ResultSet(full_sql=sql)
+        if stream:
+            return self._stream_query(result_set, db_name, sql, limit_num, close_conn)
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(db_name=db_name)
             cursor = conn.cursor()
-            if db_name:
-                cursor.execute('use {};'.format(db_name))
             effect_row = cursor.execute(sql)
             if int(limit_num) > 0:
                 rows = cursor.fetchmany(int(limit_num))
@@ -120,9 +145,52 @@ order by o.name,c.colid""".format(db_name, tb_name)
             logger.error(traceback.format_exc())
             result_set.error = str(e)
         finally:
-            conn.close()
+            if close_conn:
+                self.close()
         return result_set
 
+    def close(self):
+        """归还连接到连接池"""
+        if self.conn:
+            self.pool.release(self.conn)
+            self.conn = None
+
+    def _stream_query(self, result_set, db_name, sql, limit_num, close_conn):
+        """rows为逐批fetchmany的迭代器"""
+        try:
+            conn = self.get_connection(db_name=db_name)
+            cursor = conn.cursor()
+            cursor.execute(sql)
+            fields = cursor.description
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            result_set.error = str(e)
+            if close_conn:
+                self.close()
+            return result_set
+        result_set.column_list = [i[0] for i in fields] if fields else []
+        # 游标和连接由StreamRows在读取完成或close()时释放, 避免依赖生成器的finally
+        result_set.rows = StreamRows(self._iter_rows(cursor, limit_num), cursor,
+                                     on_close=self.close if close_conn else None)
+        return result_set
+
+    def _iter_rows(self, cursor, limit_num):
+        """逐批读取游标, 直到读取完成或达到limit_num"""
+        limit_num = int(limit_num)
+        fetched = 0
+        while True:
+            size = self.stream_batch_size
+            if limit_num > 0:
+                size = min(size, limit_num - fetched)
+                if size <= 0:
+                    break
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            fetched += len(rows)
+            for row in rows:
+                yield tuple(row)
+
     def query_masking(self, db_name=None, sql='', resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
@@ -1,26 +1,123 @@
+import functools
 import logging
+import queue
+import threading
 import traceback
 import MySQLdb
+import MySQLdb.cursors
 import re
 import sqlparse
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 
 from . import EngineBase
-from .models import ResultSet, ReviewResult, ReviewSet
+from .models import ResultSet, ReviewResult, ReviewSet, StreamRows
 from .inception import InceptionEngine
 from sql.utils.data_masking import Masking
+from sql.utils.execute_result import append_execute_result, clear_execute_result
 from common.config import SysConfig
 
 logger = logging.getLogger('default')
 
+# 可识别目标表的单表语句, 多表关联、子查询等无法判断涉及的表, 作为执行屏障单独执行
+split_table_pattern = re.compile(
+    r"^(?:insert\s+(?:(?:low_priority|delayed|high_priority|ignore)\s+)*(?:into\s+)?"
+    r"|replace\s+(?:(?:low_priority|delayed)\s+)*(?:into\s+)?"
+    r"|update\s+(?:(?:low_priority|ignore)\s+)*"
+    r"|delete\s+(?:(?:low_priority|quick|ignore)\s+)*from\s+)"
+    r"((?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?)(?![\w`.])", re.I)
+
+
+def split_chunk_tables(sql_chunk, db_name=''):
+    """
+    获取split后的一段SQL涉及的表, 含有无法识别的语句时返回None
+    db_name: 工单的默认数据库, 没有use语句时未指定库名的表属于该库
+    """
+    db_name = (db_name or '').lower()
+    tables = set()
+    for statement in sqlparse.split(sql_chunk):
+        statement = sqlparse.format(statement, strip_comments=True).strip().rstrip(';').strip()
+        if not statement:
+            continue
+        use_match = re.match(r"^use\s+`?([^`\s]+)`?$", statement, re.I)
+        if use_match:
+            db_name = use_match.group(1).lower()
+            continue
+        table_match = split_table_pattern.match(statement)
+        if table_match is None or re.search(r"\b(?:join|select|using)\b", statement, re.I):
+            return None
+        # 多表update
+        if statement[:6].lower() == 'update' and ',' in re.split(r"\sset\s", statement, 1, re.I)[0]:
+            return None
+        names = [name.strip().strip('`').lower() for name in table_match.group(1).split('.')]
+        tables.add(tuple(names) if len(names) == 2 else (db_name, names[0]))
+    return tables
+
+
+def plan_split_chunks(split_rows, db_name=''):
+    """
+    根据inception的split结果生成执行计划, db_name为工单的默认数据库
+    返回[stage], stage为[group], group为split结果的下标列表
+    stage之间顺序执行, 同一stage内的group可并发执行, group内按原顺序执行,
+    DDL和无法识别目标表的SQL单独作为一个stage
+    """
+    stages = []
+    groups = []  # [(tables, [index])]
+    for index, split_row in enumerate(split_rows):
+        is_ddl = len(split_row) > 2 and str(split_row[2]) == '1'
+        tables = None if is_ddl else split_chunk_tables(split_row[1], db_name)
+        if not tables:
+            if groups:
+                stages.append([group for _, group in groups])
+                groups = []
+            stages.append([[index]])
+            continue
+        merged_tables, merged_group = set(tables), [index]
+        for group_tables, group in [g for g in groups if g[0] & tables]:
+            groups.remove((group_tables, group))
+            merged_tables |= group_tables
+            merged_group += group
+        groups.append((merged_tables, sorted(merged_group)))
+    if groups:
+        stages.append([group for _, group in groups])
+    return stages
+
 
 class MysqlEngine(EngineBase):
     def get_connection(self, db_name=None):
-        if self.conn:
-            return self.conn
-        self.conn = MySQLdb.connect(host=self.host,
-                                    port=self.port, user=self.user, passwd=self.password, charset='utf8')
+        if not self.conn:
+            self.conn = self.pool.acquire()
+        # 池中的连接可能停留在其他库, 每次指定库名时重新切换,
+        # 不指定库名时如果连接切换过库, 使用COM_CHANGE_USER清除默认库, 与新建连接一致
+        if db_name:
+            self.conn.select_db(db_name)
+            self.conn.archery_selected_db = db_name
+        elif self.conn.archery_selected_db:
+            self.conn.change_user(self.user, self.password)
+            self.conn.archery_selected_db = None
         return self.conn
 
+    def new_connection(self):
+        conn = MySQLdb.connect(host=self.host,
+                               port=self.port, user=self.user, passwd=self.password, charset='utf8')
+        # 记录连接切换到的库, 新建连接没有默认库
+        conn.archery_selected_db = None
+        return conn
+
+    def check_connection(self, conn):
+        conn.ping()
+
+    def reset_connection(self, conn):
+        """
+        归还前回滚未提交的事务, 默认库在下次不指定库名取出时才清除,
+        ENGINE_CONNECTION_POOL['reset_session']为True时使用COM_CHANGE_USER完整重置会话变量、临时表等
+        """
+        if getattr(settings, 'ENGINE_CONNECTION_POOL', {}).get('reset_session', False):
+            conn.change_user(self.user, self.password)
+            conn.archery_selected_db = None
+        else:
+            conn.rollback()
+
     @property
     def name(self):
         return 'MySQL'
@@ -71,14 +168,14 @@ ORDER BY ORDINAL_POSITION;""".format(
         result = self.query(sql=sql)
         return result
 
-    def query(self, db_name=None, sql='', limit_num=0, close_conn=True):
+    def query(self, db_name=None, sql='', limit_num=0, close_conn=True, stream=False):
         """返回 ResultSet """
         result_set = ResultSet(full_sql=sql)
+        if stream:
+            return self._stream_query(result_set, db_name, sql, limit_num, close_conn)
         try:
-            conn = self.get_connection()
+            conn = self.get_connection(db_name=db_name)
             cursor = conn.cursor()
-            if db_name:
-                cursor.execute('use {}'.format(db_name))
             effect_row = cursor.execute(sql)
             if int(limit_num) > 0:
                 rows = cursor.fetchmany(size=int(limit_num))
@@ -101,6 +198,41 @@ ORDER BY ORDINAL_POSITION;""".format(
                 self.close()
         return result_set
 
+    def _stream_query(self, result_set, db_name, sql, limit_num, close_conn):
+        """使用服务端游标SSCursor查询, rows为逐批fetchmany的迭代器"""
+        try:
+            conn = self.get_connection(db_name=db_name)
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql)
+            fields = cursor.description
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            result_set.error = str(e)
+            if close_conn:
+                self.close()
+            return result_set
+        result_set.column_list = [i[0] for i in fields] if fields else []
+        # 游标和连接由StreamRows在读取完成或close()时释放, 避免依赖生成器的finally
+        result_set.rows = StreamRows(self._iter_rows(cursor, limit_num), cursor,
+                                     on_close=self.close if close_conn else None)
+        return result_set
+
+    def _iter_rows(self, cursor, limit_num):
+        """逐批读取游标, 直到读取完成或达到limit_num"""
+        limit_num = int(limit_num)
+        fetched = 0
+        while True:
+            size = self.stream_batch_size
+            if limit_num > 0:
+                size = min(size, limit_num - fetched)
+                if size <= 0:
+                    break
+            rows = cursor.fetchmany(size=size)
+            if not rows:
+                break
+            fetched += len(rows)
+            yield from rows
+
     def query_check(self, db_name=None, sql='', limit_num=10):
         # 连进指定的mysql实例里，执行sql并返回
         check_result = {'has_star': False, 'msg': '', 'filtered_sql': sql}
@@ -117,20 +249,21 @@ ORDER BY ORDINAL_POSITION;""".format(
     def query_masking(self, db_name=None, sql='', resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
-        # 解析语法树
-        mask_tool = Masking()
-        resultset_dict = resultset.__dict__
-        inception_mask_result = mask_tool.data_masking(self.instance_name, db_name, sql, resultset_dict)
-        # 传参进去之后, 就已经被处理
-        resultset.rows = resultset_dict['rows']
-        hit_rule = inception_mask_result['data']['hit_rule']
+        resultset, _ = self.query_masking_plan(db_name=db_name, sql=sql, resultset=resultset)
+        return resultset
+
+    def query_masking_plan(self, db_name=None, sql='', resultset=None):
+        """解析语法树生成一次脱敏计划, 脱敏传入的结果集, 后续各批数据使用同一计划脱敏"""
+        mask_result, plan = Masking().masking_plan(self.instance_name, db_name, sql, resultset.column_list)
+        resultset.rows = Masking.mask_rows(resultset.rows, plan)
+        hit_rule = mask_result['data']['hit_rule']
         if hit_rule == 1:
             resultset.is_masked = True
-        if inception_mask_result['status'] != 0:
+        if mask_result['status'] != 0:
             resultset.is_critical = True
-            resultset.error = inception_mask_result['msg']
-        resultset.status = inception_mask_result['status']
-        return resultset
+            resultset.error = mask_result['msg']
+        resultset.status = mask_result['status']
+        return resultset, functools.partial(Masking.mask_rows, plan=plan)
 
     def execute_check(self, db_name=None, sql=''):
         """上线单执行前的检查, 返回Review set"""
@@ -227,44 +360,25 @@ ORDER BY ORDINAL_POSITION;""".format(
             workflow_detail.db_name, workflow_detail.sql_content)
         split_result = inception_engine.query(sql=sql_split)
 
-        execute_result.rows = []
         # 对于split好的结果，再次交给inception执行.这里无需保持在长连接里执行，短连接即可.
-        for splitRow in split_result.rows:
-            sql_tmp = splitRow[1]
-            sql_execute = "/*--user=%s;--password=%s;--host=%s;--enable-execute;--port=%d; --enable-ignore-warnings;%s*/\
-                    inception_magic_start;\
-                    %s\
-                    inception_magic_commit;" % (
-                self.user,
-                self.password,
-                self.host,
-                self.port,
-                str_backup,
-                sql_tmp)
-
-            one_line_execute_result = inception_engine.query(sql=sql_execute)
-            # 执行, 把结果转换为ReviewSet
-            for sqlRow in one_line_execute_result.to_dict():
-                execute_result.rows.append(ReviewResult(
-                    id=sqlRow['ID'],
-                    stage=sqlRow['stage'],
-                    errlevel=sqlRow['errlevel'],
-                    stagestatus=sqlRow['stagestatus'],
-                    errormessage=sqlRow['errormessage'],
-                    sql=sqlRow['SQL'],
-                    affected_rows=sqlRow['Affected_rows'],
-                    actual_affected_rows=sqlRow['Affected_rows'],
-                    sequence=sqlRow['sequence'],
-                    backup_dbname=sqlRow['backup_dbname'],
-                    execute_time=sqlRow['execute_time'],
-                    sqlsha1=sqlRow['sqlsha1']))
-
-            # 每执行一次，就将执行结果更新到工单的execute_result
-            workflow_detail.execute_result = execute_result.json()
-            from django.db import connection
-            if connection.connection is not None:
-                connection.close()
-            workflow_detail.save()
+        chunks = [split_row[1] for split_row in split_result.rows]
+        chunk_results = [None] * len(chunks)
+
+        def save_progress(index):
+            # 每执行完一段，就将该段的执行结果追加到执行结果表，不再改写工单的execute_result
+            append_execute_result(workflow_detail.id, index, chunk_results[index])
+
+        clear_execute_result(workflow_detail.id)
+
+        workers = int(SysConfig().get('inception_parallel_workers', 1) or 1)
+        if workers > 1:
+            self._execute_split_parallel(inception_engine, split_result.rows, str_backup,
+                                         chunk_results, save_progress, workers, workflow_detail.db_name)
+        else:
+            for index, sql_tmp in enumerate(chunks):
+                chunk_results[index] = self._execute_split_chunk(inception_engine, sql_tmp, str_backup)
+                save_progress(index)
+        execute_result.rows = [row for rows in chunk_results if rows for row in rows]
 
         # 二次加工一下，目的是为了和sqlautoReview()函数的return保持格式一致，便于在detail页面渲染.
         execute_result.status = "workflow_finish"
@@ -277,11 +391,97 @@ ORDER BY ORDINAL_POSITION;""".format(
 
         return execute_result
 
+    def _execute_split_chunk(self, inception_engine, sql_tmp, str_backup):
+        """将split后的一段SQL交给inception执行, 返回ReviewResult列表"""
+        sql_execute = "/*--user=%s;--password=%s;--host=%s;--enable-execute;--port=%d; --enable-ignore-warnings;%s*/\
+                inception_magic_start;\
+                %s\
+                inception_magic_commit;" % (
+            self.user,
+            self.password,
+            self.host,
+            self.port,
+            str_backup,
+            sql_tmp)
+
+        one_line_execute_result = inception_engine.query(sql=sql_execute)
+        # 执行, 把结果转换为ReviewSet
+        return [ReviewResult(
+            id=sqlRow['ID'],
+            stage=sqlRow['stage'],
+            errlevel=sqlRow['errlevel'],
+            stagestatus=sqlRow['stagestatus'],
+            errormessage=sqlRow['errormessage'],
+            sql=sqlRow['SQL'],
+            affected_rows=sqlRow['Affected_rows'],
+            actual_affected_rows=sqlRow['Affected_rows'],
+            sequence=sqlRow['sequence'],
+            backup_dbname=sqlRow['backup_dbname'],
+            execute_time=sqlRow['execute_time'],
+            sqlsha1=sqlRow['sqlsha1']) for sqlRow in one_line_execute_result.to_dict()]
+
+    def _execute_split_parallel(self, inception_engine, split_rows, str_backup, chunk_results, save_progress,
+                                workers, db_name=''):
+        """按执行计划并发执行split结果, 同一张表的SQL按原顺序串行执行, 不同表的SQL并发执行,
+        执行结果写入chunk_results, 工单进度只在当前线程中按split的原顺序保存, 先完成的段等待前面的段完成后再保存"""
+        failed = threading.Event()
+        next_save = 0  # 下一个待保存的段
+        completed = set()  # 已完成但前面还有未完成的段
+        for stage in plan_split_chunks(split_rows, db_name):
+            done = queue.Queue()
+
+            def run_group(group):
+                from django.db import connection
+                try:
+                    for index in group:
+                        if failed.is_set():
+                            return
+                        chunk_results[index] = self._execute_split_chunk(
+                            inception_engine, split_rows[index][1], str_backup)
+                        done.put(index)
+                except Exception:
+                    failed.set()
+                    raise
+                finally:
+                    done.put(None)
+                    if connection.connection is not None:
+                        connection.close()
+
+            with ThreadPoolExecutor(max_workers=min(workers, len(stage))) as executor:
+                futures = [executor.submit(run_group, group) for group in stage]
+                running = len(futures)
+                while running:
+                    index = done.get()
+                    if index is None:
+                        running -= 1
+                        continue
+                    completed.add(index)
+                    while next_save in completed:
+                        completed.remove(next_save)
+                        save_progress(next_save)
+                        next_save += 1
+            # 有段执行失败时前面会留下未完成的段, 已完成的段仍按顺序保存
+            for index in sorted(completed):
+                save_progress(index)
+            completed.clear()
+            for future in futures:
+                future.result()
+
     def get_rollback(self):
         """获取回滚语句列表"""
         inception_engine = InceptionEngine()
         return inception_engine.get_rollback_list(self.workflow.id)
 
+    def get_rollback_page(self, offset=0, limit=None):
+        """分页获取回滚语句, 用于回滚页面分批加载"""
+        inception_engine = InceptionEngine()
+        return inception_engine.get_rollback_page(self.workflow.id, offset, limit)
+
+    def get_rollback_script(self):
+        """流式获取回滚脚本, 用于下载"""
+        inception_engine = InceptionEngine()
+        return inception_engine.iter_rollback_sql(self.workflow.id)
+
     def execute(self, db_name=None, sql='', close_conn=True):
         result = ResultSet(full_sql=sql)
         conn = self.get_connection()
@@ -299,6 +499,7 @@ ORDER BY ORDINAL_POSITION;""".format(
         return result
 
     def close(self):
+        """归还连接到连接池"""
         if self.conn:
-            self.conn.close()
+            self.pool.release(self.conn)
             self.conn = None
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+"""实例连接池, 按进程、按实例复用engine的数据库连接
+
+每个进程内对同一个实例(host/port/user/password相同)维护一个``ConnectionPool``,
+engine在``get_connection``时从池中取出连接, 在``close``时归还连接.
+"""
+import logging
+import os
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+logger = logging.getLogger('default')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """单个实例的连接池
+
+    creator: 无参函数, 返回一个新连接
+    checker: 取出连接时的健康检查函数, 传入conn, 检查失败抛出异常
+    resetter: 归还连接时的重置函数, 传入conn, 如回滚未提交的事务
+    max_size: 池中保留的空闲连接数上限, 为0时不做复用, 归还即关闭
+    idle_timeout: 空闲超过该秒数的连接在取出时丢弃
+    check_interval: 归还不超过该秒数的连接在取出时跳过健康检查, 为0时每次取出都检查
+    """
+
+    def __init__(self, creator, checker=None, resetter=None, max_size=10, idle_timeout=300, check_interval=5):
+        self.creator = creator
+        self.checker = checker
+        self.resetter = resetter
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._idle = []  # [(conn, 归还时间)], 后进先出
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取出一个可用连接, 池中无可用连接则新建"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, released_at = self._idle.pop()
+            idle_seconds = time.time() - released_at
+            if idle_seconds > self.idle_timeout:
+                self._close(conn)
+                continue
+            try:
+                if self.checker and idle_seconds > self.check_interval:
+                    self.checker(conn)
+            except Exception:
+                logger.debug('连接池健康检查失败, 丢弃连接:{}'.format(traceback.format_exc()))
+                self._close(conn)
+                continue
+            return conn
+        return self.creator()
+
+    def release(self, conn):
+        """归还连接, 重置失败或池已满时直接关闭"""
+        try:
+            if self.resetter:
+                self.resetter(conn)
+        except Exception:
+            logger.debug('连接重置失败, 丢弃连接:{}'.format(traceback.format_exc()))
+            self._close(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.time()))
+                return
+        self._close(conn)
+
+    def clear(self):
+        """关闭池中所有空闲连接"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    @property
+    def size(self):
+        return len(self._idle)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            logger.debug(traceback.format_exc())
+
+
+def get_pool(key, creator, checker=None, resetter=None):
+    """获取key对应的连接池, 不存在则创建, key中会加入进程号, 避免fork后的子进程共用连接"""
+    pool_key = (os.getpid(),) + tuple(key)
+    with _pools_lock:
+        pool = _pools.get(pool_key)
+        if pool is None:
+            pool_config = getattr(settings, 'ENGINE_CONNECTION_POOL', {})
+            pool = ConnectionPool(creator, checker=checker, resetter=resetter,
+                                  max_size=int(pool_config.get('max_size', 10)),
+                                  idle_timeout=int(pool_config.get('idle_timeout', 300)),
+                                  check_interval=float(pool_config.get('check_interval', 5)))
+            _pools[pool_key] = pool
+    return pool
+
+
+def close_all_pools():
+    """关闭并清空当前进程的全部连接池"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
@@ -1,9 +1,14 @@
+import json
+import threading
+
 from django.test import TestCase
 from unittest.mock import patch, Mock, ANY
-from sql.models import Instance
+from sql.models import Instance, SqlWorkflow
+from sql.engines.inception import InceptionEngine
 from sql.engines.mssql import MssqlEngine
-from sql.engines.mysql import MysqlEngine
+from sql.engines.mysql import MysqlEngine, plan_split_chunks
 from sql.engines.models import ResultSet
+from sql.engines.pool import ConnectionPool, close_all_pools
 
 
 class TestMssql(TestCase):
@@ -19,6 +24,9 @@ class TestMssql(TestCase):
     def tearDownClass(cls):
         cls.ins1.delete()
 
+    def setUp(self):
+        close_all_pools()
+
     @patch('sql.engines.mssql.pyodbc.connect')
     def testGetConnection(self,connect):
         new_engine = MssqlEngine(instance=self.ins1)
@@ -36,9 +44,22 @@ class TestMssql(TestCase):
         query_result = new_engine.query(sql='some_str',limit_num=100)
         cur.return_value.execute.assert_called()
         cur.return_value.fetchmany.assert_called_once_with(100)
-        connect.return_value.close.assert_called_once()
+        # 查询结束后连接归还连接池, 不关闭
+        connect.return_value.close.assert_not_called()
+        self.assertEqual(new_engine.pool.size, 1)
         self.assertIsInstance(query_result, ResultSet)
 
+    @patch('sql.engines.mssql.pyodbc.connect')
+    def testReleasedConnectionReset(self, connect):
+        """归还的连接回滚并切换回登录时的默认库"""
+        connect.return_value.execute.return_value.fetchone.return_value = ('some_default_db',)
+        new_engine = MssqlEngine(instance=self.ins1)
+        new_engine.get_connection(db_name='db_a')
+        new_engine.close()
+        connect.return_value.rollback.assert_called_once()
+        connect.return_value.execute.assert_called_with('use [some_default_db];')
+        self.assertEqual(new_engine.pool.size, 1)
+
     @patch.object(MssqlEngine, 'query')
     def testAllDb(self, mock_query):
         db_result = ResultSet()
@@ -96,6 +117,8 @@ class TestMysql(TestCase):
     def tearDownClass(cls):
         cls.ins1.delete()
 
+    def setUp(self):
+        close_all_pools()
 
     @patch('MySQLdb.connect')
     def testGetConnection(self,connect):
@@ -114,9 +137,110 @@ class TestMysql(TestCase):
         query_result = new_engine.query(sql='some_str', limit_num=100)
         cur.return_value.execute.assert_called()
         cur.return_value.fetchmany.assert_called_once_with(size=100)
-        connect.return_value.close.assert_called_once()
+        # 查询结束后连接归还连接池, 不关闭
+        connect.return_value.close.assert_not_called()
+        connect.return_value.rollback.assert_called_once()
+        connect.return_value.change_user.assert_not_called()
         self.assertIsInstance(query_result, ResultSet)
 
+    @patch('MySQLdb.connect')
+    def testStreamQuery(self, connect):
+        """流式查询分批读取, 达到limit_num后停止并归还连接"""
+        cur = connect.return_value.cursor.return_value
+        cur.description = (('k1', 'some_other_des'),)
+        cur.fetchmany.side_effect = [(('v1',), ('v2',)), (('v3',),)]
+        new_engine = MysqlEngine(instance=self.ins1)
+        new_engine.stream_batch_size = 2
+        query_result = new_engine.query(sql='some_str', limit_num=3, stream=True)
+        self.assertEqual(query_result.column_list, ['k1'])
+        connect.return_value.rollback.assert_not_called()
+        self.assertEqual(list(query_result.rows), [('v1',), ('v2',), ('v3',)])
+        self.assertEqual(cur.fetchmany.call_count, 2)
+        cur.fetchmany.assert_called_with(size=1)
+        cur.close.assert_called_once()
+        connect.return_value.rollback.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def testStreamQueryCloseBeforeIter(self, connect):
+        """流式查询未遍历就close时关闭游标并归还连接, 重复close不会重复归还"""
+        cur = connect.return_value.cursor.return_value
+        cur.description = (('k1', 'some_other_des'),)
+        new_engine = MysqlEngine(instance=self.ins1)
+        query_result = new_engine.query(sql='some_str', stream=True)
+        query_result.rows.close()
+        query_result.rows.close()
+        cur.fetchmany.assert_not_called()
+        cur.close.assert_called_once()
+        connect.return_value.rollback.assert_called_once()
+        self.assertIsNone(new_engine.conn)
+
+    @patch('MySQLdb.connect')
+    def testConnectionReuse(self, connect):
+        """同一实例的engine复用连接池中的连接, 刚归还的连接取出时不检查"""
+        MysqlEngine(instance=self.ins1).query(sql='select 1')
+        new_engine = MysqlEngine(instance=self.ins1)
+        new_engine.query(db_name='some_db', sql='select 1')
+        connect.assert_called_once()
+        connect.return_value.ping.assert_not_called()
+        connect.return_value.select_db.assert_called_once_with('some_db')
+
+    @patch('MySQLdb.connect')
+    def testConnectionCheckAfterInterval(self, connect):
+        """归还超过check_interval的连接取出时ping检查"""
+        with self.settings(ENGINE_CONNECTION_POOL={'check_interval': 0}):
+            MysqlEngine(instance=self.ins1).query(sql='select 1')
+            MysqlEngine(instance=self.ins1).query(sql='select 1')
+        connect.assert_called_once()
+        connect.return_value.ping.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def testReleasedConnectionReset(self, connect):
+        """归还的连接重置会话, use切换的库不会带到下一次db_name=None的取用"""
+        class SessionConn(Mock):
+            db = None
+
+            def select_db(self, db_name):
+                self.db = db_name
+
+            def change_user(self, user, passwd, db=None):
+                self.db = db
+
+        connect.return_value = SessionConn()
+        engine = MysqlEngine(instance=self.ins1)
+        self.assertEqual(engine.get_connection(db_name='db_a').db, 'db_a')
+        engine.close()
+        conn = MysqlEngine(instance=self.ins1).get_connection()
+        connect.assert_called_once()
+        self.assertIsNone(conn.db)
+
+    @patch('MySQLdb.connect')
+    def testReleasedConnectionResetOnlyChanged(self, connect):
+        """归还时只回滚事务, 只有切换过库且下次不指定库名取出时才使用COM_CHANGE_USER"""
+        engine = MysqlEngine(instance=self.ins1)
+        engine.get_connection(db_name='db_a')
+        engine.close()
+        engine.get_connection(db_name='db_b')
+        engine.close()
+        connect.return_value.change_user.assert_not_called()
+        self.assertEqual(connect.return_value.rollback.call_count, 2)
+        engine.get_connection()
+        connect.return_value.change_user.assert_called_once_with('ins_user', 'some_pass')
+        engine.close()
+        engine.get_connection()
+        connect.return_value.change_user.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def testReleasedConnectionResetSession(self, connect):
+        """配置reset_session时归还连接使用COM_CHANGE_USER完整重置会话"""
+        with self.settings(ENGINE_CONNECTION_POOL={'reset_session': True}):
+            engine = MysqlEngine(instance=self.ins1)
+            engine.get_connection(db_name='db_a')
+            engine.close()
+            connect.return_value.change_user.assert_called_once_with('ins_user', 'some_pass')
+            connect.return_value.rollback.assert_not_called()
+            engine.get_connection()
+        connect.return_value.change_user.assert_called_once()
+
     @patch.object(MysqlEngine, 'query')
     def testAllDb(self, mock_query):
         db_result = ResultSet()
@@ -156,3 +280,173 @@ class TestMysql(TestCase):
         sql_without_limit = 'select user from usertable'
         check_result = new_engine.query_check(db_name='some_db', sql=sql_without_limit,limit_num=100)
         self.assertEqual(check_result['filtered_sql'], 'select user from usertable limit 100')
+
+    def testPlanSplitChunks(self):
+        split_rows = [
+            (1, 'use some_db;insert into t1 values(1);', 0),
+            (2, 'use some_db;update t2 set c=1;', 0),
+            (3, 'use some_db;delete from `some_db`.`t1` where id=1;', 0),
+            (4, 'use some_db;alter table t3 add c int;', 1),
+            (5, 'use some_db;update t1 a, t2 b set a.c=b.c;', 0),
+            (6, 'use some_db;update t4 set c=1;', 0),
+        ]
+        # 同一张表按顺序分在同一组, DDL和多表语句单独执行
+        self.assertEqual(plan_split_chunks(split_rows), [[[1], [0, 2]], [[3]], [[4]], [[5]]])
+
+    def testPlanSplitChunksDefaultDb(self):
+        """没有use语句的表属于工单的默认数据库"""
+        split_rows = [
+            (1, 'insert into t1 values(1);', 0),
+            (2, 'update some_db.t1 set c=1;', 0),
+            (3, 'update other_db.t1 set c=1;', 0),
+        ]
+        self.assertEqual(plan_split_chunks(split_rows, 'Some_DB'), [[[0, 1], [2]]])
+        self.assertEqual(plan_split_chunks(split_rows), [[[0], [1], [2]]])
+
+    def testExecuteSplitParallelSaveInOrder(self):
+        """并发执行时先完成的段等待前面的段完成后, 按split的原顺序保存进度"""
+        split_rows = [(1, 'update t1 set c=1;', 0), (2, 'update t2 set c=1;', 0), (3, 'update t3 set c=1;', 0)]
+        first_started = threading.Event()
+        others_done = threading.Semaphore(0)
+
+        def execute_split_chunk(inception_engine, sql_tmp, str_backup):
+            # 第一段在其余两段完成后才完成
+            if 't1' in sql_tmp:
+                first_started.set()
+                others_done.acquire()
+                others_done.acquire()
+            else:
+                first_started.wait()
+                others_done.release()
+            return [sql_tmp]
+
+        saved = []
+        chunk_results = [None] * 3
+        engine = MysqlEngine(instance=self.ins1)
+        with patch.object(engine, '_execute_split_chunk', side_effect=execute_split_chunk):
+            engine._execute_split_parallel(Mock(), split_rows, '', chunk_results, saved.append, 3)
+        self.assertEqual(saved, [0, 1, 2])
+        self.assertEqual(chunk_results, [['update t1 set c=1;'], ['update t2 set c=1;'], ['update t3 set c=1;']])
+
+
+class TestConnectionPool(TestCase):
+
+    def testDiscardBrokenConnection(self):
+        """健康检查失败的连接被丢弃并新建连接"""
+        broken_conn, new_conn = Mock(), Mock()
+        creator = Mock(return_value=new_conn)
+        checker = Mock(side_effect=Exception('gone away'))
+        pool = ConnectionPool(creator, checker=checker, check_interval=0)
+        pool.release(broken_conn)
+        self.assertEqual(pool.acquire(), new_conn)
+        broken_conn.close.assert_called_once()
+
+    def testSkipCheckFreshConnection(self):
+        """归还不超过check_interval的连接取出时跳过健康检查"""
+        conn, checker = Mock(), Mock()
+        pool = ConnectionPool(Mock(), checker=checker, check_interval=60)
+        pool.release(conn)
+        self.assertEqual(pool.acquire(), conn)
+        checker.assert_not_called()
+
+    def testIdleTimeout(self):
+        """空闲超时的连接被丢弃"""
+        old_conn = Mock()
+        pool = ConnectionPool(Mock(), idle_timeout=-1)
+        pool.release(old_conn)
+        pool.acquire()
+        old_conn.close.assert_called_once()
+
+    def testMaxSize(self):
+        """超出max_size的连接归还时直接关闭"""
+        pool = ConnectionPool(Mock(), max_size=1)
+        conn1, conn2 = Mock(), Mock()
+        pool.release(conn1)
+        pool.release(conn2)
+        self.assertEqual(pool.size, 1)
+        conn2.close.assert_called_once()
+
+
+class TestInception(TestCase):
+    def setUp(self):
+        self.wf = SqlWorkflow.objects.create(
+            workflow_name='some_name', group_id=1, group_name='g1', engineer='some_user',
+            audit_auth_groups='some_group', status='workflow_finish', is_backup='是',
+            instance_name='some_instance', db_name='some_db', sql_content='some_sql', sql_syntax=2,
+            execute_result=json.dumps([
+                {'id': 1, 'sql': 'use some_db', 'sequence': "'0_0_0'", 'backup_dbname': 'None'},
+                {'id': 2, 'sql': 'update t1 set c=1', 'sequence': "'1_0_1'", 'backup_dbname': 'backup_db'},
+                {'id': 3, 'sql': 'update t2 set c=1', 'sequence': "'1_0_2'", 'backup_dbname': 'backup_db'},
+            ]))
+
+    @patch('sql.engines.inception.InceptionEngine.get_backup_connection')
+    def testGetRollbackList(self, get_backup_connection):
+        """按备份库批量获取回滚语句, 结果按执行顺序倒序"""
+        cursor = get_backup_connection.return_value.cursor.return_value
+        cursor.fetchall.side_effect = [
+            [('1_0_1', 't1'), ('1_0_2', 't2')],
+            [('1_0_1', 'update t1 set c=0 where id=1;'), ('1_0_1', 'update t1 set c=0 where id=2;')],
+            [('1_0_2', 'update t2 set c=0 where id=1;')],
+        ]
+        rollback_list = InceptionEngine().get_rollback_list(self.wf.id)
+        self.assertEqual(rollback_list, [
+            ['update t2 set c=1', 'update t2 set c=0 where id=1;'],
+            ['update t1 set c=1', 'update t1 set c=0 where id=1;\nupdate t1 set c=0 where id=2;'],
+        ])
+        self.assertEqual(cursor.execute.call_count, 3)
+
+    @patch('sql.engines.inception.InceptionEngine.get_backup_connection')
+    def testGetRollbackPage(self, get_backup_connection):
+        """分页获取回滚语句, 只查询当前页的语句并返回有备份的语句总数"""
+        cursor = get_backup_connection.return_value.cursor.return_value
+        cursor.fetchall.side_effect = [
+            [('1_0_1', 't1')],
+            [('1_0_1', 'update t1 set c=0 where id=1;')],
+        ]
+        rows, total = InceptionEngine().get_rollback_page(self.wf.id, offset=1, limit=1)
+        self.assertEqual(rows, [['update t1 set c=1', 'update t1 set c=0 where id=1;']])
+        self.assertEqual(total, 2)
+        cursor.execute.assert_any_call(
+            'select opid_time, tablename from backup_db.$_$Inception_backup_information$_$ '
+            'where opid_time in (%s);', ['1_0_1'])
+
+    @patch('sql.engines.inception.InceptionEngine.get_backup_connection')
+    def testIterRollbackSql(self, get_backup_connection):
+        """回滚脚本按执行顺序倒序逐批输出"""
+        cursor = get_backup_connection.return_value.cursor.return_value
+        cursor.fetchall.return_value = [('1_0_1', 't1'), ('1_0_2', 't2')]
+        cursor.fetchmany.side_effect = [
+            [('1_0_2', 'update t2 set c=0 where id=1;')], [],
+            [('1_0_1', 'update t1 set c=0 where id=1;'), ('1_0_1', 'update t1 set c=0 where id=2;')], [],
+        ]
+        script = ''.join(InceptionEngine().iter_rollback_sql(self.wf.id))
+        self.assertEqual(script, '-- update t2 set c=1\n'
+                                 'update t2 set c=0 where id=1;\n'
+                                 '-- update t1 set c=1\n'
+                                 'update t1 set c=0 where id=1;\n'
+                                 'update t1 set c=0 where id=2;\n')
+        get_backup_connection.return_value.close.assert_called_once()
+
+    @patch('sql.engines.inception.InceptionEngine.get_backup_connection')
+    def testIterRollbackSqlSameTable(self, get_backup_connection):
+        """连续使用同一备份表的语句只执行一次流式查询, 没有回滚语句的语句只输出注释"""
+        self.wf.execute_result = json.dumps([
+            {'id': i, 'sql': 'update t1 set c={}'.format(i), 'sequence': "'1_0_{}'".format(i),
+             'backup_dbname': 'backup_db'} for i in range(1, 4)])
+        self.wf.save()
+        cursor = get_backup_connection.return_value.cursor.return_value
+        cursor.fetchall.return_value = [('1_0_1', 't1'), ('1_0_2', 't1'), ('1_0_3', 't1')]
+        cursor.fetchmany.side_effect = [
+            [('1_0_3', 'update t1 set c=2 where id=1;'), ('1_0_1', 'update t1 set c=0 where id=1;')], [],
+        ]
+        script = ''.join(InceptionEngine().iter_rollback_sql(self.wf.id))
+        self.assertEqual(script, '-- update t1 set c=3\n'
+                                 'update t1 set c=2 where id=1;\n'
+                                 '-- update t1 set c=2\n'
+                                 '-- update t1 set c=1\n'
+                                 'update t1 set c=0 where id=1;\n')
+        # 一次查询备份表名, 一次流式查询回滚语句
+        self.assertEqual(cursor.execute.call_count, 2)
+        cursor.execute.assert_called_with(
+            'select opid_time, rollback_statement from backup_db.t1 where opid_time in (%s,%s,%s) '
+            'order by field(opid_time, %s,%s,%s), id', ['1_0_3', '1_0_2', '1_0_1'] * 2)
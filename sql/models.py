@@ -140,6 +140,47 @@ class SqlWorkflow(models.Model):
         verbose_name_plural = u'SQL工单管理'
 
 
+class SqlWorkflowExecuteResult(models.Model):
+    """SQL上线工单的逐条执行结果, 执行过程中每完成一段split就追加写入, 不再反复改写工单的execute_result"""
+    workflow_id = models.IntegerField('工单ID')
+    chunk_index = models.IntegerField('split段序号')
+    row_index = models.IntegerField('段内序号')
+    result = models.TextField('单条执行结果的JSON格式')
+    create_time = models.DateTimeField('写入时间', auto_now_add=True)
+
+    class Meta:
+        managed = True
+        db_table = 'sql_workflow_execute_result'
+        unique_together = ('workflow_id', 'chunk_index', 'row_index')
+        verbose_name = u'SQL工单执行结果'
+        verbose_name_plural = u'SQL工单执行结果'
+
+
+class Binlog2sqlJob(models.Model):
+    """binlog2sql解析任务, 后台执行, 定期记录检查点, 失败或取消后可从检查点继续解析"""
+    instance_name = models.CharField('实例名称', max_length=50)
+    user_name = models.CharField('发起人', max_length=30)
+    params = models.TextField('解析参数的JSON格式')
+    filename = models.CharField('输出文件', max_length=255)
+    status = models.CharField('状态', max_length=20, default='waiting',
+                              choices=(('waiting', '等待执行'), ('running', '执行中'), ('canceling', '取消中'),
+                                       ('canceled', '已取消'), ('finish', '已完成'), ('failed', '执行失败')))
+    progress = models.FloatField('解析进度', default=0)
+    rows = models.BigIntegerField('已生成SQL行数', default=0)
+    log_file = models.CharField('检查点binlog文件', max_length=100, blank=True, default='')
+    log_pos = models.BigIntegerField('检查点binlog位置', default=0)
+    checkpoint = models.TextField('检查点的JSON格式', blank=True, default='')
+    error = models.TextField('错误信息', blank=True, default='')
+    create_time = models.DateTimeField('创建时间', auto_now_add=True)
+    update_time = models.DateTimeField('更新时间', auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = 'binlog2sql_job'
+        verbose_name = u'binlog2sql任务'
+        verbose_name_plural = u'binlog2sql任务'
+
+
 workflow_type_choices = (('sql_query', _('sql_query')), ('sql_review', _('sql_review')))
 
 
@@ -568,7 +609,30 @@ class SlowQueryHistory(models.Model):
     class Meta:
         managed = False
         db_table = 'mysql_slow_query_review_history'
-        unique_together = ('checksum', 'ts_min', 'ts_max')
-        index_together = ('hostname_max', 'ts_min')
+        unique_together = ('hostname_max', 'checksum', 'ts_min', 'ts_max')
+        index_together = (('hostname_max', 'ts_min'), ('hostname_max', 'db_max', 'ts_min', 'checksum'))
         verbose_name = u'慢日志明细'
         verbose_name_plural = u'慢日志明细'
+
+
+# 慢日志按小时预聚合, 由定时任务根据慢日志明细增量维护
+class SlowQueryRollup(models.Model):
+    hostname = models.CharField('实例地址', max_length=64)
+    db_name = models.CharField('数据库', max_length=64, null=True, default=None)
+    checksum = models.ForeignKey(SlowQuery, db_constraint=False, to_field='checksum', db_column='checksum',
+                                 on_delete=models.DO_NOTHING)
+    bucket = models.DateTimeField('统计小时')
+    ts_cnt = models.FloatField('执行次数', default=0)
+    query_time_sum = models.FloatField('执行总时长', default=0)
+    rows_examined_sum = models.FloatField('扫描总行数', default=0)
+    rows_sent_sum = models.FloatField('返回总行数', default=0)
+    ts_max = models.DateTimeField('最后出现时间')
+    history_id = models.IntegerField('已聚合的最大明细ID', default=0)
+
+    class Meta:
+        managed = True
+        db_table = 'mysql_slow_query_rollup'
+        unique_together = ('hostname', 'db_name', 'checksum', 'bucket')
+        index_together = (('hostname', 'bucket'), ('history_id',))
+        verbose_name = u'慢日志小时汇总'
+        verbose_name_plural = u'慢日志小时汇总'
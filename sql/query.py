@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 import datetime
+import itertools
 import logging
 import re
 import time
@@ -9,10 +10,9 @@ import simplejson as json
 import sqlparse
 from django.contrib.auth.decorators import permission_required
 from django.core import serializers
-from django.db import connection
 from django.db import transaction
-from django.db.models import Q, Min
-from django.http import HttpResponse, HttpResponseRedirect
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse
 from django_q.tasks import async_task
@@ -22,10 +22,13 @@ from common.utils.const import WorkflowDict
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.notify import notify_for_audit
 from sql.utils.data_masking import Masking
+from sql.utils.query_log import query_log_writer
+from sql.utils.query_privileges import UserPrivileges, query_privileges_changed
 from sql.utils.resource_group import user_instances, user_groups
 from sql.utils.workflow_audit import Audit
 from .models import QueryPrivilegesApply, QueryPrivileges, QueryLog, ResourceGroup, Instance
 from sql.engines import get_engine
+from sql.engines.models import ResultSet
 
 logger = logging.getLogger('default')
 
@@ -59,6 +62,9 @@ def query_audit_call_back(workflow_id, workflow_status):
                 limit_num=apply_queryset.limit_num, priv_type=apply_queryset.priv_type) for table_name in
                 apply_queryset.table_list.split(',')]
         QueryPrivileges.objects.bulk_create(insertlist)
+        # bulk_create不触发post_save，需要通知权限变更, 事务提交后再通知, 避免提交前缓存被旧权限重新写入
+        user_name = apply_queryset.user_name
+        transaction.on_commit(lambda: query_privileges_changed.send(sender=QueryPrivileges, user_name=user_name))
 
 
 # 查询权限校验
@@ -73,19 +79,15 @@ def query_priv_check(user, instance_name, db_name, sql_content, limit_num):
         result['data']['limit_num'] = limit_num
         return result
 
+    # 获取用户的查询权限快照，后续校验均在快照中完成
+    user_privileges = UserPrivileges.load(user.username)
+
     # 查看表结构的语句，inception语法树解析会报错，故单独处理，explain直接跳过不做校验
-    elif re.match(r"^show\s+create\s+table", sql_content.lower()):
+    if re.match(r"^show\s+create\s+table", sql_content.lower()):
         tb_name = re.sub('^show\s+create\s+table', '', sql_content, count=1, flags=0).strip()
-        # 先判断是否有整库权限
-        db_privileges = QueryPrivileges.objects.filter(user_name=user.username, instance_name=instance_name,
-                                                       db_name=db_name, priv_type=1,
-                                                       valid_date__gte=datetime.datetime.now(), is_deleted=0)
-        # 无整库权限再验证表权限
-        if len(db_privileges) == 0:
-            tb_privileges = QueryPrivileges.objects.filter(user_name=user.username, instance_name=instance_name,
-                                                           db_name=db_name, table_name=tb_name, priv_type=2,
-                                                           valid_date__gte=datetime.datetime.now(), is_deleted=0)
-            if len(tb_privileges) == 0:
+        # 先判断是否有整库权限，无整库权限再验证表权限
+        if not user_privileges.has_db_priv(instance_name, db_name):
+            if not user_privileges.has_table_priv(instance_name, db_name, tb_name, priv_type=2):
                 result['status'] = 1
                 result['msg'] = '你无' + db_name + '.' + tb_name + '表的查询权限！请先到查询权限管理进行申请'
                 return result
@@ -97,18 +99,10 @@ def query_priv_check(user, instance_name, db_name, sql_content, limit_num):
         # 正确解析拿到表数据，可以校验表权限
         if table_ref_result['status'] == 0:
             table_ref = table_ref_result['data']
-            # 获取表信息,校验是否拥有全部表查询权限
-            QueryPrivilegesOb = QueryPrivileges.objects.filter(user_name=user.username, instance_name=instance_name)
-            # 先判断是否有整库权限
+            # 先判断是否有整库权限，无整库权限再验证表权限
             for table in table_ref:
-                db_privileges = QueryPrivilegesOb.filter(db_name=table['db'], priv_type=1,
-                                                         valid_date__gte=datetime.datetime.now(),
-                                                         is_deleted=0)
-                # 无整库权限再验证表权限
-                if len(db_privileges) == 0:
-                    tb_privileges = QueryPrivilegesOb.filter(db_name=table['db'], table_name=table['table'],
-                                                             valid_date__gte=datetime.datetime.now(), is_deleted=0)
-                    if len(tb_privileges) == 0:
+                if not user_privileges.has_db_priv(instance_name, table['db']):
+                    if not user_privileges.has_table_priv(instance_name, table['db'], table['table']):
                         result['status'] = 1
                         result['msg'] = '你无' + table['db'] + '.' + table['table'] + '表的查询权限！请先到查询权限管理进行申请'
                         return result
@@ -116,11 +110,7 @@ def query_priv_check(user, instance_name, db_name, sql_content, limit_num):
         # 获取表数据报错，检查配置文件是否允许继续执行，并进行库权限校验
         else:
             # 校验库权限，防止inception的语法树打印错误时连库权限也未做校验
-            privileges = QueryPrivileges.objects.filter(user_name=user.username, instance_name=instance_name,
-                                                        db_name=db_name,
-                                                        valid_date__gte=datetime.datetime.now(),
-                                                        is_deleted=0)
-            if len(privileges) == 0:
+            if not user_privileges.has_any_priv(instance_name, db_name):
                 result['status'] = 1
                 result['msg'] = '你无' + db_name + '数据库的查询权限！请先到查询权限管理进行申请'
                 return result
@@ -133,26 +123,13 @@ def query_priv_check(user, instance_name, db_name, sql_content, limit_num):
     if table_ref:
         db_list = [table_info['db'] for table_info in table_ref]
         table_list = [table_info['table'] for table_info in table_ref]
-        user_limit_num = QueryPrivileges.objects.filter(user_name=user.username,
-                                                        instance_name=instance_name,
-                                                        db_name__in=db_list,
-                                                        table_name__in=table_list,
-                                                        valid_date__gte=datetime.datetime.now(),
-                                                        is_deleted=0).aggregate(Min('limit_num'))['limit_num__min']
+        user_limit_num = user_privileges.min_limit(instance_name, db_list, table_list)
         if user_limit_num is None:
             # 如果表没获取到则获取涉及库的最小limit限制
-            user_limit_num = QueryPrivileges.objects.filter(user_name=user.username,
-                                                            instance_name=instance_name,
-                                                            db_name=db_name,
-                                                            valid_date__gte=datetime.datetime.now(), is_deleted=0
-                                                            ).aggregate(Min('limit_num'))['limit_num__min']
+            user_limit_num = user_privileges.min_limit(instance_name, [db_name])
     else:
         # 如果表没获取到则获取涉及库的最小limit限制
-        user_limit_num = QueryPrivileges.objects.filter(user_name=user.username,
-                                                        instance_name=instance_name,
-                                                        db_name=db_name,
-                                                        valid_date__gte=datetime.datetime.now(),
-                                                        is_deleted=0).aggregate(Min('limit_num'))['limit_num__min']
+        user_limit_num = user_privileges.min_limit(instance_name, [db_name])
     limit_num = int(user_limit_num) if int(limit_num) == 0 else min(int(limit_num), int(user_limit_num))
     result['data']['limit_num'] = limit_num
     return result
@@ -365,11 +342,13 @@ def modifyqueryprivileges(request):
 
     # type=1删除权限,type=2变更权限
     privileges = QueryPrivileges()
+    user_name = QueryPrivileges.objects.filter(privilege_id=int(privilege_id)).values_list('user_name', flat=True).first()
     if int(type) == 1:
         # 删除权限
         privileges.privilege_id = int(privilege_id)
         privileges.is_deleted = 1
         privileges.save(update_fields=['is_deleted'])
+        transaction.on_commit(lambda: query_privileges_changed.send(sender=QueryPrivileges, user_name=user_name))
         return HttpResponse(json.dumps(result), content_type='application/json')
     elif int(type) == 2:
         # 变更权限
@@ -379,6 +358,7 @@ def modifyqueryprivileges(request):
         privileges.valid_date = valid_date
         privileges.limit_num = limit_num
         privileges.save(update_fields=['valid_date', 'limit_num'])
+        transaction.on_commit(lambda: query_privileges_changed.send(sender=QueryPrivileges, user_name=user_name))
         return HttpResponse(json.dumps(result), content_type='application/json')
 
 
@@ -498,6 +478,11 @@ def query(request):
             sql_content = filter_result['filtered_sql']
         sql_content = sql_content + ';'
 
+        # 流式返回查询结果
+        if SysConfig().get('stream_query'):
+            return query_stream_response(user, query_engine, instance_name, db_name, sql_content,
+                                         limit_num, priv_check)
+
         # 执行查询语句,统计执行时间
         t_start = time.time()
         query_result = query_engine.query(db_name=str(db_name), sql=sql_content, limit_num=limit_num)
@@ -542,27 +527,8 @@ def query(request):
         if sql_result.get('error'):
             pass
         else:
-            query_log = QueryLog()
-            query_log.username = user.username
-            query_log.user_display = user.display
-            query_log.db_name = db_name
-            query_log.instance_name = instance_name
-            query_log.sqllog = sql_content
-            if int(limit_num) == 0:
-                limit_num = int(sql_result['affected_rows'])
-            else:
-                limit_num = min(int(limit_num), int(sql_result['affected_rows']))
-            query_log.effect_row = limit_num
-            query_log.cost_time = query_result.query_time
-            query_log.priv_check = priv_check
-            query_log.hit_rule = hit_rule
-            query_log.masking = masking
-            # 防止查询超时
-            try:
-                query_log.save()
-            except:
-                connection.close()
-                query_log.save()
+            save_query_log(user, instance_name, db_name, sql_content, limit_num, sql_result['affected_rows'],
+                           query_result.query_time, priv_check, hit_rule, masking)
     except Exception as e:
         logger.error(traceback.format_exc())
         result['status'] = 1
@@ -577,6 +543,141 @@ def query(request):
                             content_type='application/json')
 
 
+# 记录查询日志
+def save_query_log(user, instance_name, db_name, sql_content, limit_num, affected_rows, cost_time,
+                   priv_check, hit_rule, masking):
+    query_log = QueryLog()
+    query_log.username = user.username
+    query_log.user_display = user.display
+    query_log.db_name = db_name
+    query_log.instance_name = instance_name
+    query_log.sqllog = sql_content
+    if int(limit_num) == 0:
+        limit_num = int(affected_rows)
+    else:
+        limit_num = min(int(limit_num), int(affected_rows))
+    query_log.effect_row = limit_num
+    query_log.cost_time = cost_time
+    query_log.priv_check = priv_check
+    query_log.hit_rule = hit_rule
+    query_log.masking = masking
+    # 放入队列由后台线程批量写入
+    query_log_writer.write(query_log)
+
+
+# 流式返回查询结果, 逐批读取、脱敏并输出, 结果集不在内存中完整保存
+def query_stream_response(user, query_engine, instance_name, db_name, sql_content, limit_num, priv_check):
+    result = {'status': 0, 'msg': 'ok', 'data': {}}
+    t_start = time.time()
+    query_result = query_engine.query(db_name=str(db_name), sql=sql_content, limit_num=limit_num, stream=True)
+    t_end = time.time()
+    query_result.query_time = "%5s" % "{:.4f}".format(t_end - t_start)
+    if query_result.error:
+        result['data'] = query_result.__dict__
+        return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+                            content_type='application/json')
+
+    rows = query_result.rows
+    batch_size = query_engine.stream_batch_size
+    hit_rule = 0 if re.match(r"^select", sql_content.lower()) else 2  # 查询是否命中脱敏规则，0, '未知', 1, '命中', 2, '未命中'
+    masking = 2  # 查询结果是否正常脱敏，1, '是', 2, '否'
+    need_masking = SysConfig().get('data_masking') and re.match(r"^select", sql_content.lower())
+    mask_cost = 0.0
+    # 后续各批数据的脱敏函数, 由第一批脱敏时生成, 与第一批是否命中无关
+    mask_rows = None
+
+    def close_rows():
+        if hasattr(rows, 'close'):
+            rows.close()
+
+    # 先读取并脱敏第一批数据, 脱敏校验不通过时直接返回错误
+    first_batch = list(itertools.islice(rows, batch_size))
+    if need_masking:
+        t_start = time.time()
+        try:
+            batch_result = ResultSet(full_sql=sql_content, rows=first_batch, column_list=query_result.column_list)
+            masked_result, mask_rows = query_engine.query_masking_plan(db_name=db_name, sql=sql_content,
+                                                                       resultset=batch_result)
+            if SysConfig().get('query_check') and masked_result.is_critical is True:
+                close_rows()
+                masking_result = {'status': masked_result.status,
+                                  'msg': masked_result.error,
+                                  'data': masked_result.__dict__}
+                return HttpResponse(json.dumps(masking_result), content_type='application/json')
+            if masked_result.is_masked:
+                masking = 1
+                hit_rule = 1
+            first_batch = masked_result.rows
+        except Exception:
+            logger.error(traceback.format_exc())
+            hit_rule = 2
+            masking = 2
+            if SysConfig().get('query_check'):
+                close_rows()
+                result['status'] = 1
+                result['msg'] = '脱敏数据报错,请联系管理员'
+                return HttpResponse(json.dumps(result), content_type='application/json')
+        mask_cost += time.time() - t_start
+
+    def dumps(obj):
+        try:
+            return json.dumps(obj, cls=ExtendJSONEncoder, bigint_as_string=True)
+        except Exception:
+            return json.dumps(obj, default=str, bigint_as_string=True, encoding='latin1')
+
+    def stream():
+        nonlocal mask_cost
+        affected_rows = 0
+        batch = first_batch
+        try:
+            yield '{"data": {"rows": ['
+            while batch:
+                if affected_rows > 0:
+                    yield ', '
+                yield ', '.join(dumps(row) for row in batch)
+                affected_rows += len(batch)
+                batch = list(itertools.islice(rows, batch_size))
+                if batch and mask_rows:
+                    t_start = time.time()
+                    batch = mask_rows(batch)
+                    mask_cost += time.time() - t_start
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            result['status'] = 1
+            result['msg'] = str(e)
+            query_result.error = str(e)
+        finally:
+            close_rows()
+        query_result.affected_rows = affected_rows
+        query_result.is_masked = masking == 1
+        query_result.mask_time = "%5s" % "{:.4f}".format(mask_cost)
+        data = query_result.__dict__.copy()
+        data.pop('rows')
+        yield '], ' + dumps(data)[1:]
+        yield ', "status": {}, "msg": {}}}'.format(dumps(result['status']), dumps(result['msg']))
+        if query_result.error is None:
+            save_query_log(user, instance_name, db_name, sql_content, limit_num, affected_rows,
+                           query_result.query_time, priv_check, hit_rule, masking)
+
+    return QueryStreamingResponse(stream(), rows=rows, content_type='application/json')
+
+
+class QueryStreamingResponse(StreamingHttpResponse):
+    """流式查询的响应, close()时关闭查询游标并释放连接,
+    客户端中断或响应未被完整遍历时不依赖生成器的finally"""
+
+    def __init__(self, *args, rows=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rows = rows
+
+    def close(self):
+        try:
+            if hasattr(self.rows, 'close'):
+                self.rows.close()
+        finally:
+            super().close()
+
+
 # 获取sql查询记录
 @permission_required('sql.menu_sqlquery', raise_exception=True)
 def querylog(request):
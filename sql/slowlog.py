@@ -2,10 +2,12 @@
 import simplejson as json
 import datetime
 from django.contrib.auth.decorators import permission_required
-from django.db.models import F, Sum, Value as V, Max
+from django.db.models import F, Q, Sum, Value as V, Max
 from django.db.models.functions import Concat
 from django.http import HttpResponse
 from sql.utils.resource_group import user_instances
+from sql.utils.slowquery_rollup import rollup_covered_until, rollup_review
+from sql.utils.slowquery_analytics import fingerprint_trend, detect_regression
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from .models import Instance, SlowQuery, SlowQueryHistory, AliyunRdsConfig
 
@@ -43,42 +45,51 @@ def slowquery_review(request):
 
         # 时间处理
         end_time = datetime.datetime.strptime(end_time, '%Y-%m-%d') + datetime.timedelta(days=1)
-        # DBName非必传
-        if db_name:
-            # 获取慢查数据
-            slowsql_obj = SlowQuery.objects.filter(
-                slowqueryhistory__hostname_max=(instance_info.host + ':' + str(instance_info.port)),
-                slowqueryhistory__db_max=db_name,
-                slowqueryhistory__ts_min__range=(start_time, end_time)
-            ).annotate(SQLText=F('fingerprint'), SQLId=F('checksum')).values('SQLText', 'SQLId').annotate(
-                CreateTime=Max('slowqueryhistory__ts_max'),
-                DBName=Max('slowqueryhistory__db_max'),  # 数据库
-                QueryTimeAvg=Sum('slowqueryhistory__query_time_sum') / Sum('slowqueryhistory__ts_cnt'),  # 平均执行时长
-                MySQLTotalExecutionCounts=Sum('slowqueryhistory__ts_cnt'),  # 执行总次数
-                MySQLTotalExecutionTimes=Sum('slowqueryhistory__query_time_sum'),  # 执行总时长
-                ParseTotalRowCounts=Sum('slowqueryhistory__rows_examined_sum'),  # 扫描总行数
-                ReturnTotalRowCounts=Sum('slowqueryhistory__rows_sent_sum'),  # 返回总行数
-            )
+        hostname = instance_info.host + ':' + str(instance_info.port)
+        # 超过一天的时间范围, 已完整汇总的小时读取按小时预聚合的汇总表, 其余读取明细表
+        covered_until = None
+        if end_time - datetime.datetime.strptime(start_time, '%Y-%m-%d') > datetime.timedelta(days=1):
+            covered_until = rollup_covered_until(
+                hostname, datetime.datetime.strptime(start_time, '%Y-%m-%d'), end_time)
+        if covered_until:
+            result = rollup_review(hostname, db_name, start_time, covered_until, end_time, offset, limit)
         else:
-            # 获取慢查数据
-            slowsql_obj = SlowQuery.objects.filter(
-                slowqueryhistory__hostname_max=(instance_info.host + ':' + str(instance_info.port)),
-                slowqueryhistory__ts_min__range=(start_time, end_time),
-            ).annotate(SQLText=F('fingerprint'), SQLId=F('checksum')).values('SQLText', 'SQLId').annotate(
-                CreateTime=Max('slowqueryhistory__ts_max'),
-                DBName=Max('slowqueryhistory__db_max'),  # 数据库
-                QueryTimeAvg=Sum('slowqueryhistory__query_time_sum') / Sum('slowqueryhistory__ts_cnt'),  # 平均执行时长
-                MySQLTotalExecutionCounts=Sum('slowqueryhistory__ts_cnt'),  # 执行总次数
-                MySQLTotalExecutionTimes=Sum('slowqueryhistory__query_time_sum'),  # 执行总时长
-                ParseTotalRowCounts=Sum('slowqueryhistory__rows_examined_sum'),  # 扫描总行数
-                ReturnTotalRowCounts=Sum('slowqueryhistory__rows_sent_sum'),  # 返回总行数
-            )
-        slow_sql_count = slowsql_obj.count()
-        slow_sql_list = slowsql_obj.order_by('-MySQLTotalExecutionCounts')[offset:limit]  # 执行总次数倒序排列
-
-        # QuerySet 序列化
-        sql_slow_log = [SlowLog for SlowLog in slow_sql_list]
-        result = {"total": slow_sql_count, "rows": sql_slow_log}
+            # DBName非必传
+            if db_name:
+                # 获取慢查数据
+                slowsql_obj = SlowQuery.objects.filter(
+                    slowqueryhistory__hostname_max=hostname,
+                    slowqueryhistory__db_max=db_name,
+                    slowqueryhistory__ts_min__range=(start_time, end_time)
+                ).annotate(SQLText=F('fingerprint'), SQLId=F('checksum')).values('SQLText', 'SQLId').annotate(
+                    CreateTime=Max('slowqueryhistory__ts_max'),
+                    DBName=Max('slowqueryhistory__db_max'),  # 数据库
+                    QueryTimeAvg=Sum('slowqueryhistory__query_time_sum') / Sum('slowqueryhistory__ts_cnt'),  # 平均执行时长
+                    MySQLTotalExecutionCounts=Sum('slowqueryhistory__ts_cnt'),  # 执行总次数
+                    MySQLTotalExecutionTimes=Sum('slowqueryhistory__query_time_sum'),  # 执行总时长
+                    ParseTotalRowCounts=Sum('slowqueryhistory__rows_examined_sum'),  # 扫描总行数
+                    ReturnTotalRowCounts=Sum('slowqueryhistory__rows_sent_sum'),  # 返回总行数
+                )
+            else:
+                # 获取慢查数据
+                slowsql_obj = SlowQuery.objects.filter(
+                    slowqueryhistory__hostname_max=hostname,
+                    slowqueryhistory__ts_min__range=(start_time, end_time),
+                ).annotate(SQLText=F('fingerprint'), SQLId=F('checksum')).values('SQLText', 'SQLId').annotate(
+                    CreateTime=Max('slowqueryhistory__ts_max'),
+                    DBName=Max('slowqueryhistory__db_max'),  # 数据库
+                    QueryTimeAvg=Sum('slowqueryhistory__query_time_sum') / Sum('slowqueryhistory__ts_cnt'),  # 平均执行时长
+                    MySQLTotalExecutionCounts=Sum('slowqueryhistory__ts_cnt'),  # 执行总次数
+                    MySQLTotalExecutionTimes=Sum('slowqueryhistory__query_time_sum'),  # 执行总时长
+                    ParseTotalRowCounts=Sum('slowqueryhistory__rows_examined_sum'),  # 扫描总行数
+                    ReturnTotalRowCounts=Sum('slowqueryhistory__rows_sent_sum'),  # 返回总行数
+                )
+            slow_sql_count = slowsql_obj.count()
+            slow_sql_list = slowsql_obj.order_by('-MySQLTotalExecutionCounts')[offset:limit]  # 执行总次数倒序排列
+
+            # QuerySet 序列化
+            sql_slow_log = [SlowLog for SlowLog in slow_sql_list]
+            result = {"total": slow_sql_count, "rows": sql_slow_log}
 
     # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
@@ -167,18 +178,85 @@ def slowquery_review_history(request):
                            ReturnRowCounts=F('rows_sent_sum')  # 本次统计该sql语句返回总行数
                            )
 
-        slow_sql_record_count = slow_sql_record_obj.count()
-        slow_sql_record_list = slow_sql_record_obj[offset:limit].values('ExecutionStartTime', 'DBName', 'HostAddress',
-                                                                        'SQLText',
-                                                                        'TotalExecutionCounts', 'QueryTimePct95',
-                                                                        'QueryTimes', 'LockTimes', 'ParseRowCounts',
-                                                                        'ReturnRowCounts'
-                                                                        )
+        # 按(ts_min, id)排序, 传入上一页最后一行的cursor时使用键集分页, 不再扫描offset之前的记录
+        slow_sql_record_obj = slow_sql_record_obj.order_by('ts_min', 'id')
+        remaining_obj = slow_sql_record_obj
+        cursor = parse_cursor(request.POST.get('cursor'))
+        if cursor:
+            remaining_obj = slow_sql_record_obj.filter(Q(ts_min__gt=cursor[0]) | Q(ts_min=cursor[0], id__gt=cursor[1]))
+            page_obj = remaining_obj[:limit - offset]
+        else:
+            page_obj = slow_sql_record_obj[offset:limit]
+        slow_sql_record_list = list(page_obj.values('id', 'ts_min', 'ExecutionStartTime', 'DBName', 'HostAddress',
+                                                    'SQLText', 'TotalExecutionCounts', 'QueryTimePct95',
+                                                    'QueryTimes', 'LockTimes', 'ParseRowCounts', 'ReturnRowCounts'))
+        # 近似总数只统计当前位置之后最多10页, 翻页时逐步增加
+        if request.POST.get('count') == 'approx':
+            start = 0 if cursor else offset
+            slow_sql_record_count = offset + remaining_obj[start:start + (limit - offset) * 10 + 1].count()
+        else:
+            slow_sql_record_count = slow_sql_record_obj.count()
+        next_cursor = None
+        if slow_sql_record_list:
+            last = slow_sql_record_list[-1]
+            next_cursor = '{}|{}'.format(last['ts_min'].strftime('%Y-%m-%d %H:%M:%S.%f'), last['id'])
+        for row in slow_sql_record_list:
+            row.pop('ts_min')
 
-        # QuerySet 序列化
-        sql_slow_record = [SlowRecord for SlowRecord in slow_sql_record_list]
-        result = {"total": slow_sql_record_count, "rows": sql_slow_record}
+        result = {"total": slow_sql_record_count, "rows": slow_sql_record_list, "next_cursor": next_cursor}
 
         # 返回查询结果
     return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
                         content_type='application/json')
+
+
+# 慢日志分析: 单个SQL的耗时趋势(trend)和按周对比的性能退化检测(regression)
+@permission_required('sql.menu_slowquery', raise_exception=True)
+def slowquery_analytics(request):
+    instance_name = request.POST.get('instance_name')
+    # 服务端权限校验
+    try:
+        instance_info = user_instances(request.user, 'all').get(instance_name=instance_name)
+    except Exception:
+        result = {'status': 1, 'msg': '你所在组未关联该实例', 'data': []}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    hostname = instance_info.host + ':' + str(instance_info.port)
+    analytics_type = request.POST.get('type', 'trend')
+    result = {'status': 0, 'msg': 'ok', 'data': []}
+    try:
+        if analytics_type == 'trend':
+            start_time = datetime.datetime.strptime(request.POST.get('StartTime'), '%Y-%m-%d')
+            end_time = datetime.datetime.strptime(request.POST.get('EndTime'), '%Y-%m-%d') + datetime.timedelta(days=1)
+            granularity = request.POST.get('granularity') or (
+                'day' if end_time - start_time > datetime.timedelta(days=7) else 'hour')
+            if granularity not in ('hour', 'day'):
+                result = {'status': 1, 'msg': '不支持的统计粒度: {}'.format(granularity), 'data': []}
+            else:
+                result['data'] = fingerprint_trend(hostname, request.POST.get('SQLId'), start_time, end_time,
+                                                   granularity=granularity)
+        elif analytics_type == 'regression':
+            end_time = request.POST.get('EndTime')
+            end_time = datetime.datetime.strptime(end_time, '%Y-%m-%d') + datetime.timedelta(
+                days=1) if end_time else datetime.datetime.now()
+            result['data'] = detect_regression(hostname, end_time,
+                                               days=int(request.POST.get('days', 7)),
+                                               threshold=float(request.POST.get('threshold', 1.5)),
+                                               min_count=int(request.POST.get('min_count', 10)),
+                                               db_name=request.POST.get('db_name'))
+        else:
+            result = {'status': 1, 'msg': '不支持的分析类型', 'data': []}
+    except (TypeError, ValueError) as e:
+        result = {'status': 1, 'msg': '参数错误: {}'.format(e), 'data': []}
+
+    return HttpResponse(json.dumps(result, cls=ExtendJSONEncoder, bigint_as_string=True),
+                        content_type='application/json')
+
+
+def parse_cursor(cursor):
+    """解析键集分页的cursor: ts_min|id, 格式不正确时返回None, 使用offset分页"""
+    try:
+        ts_min, history_id = cursor.split('|')
+        return datetime.datetime.strptime(ts_min, '%Y-%m-%d %H:%M:%S.%f'), int(history_id)
+    except (AttributeError, ValueError):
+        return None
@@ -20,6 +20,7 @@ from common.utils.const import Const, WorkflowDict
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.notify import notify_for_audit
 from sql.models import ResourceGroup, Users
+from sql.utils.execute_result import get_executed_count
 from sql.utils.resource_group import user_groups, user_instances
 from sql.utils.jobs import add_sqlcronjob, del_sqlcronjob
 from sql.utils.sql_review import can_timingtask, can_cancel, can_execute
@@ -484,5 +485,34 @@ def get_workflow_status(request):
 
     workflow_id = int(workflow_id)
     workflow_detail = get_object_or_404(SqlWorkflow, pk=workflow_id)
-    result = {"status": workflow_detail.status, "msg": "", "data": ""}
+    # data为已执行完成的语句数
+    result = {"status": workflow_detail.status, "msg": "", "data": get_executed_count(workflow_id)}
     return JsonResponse(result)
+
+
+def rollback_list(request):
+    """
+    分批获取工单的回滚语句, 回滚页面按offset逐批加载并根据total展示进度
+    """
+    workflow_id = request.POST.get('workflow_id')
+    if workflow_id == '' or workflow_id is None:
+        result = {'status': 1, 'msg': 'workflow_id参数为空.', 'data': []}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    offset = int(request.POST.get('offset', 0))
+    limit = int(request.POST.get('limit', 500))
+    workflow = get_object_or_404(SqlWorkflow, pk=int(workflow_id))
+    try:
+        query_engine = get_engine(workflow=workflow)
+        rollback_page = query_engine.get_rollback_page(offset, limit)
+    except Exception as msg:
+        logger.error(traceback.format_exc())
+        result = {'status': 1, 'msg': str(msg), 'data': []}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    if rollback_page is None:
+        result = {'status': 1, 'msg': '该实例不支持获取回滚语句', 'data': []}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    rows, total = rollback_page
+    # next_offset为None时表示已加载完成
+    next_offset = offset + limit if offset + limit < total else None
+    result = {'status': 0, 'msg': 'ok', 'data': {'rows': rows, 'total': total, 'next_offset': next_offset}}
+    return HttpResponse(json.dumps(result), content_type='application/json')
@@ -1,20 +1,42 @@
+import importlib.util
+import io
 import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
 from datetime import timedelta, datetime
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.contrib.auth.models import Permission
+import pymysql
+from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
 
-from django.test import Client, TestCase
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
 
 from common.config import SysConfig
-from sql.engines.models import ResultSet
+from sql.engines.models import ResultSet, ReviewResult, StreamRows
 from sql.engines.mysql import MysqlEngine
 from sql import query
+from sql.utils.data_masking import Masking, query_tree_cache, masking_index, brute_mask, compile_brute_mask_plan
+from sql.utils.query_log import QueryLogWriter
+from sql.utils.query_privileges import UserPrivileges
+from sql.utils.execute_result import append_execute_result, get_execute_result
+from sql.utils.binlog2sql.binlog2sql import Binlog2sql
+from sql.utils.binlog2sql.binlog2sql_util import RowsBatcher, reversed_lines, concat_sql_from_rows_event, \
+    compare_items, fix_object, sql_template
+from sql.utils.binlog2sql_job import compress_file, read_binlog2sql_rows
+from sql.utils.slowquery_analytics import IntervalStats, weighted_percentile, detect_regression
+from sql.utils.slowquery_rollup import rollup_slow_query, rollup_covered_until, rollup_bucket
 
-from sql.models import Instance, QueryPrivilegesApply, QueryPrivileges, SqlWorkflow, QueryLog
+from sql.models import Instance, QueryPrivilegesApply, QueryPrivileges, SqlWorkflow, QueryLog, Binlog2sqlJob, \
+    DataMaskingRules, DataMaskingColumns, SlowQuery, SlowQueryHistory, SlowQueryRollup
 
 User = get_user_model()
 
@@ -104,6 +126,7 @@ class UserTest(TestCase):
         self.assertRedirects(r, '/')
 
 
+@override_settings(QUERY_LOG_WRITER={'async': False})
 class QueryTest(TestCase):
     def setUp(self):
         self.slave1 = Instance(instance_name='test_slave_instance', type='slave', db_type='mysql',
@@ -251,6 +274,54 @@ class QueryTest(TestCase):
                                 'limit_num': some_limit})
         _query.assert_called_once_with(db_name=some_db, sql=filtered_sql_with_star, limit_num=some_limit)
 
+    @patch('sql.utils.data_masking.InceptionEngine')
+    @patch('sql.engines.mysql.MysqlEngine.query')
+    def testStreamQueryMaskEveryBatch(self, _query, _inception):
+        """流式查询脱敏计划只生成一次, 第一批未脱敏任何数据时后续批次也按计划脱敏"""
+        SysConfig().set('data_masking', True)
+        DataMaskingRules.objects.create(rule_type=1, rule_regex=r'^(\d{3})(\d{4})(\d{4})$', hide_group=2)
+        DataMaskingColumns.objects.create(rule_type=1, active=1, instance_name=self.slave1.instance_name,
+                                          table_schema='some_db', table_name='some_table', column_name='phone')
+        masking_index.refresh()
+        query_tree_cache.clear()
+        query_tree = '{"select_list":[{"type":"FIELD_ITEM","db":"some_db","table":"some_table","field":"phone"}],' \
+                     '"table_ref":[{"db":"some_db","table":"some_table"}]}'
+        _inception.return_value.query_print.return_value.rows = [
+            (1, 'select phone from some_table', 0, query_tree, 'None')]
+        cursor = MagicMock()
+        rows = StreamRows(iter([(None,), ('13800001111',), ('13900002222',)]), cursor)
+        _query.return_value = ResultSet(full_sql='select phone from some_table', rows=rows, column_list=['phone'])
+        engine = MysqlEngine(instance=self.slave1)
+        engine.stream_batch_size = 1
+        response = query.query_stream_response(self.u2, engine, self.slave1.instance_name, 'some_db',
+                                               'select phone from some_table', 100, 1)
+        r_json = json.loads(b''.join(response.streaming_content).decode())
+        response.close()
+        self.assertEqual(r_json['data']['rows'], [[None], ['138****1111'], ['139****2222']])
+        self.assertTrue(r_json['data']['is_masked'])
+        _inception.return_value.query_print.assert_called_once()
+        cursor.close.assert_called_once()
+        SysConfig().set('data_masking', False)
+        query_tree_cache.clear()
+        masking_index.invalidate()
+
+    @patch('sql.engines.mysql.MysqlEngine.query')
+    def testStreamQueryResponseClose(self, _query):
+        """流式响应未遍历就关闭时, 通过close()关闭游标并释放连接"""
+        cursor = MagicMock()
+        on_close = MagicMock()
+        rows = StreamRows(iter([('v1',), ('v2',)]), cursor, on_close=on_close)
+        _query.return_value = ResultSet(full_sql='select some from some_table', rows=rows, column_list=['some'])
+        engine = MysqlEngine(instance=self.slave1)
+        engine.stream_batch_size = 1
+        response = query.query_stream_response(self.u2, engine, self.slave1.instance_name, 'some_db',
+                                               'select some from some_table', 100, 1)
+        cursor.close.assert_not_called()
+        response.close()
+        cursor.close.assert_called_once()
+        on_close.assert_called_once()
+        self.assertEqual(QueryLog.objects.count(), 0)
+
     @patch('sql.query.query_priv_check')
     def testStarOptionOn(self, _priv_check):
         c = Client()
@@ -269,6 +340,73 @@ class QueryTest(TestCase):
         r_json = r.json()
         self.assertEqual(1, r_json['status'])
 
+    def testQueryLogWriter(self):
+        """查询日志在flush时批量写入, 队列满时同步写入"""
+        writer = QueryLogWriter()
+        writer._queue = queue.Queue(maxsize=2)
+        writer._pid = os.getpid()
+        with override_settings(QUERY_LOG_WRITER={'async': True, 'put_timeout': 0}), \
+                patch.object(writer, '_start'):
+            for i in range(3):
+                writer.write(QueryLog(username=self.u1.username, sqllog='select {}'.format(i), effect_row=1))
+            self.assertEqual(QueryLog.objects.count(), 1)
+            writer.flush()
+        self.assertEqual(QueryLog.objects.count(), 3)
+
+
+class QueryPrivilegesCacheTest(TransactionTestCase):
+    """权限快照在事务提交后失效, 需要真实提交事务"""
+
+    def setUp(self):
+        self.superuser = User.objects.create(username='super1', is_superuser=True)
+        self.user = User.objects.create(username='some_user', display='中文显示', is_active=True)
+        Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                host='testhost', port=3306, user='mysql_user', password='mysql_password')
+        self.query_apply = QueryPrivilegesApply.objects.create(
+            group_id=1, group_name='some_group', title='some_title', user_name='some_user',
+            instance_name='some_ins', db_list='some_db', table_list='some_table,some_tb2', limit_num=100,
+            valid_date=datetime.now() + timedelta(days=1), priv_type=2, status=0,
+            audit_auth_groups='some_audit_group')
+
+    def tearDown(self):
+        UserPrivileges.invalidate('some_user')
+
+    def testQueryPrivCheckCache(self):
+        """权限快照在审核通过新增权限后失效并重新加载"""
+        sql_content = 'show create table some_table'
+        r = query.query_priv_check(self.user, 'some_ins', 'some_db', sql_content, 0)
+        self.assertEqual(r['status'], 1)
+        query.query_audit_call_back(self.query_apply.apply_id, 1)
+        r = query.query_priv_check(self.user, 'some_ins', 'some_db', sql_content, 0)
+        self.assertEqual(r['status'], 0)
+        self.assertEqual(r['data']['limit_num'], 100)
+
+    def testInvalidateAfterCommit(self):
+        """事务提交前不失效权限快照, 提交后才失效"""
+        cache_key = UserPrivileges.cache_key('some_user')
+        UserPrivileges.load('some_user')
+        with transaction.atomic():
+            query.query_audit_call_back(self.query_apply.apply_id, 1)
+            self.assertEqual(cache.get(cache_key), [])
+        self.assertIsNone(cache.get(cache_key))
+        # 修改权限同样在提交后失效
+        UserPrivileges.load('some_user')
+        privilege = QueryPrivileges.objects.filter(user_name='some_user').first()
+        self.client.force_login(self.superuser)
+        with transaction.atomic():
+            r = self.client.post('/query/modifyprivileges/', data={
+                'privilege_id': privilege.privilege_id, 'type': 2,
+                'valid_date': privilege.valid_date, 'limit_num': 10})
+            self.assertEqual(r.json()['status'], 0)
+            self.assertEqual(len(cache.get(cache_key)), 2)
+        self.assertIsNone(cache.get(cache_key))
+        self.assertEqual(UserPrivileges.load('some_user').min_limit('some_ins', ['some_db']), 10)
+        # 回滚的事务不失效权限快照
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            query.query_audit_call_back(self.query_apply.apply_id, 1)
+            raise RuntimeError
+        self.assertEqual(len(cache.get(cache_key)), 2)
+
 
 class WorkflowViewTest(TestCase):
 
@@ -325,6 +463,29 @@ class WorkflowViewTest(TestCase):
         self.wf1.delete()
         self.wf2.delete()
 
+    @patch('sql.engines.mysql.MysqlEngine.get_rollback_page')
+    def testRollbackList(self, _get_rollback_page):
+        """回滚语句按offset分批返回, 最后一批next_offset为None"""
+        Instance.objects.create(instance_name='some_instance', type='master', db_type='mysql',
+                                host='some_host', port=3306, user='ins_user', password='some_pass')
+        c = Client()
+        c.force_login(self.superuser1)
+        _get_rollback_page.return_value = ([['update t1 set c=1', 'update t1 set c=0;']], 3)
+        r = c.post('/rollback/list/', {'workflow_id': self.wf1.id, 'offset': 0, 'limit': 2}).json()
+        self.assertEqual(r['status'], 0)
+        self.assertEqual(r['data'], {'rows': [['update t1 set c=1', 'update t1 set c=0;']],
+                                     'total': 3, 'next_offset': 2})
+        _get_rollback_page.assert_called_once_with(0, 2)
+        r = c.post('/rollback/list/', {'workflow_id': self.wf1.id, 'offset': 2, 'limit': 2}).json()
+        self.assertIsNone(r['data']['next_offset'])
+        _get_rollback_page.side_effect = Exception('some_error')
+        r = c.post('/rollback/list/', {'workflow_id': self.wf1.id, 'offset': 0, 'limit': 2}).json()
+        self.assertEqual(r, {'status': 1, 'msg': 'some_error', 'data': []})
+        # 回滚页面本身不再读取回滚语句
+        r = c.get('/rollback/', {'workflow_id': self.wf1.id})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(_get_rollback_page.call_count, 3)
+
     def testWorkflowStatus(self):
         c = Client(header={})
         c.force_login(self.u1)
@@ -332,6 +493,18 @@ class WorkflowViewTest(TestCase):
         r_json = r.json()
         self.assertEqual(r_json['status'], 'workflow_finish')
 
+    def testExecuteResultIncremental(self):
+        """执行结果按段追加写入, 读取时按split段和段内顺序拼接"""
+        self.assertEqual(json.loads(get_execute_result(self.wf1)), [{'id': 1, 'sql': 'some_content'}])
+        append_execute_result(self.wf1.id, 1, [ReviewResult(id=3, sql='sql_3')])
+        append_execute_result(self.wf1.id, 0, [ReviewResult(id=1, sql='sql_1'), ReviewResult(id=2, sql='sql_2')])
+        rows = json.loads(get_execute_result(self.wf1))
+        self.assertEqual([row['sql'] for row in rows], ['sql_1', 'sql_2', 'sql_3'])
+        c = Client()
+        c.force_login(self.u1)
+        r = c.post('/getWorkflowStatus/', {'workflow_id': self.wf1.id})
+        self.assertEqual(r.json()['data'], 3)
+
     @patch('sql.utils.workflow_audit.Audit.review_info')
     @patch('sql.utils.workflow_audit.Audit.can_review')
     def testWorkflowDetailView(self, _can_review, _review_info):
@@ -538,3 +711,775 @@ class TestSchemaSync(TestCase):
         self.sys_config.get_all_config()
         r = self.client.post(path='/instance/schemasync/', data=data)
         self.assertEqual(json.loads(r.content)['status'], 0)
+
+
+class TestDataMasking(TestCase):
+    """
+    测试数据脱敏
+    """
+
+    def setUp(self):
+        self.ins = Instance(instance_name='some_ins', type='slave', db_type='mysql', host='some_host',
+                            port=3306, user='ins_user', password='some_pass')
+        self.ins.save()
+        query_tree_cache.clear()
+        masking_index.invalidate()
+
+    def tearDown(self):
+        self.ins.delete()
+        query_tree_cache.clear()
+        # 测试数据随事务回滚, 不会触发脱敏索引失效
+        masking_index.invalidate()
+
+    @patch('sql.utils.data_masking.InceptionEngine')
+    def test_query_tree_cache(self, _inception):
+        """权限校验和脱敏共用语法树缓存, 同一语句只请求一次inception"""
+        query_tree = '{"select_list":[{"type":"FIELD_ITEM","db":"some_db","table":"some_table","field":"phone"}],' \
+                     '"table_ref":[{"db":"some_db","table":"some_table"}]}'
+        _inception.return_value.query_print.return_value.rows = [
+            (1, 'select phone from some_table', 0, query_tree, 'None')]
+        table_ref = Masking().query_table_ref('select phone from  some_table;', 'some_ins', 'some_db')
+        self.assertEqual(table_ref['data'], [{'db': 'some_db', 'table': 'some_table'}])
+        Masking().data_masking('some_ins', 'some_db', 'select phone from some_table limit 100;',
+                               {'column_list': ['phone'], 'rows': []})
+        _inception.return_value.query_print.assert_called_once()
+
+    @patch('sql.utils.data_masking.InceptionEngine')
+    def test_data_masking_hit_column(self, _inception):
+        """命中脱敏字段的列整体脱敏, 其他列不变"""
+        DataMaskingRules.objects.create(rule_type=1, rule_regex=r'^(\d{3})(\d{4})(\d{4})$', hide_group=2)
+        DataMaskingColumns.objects.create(rule_type=1, active=1, instance_name='some_ins', table_schema='some_db',
+                                          table_name='some_table', column_name='phone')
+        query_tree = '{"select_list":[{"type":"FIELD_ITEM","db":"some_db","table":"some_table","field":"name"},' \
+                     '{"type":"FIELD_ITEM","db":"some_db","table":"some_table","field":"phone"}],' \
+                     '"table_ref":[{"db":"some_db","table":"some_table"}]}'
+        _inception.return_value.query_print.return_value.rows = [
+            (1, 'select name,phone from some_table', 0, query_tree, 'None')]
+        sql_result = {'column_list': ['name', 'phone'], 'rows': (('a', '13800001111'), ('b', None))}
+        result = Masking().data_masking('some_ins', 'some_db', 'select name,phone from some_table;', sql_result)
+        self.assertEqual(result['data']['hit_rule'], 1)
+        self.assertEqual(sql_result['rows'], [['a', '138****1111'], ['b', None]])
+
+    @patch('sql.utils.data_masking.InceptionEngine')
+    def test_data_masking_missing_rule(self, _inception):
+        """命中脱敏字段但脱敏规则不存在时返回脱敏失败, 不直接放行原始数据"""
+        DataMaskingColumns.objects.create(rule_type=1, active=1, instance_name='some_ins', table_schema='some_db',
+                                          table_name='some_table', column_name='phone')
+        query_tree = '{"select_list":[{"type":"FIELD_ITEM","db":"some_db","table":"some_table","field":"phone"}],' \
+                     '"table_ref":[{"db":"some_db","table":"some_table"}]}'
+        _inception.return_value.query_print.return_value.rows = [
+            (1, 'select phone from some_table', 0, query_tree, 'None')]
+        sql_result = {'column_list': ['phone'], 'rows': (('13800001111',),)}
+        result = Masking().data_masking('some_ins', 'some_db', 'select phone from some_table;', sql_result)
+        self.assertEqual(result['status'], 1)
+        self.assertIn('phone', result['msg'])
+        self.assertEqual(result['data']['hit_rule'], 1)
+
+    def test_masking_index_invalidate(self):
+        """脱敏字段变更后索引重新加载"""
+        masking_index.refresh()
+        self.assertEqual(masking_index.table_columns('some_ins', 'some_db', 'some_table'), {})
+        column = DataMaskingColumns.objects.create(rule_type=1, active=1, instance_name='some_ins',
+                                                   table_schema='some_db', table_name='some_table',
+                                                   column_name='phone')
+        masking_index.refresh()
+        self.assertEqual(masking_index.table_columns('some_ins', 'some_db', 'some_table'), {'phone': 1})
+        column.delete()
+        masking_index.refresh()
+        self.assertEqual(masking_index.table_columns('some_ins', 'some_db', 'some_table'), {})
+
+    def test_brute_mask_bulk(self):
+        """暴力脱敏单次遍历10万单元格, 命中的单元格脱敏, 其他单元格保持原值和原类型"""
+        DataMaskingRules.objects.create(rule_type=1, rule_regex=r'(1[3-9]\d)(\d{4})(\d{4})', hide_group=2)
+        DataMaskingRules.objects.create(rule_type=4, rule_regex=r'([^@\s]{1,3})([^@\s]*)(@\S+)', hide_group=2)
+        rows = [(i, '138%08d' % i, 'user%d@example.com' % i, None, datetime(2019, 1, 1),
+                 'some text', 1.5, 'other', i * 2, 'value') for i in range(10000)]
+        sql_result = ResultSet(rows=rows)
+        brute_mask(sql_result)
+        self.assertEqual(len(sql_result.rows), 10000)
+        self.assertEqual(sql_result.rows[1], (1, '138****0001', 'use****@example.com', None, datetime(2019, 1, 1),
+                                              'some text', 1.5, 'other', 2, 'value'))
+
+    def test_brute_mask_backreference(self):
+        """含分组和反向引用的规则不加入合并正则, 合并后分组序号偏移不影响命中判断"""
+        DataMaskingRules.objects.create(rule_type=1, rule_regex=r'(1[3-9]\d)(\d{4})(\d{4})', hide_group=2)
+        DataMaskingRules.objects.create(rule_type=2, rule_regex=r'^(?:id-)?([a-z])\1([a-z]+)$', hide_group=2)
+        masking_index.refresh()
+        prefilter, plan = compile_brute_mask_plan(masking_index.rules())
+        self.assertIsNone(prefilter)
+        self.assertEqual(len(plan), 2)
+        sql_result = ResultSet(rows=[('aabc', '13800001111', 'ab')])
+        brute_mask(sql_result)
+        self.assertEqual(sql_result.rows, [('a****', '138****1111', 'ab')])
+        # 只含分组时仍使用合并正则
+        DataMaskingRules.objects.filter(rule_type=2).update(rule_regex=r'^(?:id-)?([a-z])([a-z])([a-z]+)$')
+        masking_index.invalidate()
+        masking_index.refresh()
+        prefilter, _ = compile_brute_mask_plan(masking_index.rules())
+        self.assertIsNotNone(prefilter)
+
+
+class TestBinlog2sqlJob(TestCase):
+    def setUp(self):
+        self.superuser = User.objects.create(username='super1', is_superuser=True)
+        self.output = tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False)
+        self.output.write(''.join("INSERT INTO `db`.`t`(`id`) VALUES ({0}); #start 4 end 100 time 2018-01-01\n".format(i)
+                                  for i in range(10)))
+        self.output.close()
+        self.job = Binlog2sqlJob.objects.create(instance_name='some_instance', user_name='super1', params='{}',
+                                                filename=self.output.name, status='running', rows=10)
+
+    def tearDown(self):
+        os.remove(self.output.name)
+
+    def testJobRows(self):
+        """分页读取解析结果"""
+        c = Client()
+        c.force_login(self.superuser)
+        r = c.post('/binlog2sql/job/rows/', {'job_id': self.job.id, 'offset': 8, 'limit': 5}).json()
+        self.assertEqual(r['total'], 10)
+        self.assertEqual([row['sql'] for row in r['rows']],
+                         ["INSERT INTO `db`.`t`(`id`) VALUES (8);", "INSERT INTO `db`.`t`(`id`) VALUES (9);"])
+
+    def testCompressedJobRows(self):
+        """解析完成后压缩输出文件, 分页直接读取gzip流"""
+        filename, rows = compress_file(self.output.name)
+        self.addCleanup(os.remove, filename)
+        self.assertEqual((filename, rows), (self.output.name + '.gz', 10))
+        self.assertFalse(os.path.exists(self.output.name))
+        Binlog2sqlJob.objects.filter(id=self.job.id).update(filename=filename, status='finish')
+        job = Binlog2sqlJob.objects.get(id=self.job.id)
+        self.assertEqual([row['sql'] for row in read_binlog2sql_rows(job, offset=3, limit=1)],
+                         ["INSERT INTO `db`.`t`(`id`) VALUES (3);"])
+        open(self.output.name, 'w').close()
+
+    @patch('sql.binlog2sql.submit_binlog2sql_job')
+    def testJobCancelResume(self, _submit):
+        """执行中的任务取消后在检查点停止, 可从检查点继续"""
+        c = Client()
+        c.force_login(self.superuser)
+        c.post('/binlog2sql/job/cancel/', {'job_id': self.job.id})
+        self.assertEqual(Binlog2sqlJob.objects.get(id=self.job.id).status, 'canceling')
+        Binlog2sqlJob.objects.filter(id=self.job.id).update(status='canceled')
+        r = c.post('/binlog2sql/job/resume/', {'job_id': self.job.id}).json()
+        self.assertEqual(r['status'], 0)
+        self.assertEqual(Binlog2sqlJob.objects.get(id=self.job.id).status, 'waiting')
+        _submit.assert_called_once()
+
+    @patch('sql.binlog2sql.submit_binlog2sql_job')
+    def testJobResumeRunning(self, _submit):
+        """执行中的任务不可重复提交, 超时未更新检查点的任务标记为失败后可继续"""
+        c = Client()
+        c.force_login(self.superuser)
+        r = c.post('/binlog2sql/job/resume/', {'job_id': self.job.id}).json()
+        self.assertEqual(r['status'], 1)
+        _submit.assert_not_called()
+        Binlog2sqlJob.objects.filter(id=self.job.id).update(
+            update_time=datetime.now() - timedelta(seconds=settings.BINLOG2SQL_TIMEOUT + 60))
+        r = c.post('/binlog2sql/job/status/', {'job_id': self.job.id}).json()
+        self.assertEqual(r['data']['status'], 'failed')
+        r = c.post('/binlog2sql/job/resume/', {'job_id': self.job.id}).json()
+        self.assertEqual(r['status'], 0)
+        self.assertEqual(Binlog2sqlJob.objects.get(id=self.job.id).status, 'waiting')
+        _submit.assert_called_once()
+
+    def testCheckParams(self):
+        """提交前不连接实例校验解析参数"""
+        Binlog2sql.check_params(start_file='mysql-bin.000001', end_file='mysql-bin.000002',
+                                start_time='2018-01-01 00:00:00', stop_time='', only_dml=True)
+        for params in ({'start_file': ''},
+                       {'start_file': 'mysql-bin.000002', 'end_file': 'mysql-bin.000001'},
+                       {'start_file': 'mysql-bin.000001', 'start_time': '2018-01-01'},
+                       {'start_file': 'mysql-bin.000001', 'start_time': '2018-01-02 00:00:00',
+                        'stop_time': '2018-01-01 00:00:00'}):
+            with self.assertRaises(ValueError):
+                Binlog2sql.check_params(**params)
+
+    def testSkipToStartTime(self):
+        """start_time之前创建的binlog文件不再解析"""
+        binlog2sql = Binlog2sql.__new__(Binlog2sql)
+        binlog2sql.binlogList = ['mysql-bin.{:06d}'.format(i) for i in range(1, 11)]
+        binlog2sql.start_file, binlog2sql.start_pos = binlog2sql.binlogList[0], 120
+        binlog2sql.start_time = datetime(2018, 1, 1, 6, 30)
+        created = {name: datetime(2018, 1, 1, i) for i, name in enumerate(binlog2sql.binlogList)}
+        with patch.object(binlog2sql, 'first_event_time', side_effect=created.get) as first_event_time:
+            binlog2sql.skip_to_start_time()
+        self.assertEqual(binlog2sql.start_file, 'mysql-bin.000007')
+        self.assertEqual(binlog2sql.start_pos, 4)
+        self.assertEqual(binlog2sql.binlogList[0], 'mysql-bin.000007')
+        self.assertLessEqual(first_event_time.call_count, 4)
+
+    @staticmethod
+    def parallel_binlog2sql():
+        binlog2sql = Binlog2sql.__new__(Binlog2sql)
+        binlog2sql.binlogList = ['mysql-bin.000001', 'mysql-bin.000002', 'mysql-bin.000003']
+        binlog2sql.conn_setting = {'host': 'some_host'}
+        binlog2sql.start_file, binlog2sql.start_pos = 'mysql-bin.000001', 120
+        binlog2sql.end_file, binlog2sql.end_pos = 'mysql-bin.000003', 300
+        binlog2sql.eof_file, binlog2sql.eof_pos = 'mysql-bin.000003', 500
+        binlog2sql.start_time, binlog2sql.stop_time = datetime(1980, 1, 1), datetime(2999, 12, 31)
+        binlog2sql.only_schemas = binlog2sql.only_tables = None
+        binlog2sql.no_pk = binlog2sql.only_dml = binlog2sql.where_pk_only = False
+        binlog2sql.back_interval, binlog2sql.sql_type = 1.0, []
+        binlog2sql.batch_size, binlog2sql.back_batch = 1, 1000
+        binlog2sql.flashback = False
+        return binlog2sql
+
+    def testParallelSplitMerge(self):
+        """按binlog文件拆分解析, 按文件顺序合并分段结果, flashback时按文件倒序合并"""
+        binlog2sql = self.parallel_binlog2sql()
+        segments = []
+
+        class Worker(MagicMock):
+            returncode = 0
+
+            def communicate(self, stdin):
+                params = json.loads(stdin.decode('utf-8'))
+                kwargs = params['kwargs']
+                segments.append((kwargs['start_file'], kwargs['start_pos'], kwargs['end_pos']))
+                # 解析进程写入主进程指定的分段文件
+                with open(params['filename'], 'w') as f:
+                    f.write('-- {}\n'.format(kwargs['start_file']))
+                return b'1', b''
+
+        save_file = os.path.join(tempfile.mkdtemp(), 'binlog2sql.sql')
+        self.addCleanup(shutil.rmtree, os.path.dirname(save_file))
+        with patch('sql.utils.binlog2sql.binlog2sql.subprocess.Popen', side_effect=lambda *args, **kwargs: Worker()):
+            for flashback in (False, True):
+                binlog2sql.flashback = flashback
+                segments.clear()
+                self.assertTrue(binlog2sql.process_binlog_parallel(save_file, workers=2))
+                self.assertEqual(sorted(segments), [('mysql-bin.000001', 120, None), ('mysql-bin.000002', 4, None),
+                                                    ('mysql-bin.000003', 4, 300)])
+                self.assertEqual(binlog2sql.rows, 3)
+                with open(save_file) as f:
+                    files = [line.split()[-1] for line in f]
+                self.assertEqual(files, binlog2sql.binlogList[::-1] if flashback else binlog2sql.binlogList)
+                self.assertEqual(os.listdir(os.path.dirname(save_file)), ['binlog2sql.sql'])
+
+    def testParallelProgressHeartbeat(self):
+        """等待解析进程期间按间隔调用on_progress更新心跳, 返回False时终止解析进程"""
+        binlog2sql = self.parallel_binlog2sql()
+        killed = threading.Event()
+
+        class Worker(MagicMock):
+            returncode = 0
+
+            def communicate(self, stdin):
+                # 解析进程在被终止前一直执行
+                killed.wait(5)
+                return b'0', b''
+
+            def poll(self):
+                return None if not killed.is_set() else -9
+
+            def kill(self):
+                killed.set()
+
+        calls = []
+
+        def on_progress(done, total):
+            calls.append((done, total))
+            return len(calls) < 3
+
+        save_file = os.path.join(tempfile.mkdtemp(), 'binlog2sql.sql')
+        self.addCleanup(shutil.rmtree, os.path.dirname(save_file))
+        with patch('sql.utils.binlog2sql.binlog2sql.subprocess.Popen', side_effect=lambda *args, **kwargs: Worker()):
+            finished = binlog2sql.process_binlog_parallel(save_file, workers=3, on_progress=on_progress,
+                                                          progress_interval=0.01)
+        self.assertFalse(finished)
+        self.assertEqual(calls, [(0, 3)] * 3)
+        self.assertTrue(killed.is_set())
+
+    @patch.object(Binlog2sql, '_process_events')
+    @patch('sql.utils.binlog2sql.binlog2sql.BinLogStreamReader')
+    def testProcessBinlogOverwrite(self, _stream, _process_events):
+        """解析进程直接覆盖写入指定的分段文件, 单独解析时不覆盖已存在的文件"""
+        binlog2sql = Binlog2sql.__new__(Binlog2sql)
+        binlog2sql.conn_setting, binlog2sql.server_id = {'host': 'some_host'}, 1
+        binlog2sql.start_file, binlog2sql.start_pos = 'mysql-bin.000001', 4
+        binlog2sql.only_schemas = binlog2sql.only_tables = None
+        binlog2sql.process_binlog(self.output.name, overwrite=True)
+        self.assertEqual(_process_events.call_args[0][4], self.output.name)
+        binlog2sql.process_binlog(self.output.name)
+        self.assertEqual(_process_events.call_args[0][4], self.output.name + '.0')
+        os.remove(self.output.name + '.0')
+
+    def testReversedLines(self):
+        """倒序读取临时文件, 块边界不截断行和多字节字符"""
+        lines = ["DELETE FROM `db`.`t` WHERE `c`='中文{}' LIMIT 1;\n".format(i) for i in range(50)] + ['\n', 'last']
+        with tempfile.TemporaryFile() as f:
+            f.write(''.join(lines).encode('utf-8'))
+            for block_size in (1, 7, 4096):
+                self.assertEqual(list(reversed_lines(f, block_size)), lines[::-1])
+
+    def testWherePkOnly(self):
+        """WHERE只使用键列, UPDATE只SET变化的列"""
+        binlog_event = MagicMock(spec=UpdateRowsEvent)
+        binlog_event.schema, binlog_event.table, binlog_event.primary_key = 'db', 't', 'id'
+        binlog_event.timestamp, binlog_event.packet = 1514736000, MagicMock(log_pos=200)
+        binlog_event.rows = [{'before_values': {'id': 1, 'a': 'x', 'b': None},
+                              'after_values': {'id': 1, 'a': 'y', 'b': None}}]
+        cursor = MagicMock()
+        cursor.connection.literal = lambda value: 'NULL' if value is None else repr(value)
+        sqls = concat_sql_from_rows_event(cursor, binlog_event, e_start_pos=4, flashback=True, key_columns=('id',))
+        self.assertEqual(sqls[0].split(' #')[0], "UPDATE `db`.`t` SET `a`='x' WHERE `id`=1 LIMIT 1;")
+        sqls = concat_sql_from_rows_event(cursor, binlog_event, e_start_pos=4, flashback=True)
+        self.assertEqual(sqls[0].split(' #')[0],
+                         "UPDATE `db`.`t` SET `id`=1, `a`='x', `b`=NULL WHERE `id`=1 AND `a`='y' AND `b` IS NULL LIMIT 1;")
+
+    def testRowsEventMatchesMogrify(self):
+        """按事件生成的SQL与原逐行cursor.mogrify生成的结果一致, 包括NULL值的IS比较"""
+        def legacy_sql(cursor, binlog_event, row, flashback):
+            # 原逐行拼接模板后使用cursor.mogrify转义的实现
+            schema, table = binlog_event.schema, binlog_event.table
+            where = lambda values: ' AND '.join(map(compare_items, values.items()))
+            insert = lambda values: 'INSERT INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
+                schema, table, ', '.join('`%s`' % k for k in values), ', '.join(['%s'] * len(values)))
+            if isinstance(binlog_event, UpdateRowsEvent):
+                set_values, where_values = (row['before_values'], row['after_values']) if flashback else \
+                    (row['after_values'], row['before_values'])
+                template = 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
+                    schema, table, ', '.join('`%s`=%%s' % k for k in set_values), where(where_values))
+                values = list(set_values.values()) + list(where_values.values())
+            elif isinstance(binlog_event, WriteRowsEvent) != flashback:
+                template, values = insert(row['values']), list(row['values'].values())
+            else:
+                template = 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(schema, table, where(row['values']))
+                values = list(row['values'].values())
+            return cursor.mogrify(template, [fix_object(v) for v in values])
+
+        def rows_event(event_class, rows):
+            binlog_event = MagicMock(spec=event_class)
+            binlog_event.schema, binlog_event.table, binlog_event.primary_key = 'db', 't', 'id'
+            binlog_event.rows, binlog_event.timestamp = rows, 1514736000
+            binlog_event.packet = MagicMock(log_pos=200)
+            return binlog_event
+
+        # 不连接实例, 只使用pymysql连接的转义
+        conn = pymysql.connect(defer_connect=True, charset='utf8')
+        conn.server_status = 0
+        cursor = conn.cursor()
+        # 同一事件中NULL分布不同的行交替出现, 模板缓存不能跨NULL分布复用
+        values = [{'id': 1, 'a': "it's", 'b': None}, {'id': 2, 'a': None, 'b': b'\x00x'},
+                  {'id': 3, 'a': 'x', 'b': 1.5}, {'id': 4, 'a': None, 'b': None}]
+        events = [rows_event(WriteRowsEvent, [{'values': v} for v in values]),
+                  rows_event(DeleteRowsEvent, [{'values': v} for v in values]),
+                  rows_event(UpdateRowsEvent, [{'before_values': b, 'after_values': a}
+                                               for b, a in zip(values, values[1:] + values[:1])])]
+        for binlog_event in events:
+            for flashback in (False, True):
+                sqls = concat_sql_from_rows_event(cursor, binlog_event, e_start_pos=4, flashback=flashback)
+                self.assertEqual([sql.split(' #')[0] for sql in sqls],
+                                 [legacy_sql(cursor, binlog_event, row, flashback) for row in binlog_event.rows])
+        sqls = concat_sql_from_rows_event(cursor, events[1], e_start_pos=4)
+        self.assertEqual(sqls[3].split(' #')[0],
+                         "DELETE FROM `db`.`t` WHERE `id`=4 AND `a` IS NULL AND `b` IS NULL LIMIT 1;")
+        self.assertNotEqual(sql_template('DELETE', 'db', 't', (), ('id', 'a'), (False, True)),
+                            sql_template('DELETE', 'db', 't', (), ('id', 'a'), (False, False)))
+
+    def testRowsBatcher(self):
+        """同一事务中连续的同表行合并为多行语句"""
+        def rows_event(event_class, rows, log_pos):
+            binlog_event = MagicMock(spec=event_class)
+            binlog_event.schema, binlog_event.table, binlog_event.primary_key = 'db', 't', 'id'
+            binlog_event.rows, binlog_event.timestamp = rows, 1514736000
+            binlog_event.packet = MagicMock(log_pos=log_pos)
+            return binlog_event
+
+        literal = lambda value: repr(value)
+        insert = rows_event(WriteRowsEvent, [{'values': {'id': i, 'c': 'a'}} for i in range(3)], 200)
+        batcher = RowsBatcher(literal, batch_size=2)
+        sqls = batcher.add(insert, e_start_pos=4) + batcher.flush()
+        self.assertEqual([sql.split(' #')[0] for sql in sqls],
+                         ["INSERT INTO `db`.`t`(`id`, `c`) VALUES (0, 'a'),(1, 'a');",
+                          "INSERT INTO `db`.`t`(`id`, `c`) VALUES (2, 'a');"])
+        self.assertTrue(sqls[0].endswith('#start 4 end 200 time {}'.format(datetime.fromtimestamp(1514736000))))
+        # flashback时INSERT按主键合并为DELETE ... IN
+        batcher = RowsBatcher(literal, batch_size=10, flashback=True)
+        sqls = batcher.add(insert, e_start_pos=4) + batcher.flush()
+        self.assertEqual(sqls[0].split(' #')[0], "DELETE FROM `db`.`t` WHERE `id` IN (0,1,2);")
+
+
+class TestSlowQueryAnalytics(TestCase):
+    """慢日志分析"""
+
+    def testWeightedPercentile(self):
+        """跨区间的分位数按执行次数加权"""
+        self.assertEqual(weighted_percentile([10, 1, 2], [5, 90, 5], 95), 2)
+        self.assertEqual(weighted_percentile([10, 1, 2], [5, 90, 5], 50), 1)
+        self.assertEqual(weighted_percentile([10, None], [5, 0], 99), 10)
+        self.assertIsNone(weighted_percentile([], [], 95))
+
+    def testIntervalStats(self):
+        """汇总多个区间的统计"""
+        stats = IntervalStats()
+        stats.add(90, 9.0, 0.5, 0.2, 0.1)
+        stats.add(10, 11.0, 3.0, 2.0, 1.0)
+        result = stats.result()
+        self.assertEqual(result['count'], 100)
+        self.assertEqual(result['query_time_avg'], 0.2)
+        self.assertEqual(result['query_time_max'], 3.0)
+        self.assertEqual(result['query_time_pct_95'], 2.0)
+        self.assertEqual(result['query_time_median'], 0.1)
+        self.assertIsNone(IntervalStats().result()['query_time_avg'])
+
+
+class SlowQueryTestCase(TestCase):
+    """慢日志表不由Django管理, 测试前创建"""
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(SlowQuery)
+            editor.create_model(SlowQueryHistory)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(SlowQueryHistory)
+            editor.delete_model(SlowQuery)
+
+    def add_history(self, ts_min, ts_cnt, query_time_sum, checksum='0123456789ABCDEF', db_max='some_db'):
+        return SlowQueryHistory.objects.create(
+            hostname_max='some_host:3306', user_max='some_user', db_max=db_max, checksum_id=checksum,
+            sample='select 1', ts_min=ts_min, ts_max=ts_min, ts_cnt=ts_cnt, query_time_sum=query_time_sum,
+            rows_examined_sum=ts_cnt * 10, rows_sent_sum=ts_cnt)
+
+
+class TestSlowQueryRollup(SlowQueryTestCase):
+    def setUp(self):
+        self.superuser = User.objects.create(username='super1', is_superuser=True)
+        Instance.objects.create(instance_name='some_instance', type='master', db_type='mysql',
+                                host='some_host', port=3306, user='ins_user', password='some_pass')
+        SlowQuery.objects.create(checksum='0123456789ABCDEF', fingerprint='select ?', sample='select 1')
+        self.add_history(datetime(2019, 1, 1, 10, 5), 2, 2.0)
+        self.add_history(datetime(2019, 1, 1, 10, 40), 3, 6.0)
+        self.add_history(datetime(2019, 1, 1, 11, 10), 1, 5.0)
+
+    def testRollupBuckets(self):
+        """按实例、数据库、SQL指纹和小时汇总, 水位为已汇总的最大明细ID"""
+        rollup_slow_query()
+        rollups = SlowQueryRollup.objects.order_by('bucket').values_list('bucket', 'ts_cnt', 'query_time_sum',
+                                                                         'rows_examined_sum', 'history_id')
+        max_id = SlowQueryHistory.objects.order_by('-id').first().id
+        self.assertEqual(list(rollups), [(datetime(2019, 1, 1, 10), 5, 8.0, 50, max_id),
+                                         (datetime(2019, 1, 1, 11), 1, 5.0, 10, max_id)])
+
+    def testRollupIncremental(self):
+        """只重新汇总水位之后新增明细所在的小时, 迟到的明细计入原来的小时"""
+        start_time, end_time = datetime(2019, 1, 1), datetime(2019, 1, 3)
+        self.assertIsNone(rollup_covered_until('some_host:3306', start_time, end_time))
+        rollup_slow_query(batch_size=1)
+        self.assertEqual(rollup_covered_until('some_host:3306', start_time, end_time), end_time)
+        self.add_history(datetime(2019, 1, 1, 10, 50), 4, 4.0)
+        # 未汇总的明细所在小时及之后读取明细表
+        self.assertEqual(rollup_covered_until('some_host:3306', start_time, end_time), datetime(2019, 1, 1, 10))
+        self.assertIsNone(rollup_covered_until('some_host:3306', datetime(2019, 1, 1, 10), end_time))
+        # 新增明细不在查询的时间范围内时全部读取汇总表
+        self.assertEqual(rollup_covered_until('some_host:3306', datetime(2019, 1, 2), end_time), end_time)
+        with patch('sql.utils.slowquery_rollup.rollup_bucket', wraps=rollup_bucket) as _rollup_bucket:
+            rollup_slow_query()
+        _rollup_bucket.assert_called_once_with('some_host:3306', datetime(2019, 1, 1, 10), ANY)
+        self.assertEqual(SlowQueryRollup.objects.get(bucket=datetime(2019, 1, 1, 10)).ts_cnt, 9)
+        self.assertEqual(rollup_covered_until('some_host:3306', start_time, end_time), end_time)
+
+    @patch('sql.slowlog.rollup_review')
+    def testReviewRollupBranch(self, _rollup_review):
+        """超过一天的时间范围在汇总完成后读取汇总表, 汇总未完成时读取明细表"""
+        _rollup_review.return_value = {'total': 0, 'rows': []}
+        c = Client()
+        c.force_login(self.superuser)
+        data = {'instance_name': 'some_instance', 'StartTime': '2019-01-01', 'EndTime': '2019-01-02',
+                'db_name': '', 'limit': 14, 'offset': 0}
+        r = c.post('/slowquery/review/', data=data).json()
+        _rollup_review.assert_not_called()
+        self.assertEqual(r['total'], 1)
+        self.assertEqual(r['rows'][0]['MySQLTotalExecutionCounts'], 6)
+        rollup_slow_query()
+        c.post('/slowquery/review/', data=data)
+        _rollup_review.assert_called_once()
+        # 一天以内的时间范围始终读取明细表
+        c.post('/slowquery/review/', data=dict(data, EndTime='2019-01-01'))
+        _rollup_review.assert_called_once()
+
+    def testReviewRollupWithTail(self):
+        """已汇总的小时读取汇总表, 未汇总的明细所在小时及之后读取明细表, 按checksum合并"""
+        rollup_slow_query()
+        # 删除已汇总的10点明细, 结果仍包含10点的汇总数据
+        SlowQueryHistory.objects.filter(ts_min__lt=datetime(2019, 1, 1, 11)).delete()
+        self.add_history(datetime(2019, 1, 1, 11, 30), 4, 4.0)
+        self.client.force_login(self.superuser)
+        data = {'instance_name': 'some_instance', 'StartTime': '2019-01-01', 'EndTime': '2019-01-02',
+                'db_name': '', 'limit': 14, 'offset': 0}
+        r = self.client.post('/slowquery/review/', data=data).json()
+        self.assertEqual(r['total'], 1)
+        row = r['rows'][0]
+        self.assertEqual(row['SQLText'], 'select ?')
+        self.assertEqual(row['MySQLTotalExecutionCounts'], 10)
+        self.assertEqual(row['MySQLTotalExecutionTimes'], 17.0)
+        self.assertEqual(row['ParseTotalRowCounts'], 100)
+        self.assertAlmostEqual(row['QueryTimeAvg'], 1.7)
+        self.assertEqual(row['CreateTime'], '2019-01-01 11:30:00')
+        r = self.client.post('/slowquery/review/', data=dict(data, db_name='other_db')).json()
+        self.assertEqual(r['total'], 0)
+
+
+class TestSlowQueryReviewHistory(SlowQueryTestCase):
+    def setUp(self):
+        self.superuser = User.objects.create(username='super1', is_superuser=True)
+        Instance.objects.create(instance_name='some_instance', type='master', db_type='mysql',
+                                host='some_host', port=3306, user='ins_user', password='some_pass')
+        checksums = ['{:016X}'.format(i) for i in range(3)]
+        for checksum in checksums:
+            SlowQuery.objects.create(checksum=checksum, fingerprint='select ?', sample='select 1')
+        # 前三条的ts_min相同, 分页需要按id区分
+        self.history_ids = [self.add_history(datetime(2019, 1, 1, 10), 1, 1.0, checksum=checksum).id
+                            for checksum in checksums]
+        self.history_ids += [self.add_history(datetime(2019, 1, 1, 10, minute), 1, 1.0, checksum=checksums[0]).id
+                             for minute in (5, 10)]
+        self.client.force_login(self.superuser)
+
+    def review_history(self, **kwargs):
+        data = dict({'instance_name': 'some_instance', 'StartTime': '2019-01-01', 'EndTime': '2019-01-01',
+                     'db_name': '', 'SQLId': '', 'limit': 2, 'offset': 0}, **kwargs)
+        return self.client.post('/slowquery/review_history/', data=data).json()
+
+    def testKeysetPaging(self):
+        """按(ts_min, id)键集分页, ts_min相同的记录不重复也不遗漏"""
+        pages = []
+        cursor, offset = '', 0
+        while True:
+            r = self.review_history(cursor=cursor, offset=offset)
+            self.assertEqual(r['total'], 5)
+            if not r['rows']:
+                self.assertIsNone(r['next_cursor'])
+                break
+            pages.append([row['id'] for row in r['rows']])
+            cursor, offset = r['next_cursor'], offset + 2
+        ids = self.history_ids
+        self.assertEqual(pages, [ids[0:2], ids[2:4], ids[4:5]])
+
+    def testInvalidCursor(self):
+        """cursor格式不正确时按offset分页"""
+        for cursor in ('some_cursor', '2019-01-01 10:00:00|x', '2019-01-01|1'):
+            r = self.review_history(cursor=cursor, offset=2)
+            self.assertEqual([row['id'] for row in r['rows']], self.history_ids[2:4])
+
+    def testApproxCount(self):
+        """近似总数只统计当前位置之后最多10页"""
+        r = self.review_history(count='approx')
+        self.assertEqual(r['total'], 5)
+        r = self.review_history(count='approx', cursor=r['next_cursor'], offset=2)
+        self.assertEqual(r['total'], 5)
+        for minute in range(11, 21):
+            self.add_history(datetime(2019, 1, 1, 10, minute), 1, 1.0, checksum='0000000000000000')
+        self.assertEqual(self.review_history(count='approx', limit=1)['total'], 11)
+        self.assertEqual(self.review_history(limit=1)['total'], 15)
+        r = self.review_history(count='approx', limit=1, offset=10)
+        self.assertEqual(r['total'], 15)
+
+
+class TestSlowQueryRegression(SlowQueryTestCase):
+    def setUp(self):
+        self.superuser = User.objects.create(username='super1', is_superuser=True)
+        Instance.objects.create(instance_name='some_instance', type='master', db_type='mysql',
+                                host='some_host', port=3306, user='ins_user', password='some_pass')
+        self.checksums = ['{:016X}'.format(i) for i in range(3)]
+        for checksum in self.checksums:
+            SlowQuery.objects.create(checksum=checksum, fingerprint='select {}'.format(checksum), sample='select 1')
+        # 第一个SQL指纹最近一周变慢, 第二个基本不变, 第三个只在最近一周出现且执行次数不足
+        self.add_stats(datetime(2019, 1, 2), 6, 6.0, 1.0, checksum=self.checksums[0])
+        self.add_stats(datetime(2019, 1, 3), 4, 4.0, 1.0, checksum=self.checksums[0])
+        self.add_stats(datetime(2019, 1, 9), 10, 30.0, 3.0, checksum=self.checksums[0])
+        self.add_stats(datetime(2019, 1, 2), 10, 10.0, 1.0, checksum=self.checksums[1])
+        self.add_stats(datetime(2019, 1, 9), 10, 11.0, 1.1, checksum=self.checksums[1])
+        self.add_stats(datetime(2019, 1, 9), 5, 50.0, 10.0, checksum=self.checksums[2])
+        self.client.force_login(self.superuser)
+
+    def add_stats(self, ts_min, ts_cnt, query_time_sum, pct_95, checksum):
+        history = self.add_history(ts_min, ts_cnt, query_time_sum, checksum=checksum)
+        SlowQueryHistory.objects.filter(id=history.id).update(
+            query_time_max=pct_95 * 2, query_time_pct_95=pct_95, query_time_median=pct_95 / 2)
+
+    def testDetectRegression(self):
+        """按SQL指纹在数据库中聚合两个时间段, 只为满足执行次数的SQL指纹读取分位数"""
+        # 两个时间段的聚合、候选SQL指纹的分位数、SQL指纹文本各一次查询
+        with self.assertNumQueries(4):
+            regressions = detect_regression('some_host:3306', datetime(2019, 1, 15), days=7)
+        self.assertEqual([item['SQLId'] for item in regressions], [self.checksums[0]])
+        regression = regressions[0]
+        self.assertEqual(regression['SQLText'], 'select 0000000000000000')
+        self.assertEqual(regression['previous'], {'count': 10, 'query_time_sum': 10.0, 'query_time_avg': 1.0,
+                                                  'query_time_max': 2.0, 'query_time_pct_95': 1.0,
+                                                  'query_time_median': 0.5})
+        self.assertEqual(regression['current']['query_time_pct_95'], 3.0)
+        self.assertEqual((regression['avg_ratio'], regression['pct_95_ratio'], regression['change']),
+                         (3.0, 3.0, 3.0))
+        self.assertEqual(detect_regression('some_host:3306', datetime(2019, 1, 15), db_name='other_db'), [])
+
+    def analytics(self, **kwargs):
+        data = dict({'instance_name': 'some_instance', 'type': 'trend', 'SQLId': self.checksums[0],
+                     'StartTime': '2019-01-01', 'EndTime': '2019-01-14'}, **kwargs)
+        return self.client.post('/slowquery/analytics/', data=data).json()
+
+    def testAnalyticsView(self):
+        """趋势默认按时间范围选择粒度, 不支持的粒度和分析类型返回错误"""
+        r = self.analytics()
+        self.assertEqual(r['status'], 0)
+        self.assertEqual([point['time'] for point in r['data']['series']],
+                         ['2019-01-02 00:00:00', '2019-01-03 00:00:00', '2019-01-09 00:00:00'])
+        self.assertEqual(r['data']['summary']['count'], 20)
+        r = self.analytics(granularity='hour', EndTime='2019-01-02')
+        self.assertEqual(r['status'], 0)
+        self.assertEqual(len(r['data']['series']), 1)
+        r = self.analytics(granularity='minute')
+        self.assertEqual(r, {'status': 1, 'msg': '不支持的统计粒度: minute', 'data': []})
+        r = self.analytics(type='regression', EndTime='2019-01-14')
+        self.assertEqual([item['SQLId'] for item in r['data']], [self.checksums[0]])
+        self.assertEqual(self.analytics(type='other')['status'], 1)
+        self.assertEqual(self.analytics(type='regression', days='x')['status'], 1)
+
+
+def load_slow_log_script():
+    """慢日志解析脚本不在Django项目的包内, 按文件加载"""
+    spec = importlib.util.spec_from_file_location(
+        'analysis_slow_query', os.path.join(settings.BASE_DIR, 'src/script/analysis_slow_query.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestSlowLogParser(TestCase):
+    slow_log = b"""/usr/sbin/mysqld, Version: 5.7.24-log (MySQL Community Server (GPL)). started with:
+Tcp port: 3306  Unix socket: /tmp/mysql.sock
+Time                 Id Command    Argument
+# Time: 2019-01-01T02:00:01.000000Z
+# User@Host: app[app] @  [10.0.0.1]  Id:    11
+# Query_time: 1.500000  Lock_time: 0.000100 Rows_sent: 1  Rows_examined: 1000
+use shop;
+SET timestamp=1546308001;
+SELECT * FROM orders
+WHERE id = 42;
+# Time: 2019-01-01T02:00:05.000000Z
+# User@Host: app[app] @ web1 [10.0.0.2]  Id:    12
+# Query_time: 3.000000  Lock_time: 0.000000 Rows_sent: 0  Rows_examined: 5
+SET timestamp=1546308005;
+update orders set status = 'paid' where id in (1, 2);
+# User@Host: app[app] @  [10.0.0.1]  Id:    11
+# Query_time: 2.000000  Lock_time: 0.000100 Rows_sent: 1  Rows_examined: 10
+SET timestamp=1546308006;
+# administrator command: Quit;
+# Time: 2019-01-01T02:00:09.000000Z
+# User@Host: app[app] @  [10.0.0.1]  Id:    13
+# Query_time: 9.000000  Lock_time: 0.000000 Rows_sent: 1  Rows_examined: 1
+SET timestamp=1546308009;
+select sleep(9)"""
+
+    def setUp(self):
+        self.script = load_slow_log_script()
+
+    def testIterSlowLog(self):
+        """解析慢日志头部、指标和语句, 未指定数据库时沿用上一条, 不完整的最后一条不读取"""
+        events = list(self.script.iter_slow_log(io.BytesIO(self.slow_log)))
+        self.assertEqual([event['sql'] for event, _ in events],
+                         ['SELECT * FROM orders\nWHERE id = 42', "update orders set status = 'paid' where id in (1, 2)",
+                          'administrator command: Quit'])
+        first, _ = events[0]
+        self.assertEqual((first['user'], first['client'], first['db'], first['epoch']),
+                         ('app', '10.0.0.1', 'shop', 1546308001))
+        self.assertEqual((first['Query_time'], first['Rows_examined'], first['Bytes']), (1.5, 1000, 34))
+        self.assertEqual((events[1][0]['client'], events[1][0]['db']), ('10.0.0.2', 'shop'))
+        # 最后一条没有换行结束, 下次从这条的开始位置继续读取
+        offset = events[-1][1]
+        self.assertEqual(offset, self.slow_log.index(b'# Time: 2019-01-01T02:00:09'))
+        events = list(self.script.iter_slow_log(io.BytesIO(self.slow_log + b';\n'), offset))
+        self.assertEqual(events[0][0]['sql'], 'select sleep(9)')
+        self.assertEqual(events[0][1], len(self.slow_log) + 2)
+
+    def testFingerprint(self):
+        """指纹和checksum与pt-query-digest的结果一致"""
+        cases = [
+            ('SELECT * FROM t WHERE id = 1', 'select * from t where id = ?', '35FC3906162972DA'),
+            ("select * from t1 where a in (1, 2, 3) and b = 'x'", 'select * from t? where a in(?+) and b = ?',
+             'B9EE047EA0EA655C'),
+            ("INSERT INTO t (a,b) VALUES (1,'x'),(2,'y'),(3,'z')", 'insert into t (a,b) values(?+)',
+             'AF1606D0AA96CBCD'),
+            ("select 'hello', \"world\", 'it\\'s' from dual", 'select ?, ?, ? from dual', None),
+            ('select c from t # trailing\nwhere d = 2', 'select c from t where d = ?', '9BE9D05B1CA4064A'),
+            ('SELECT * FROM `db`.`tbl_2019` WHERE c = 0x1A and e = -1.5e10 LIMIT 10, 20',
+             'select * from `db`.`tbl_?` where c = ?a and e = ? limit ?', '559AD534B1808F3B'),
+            ('select a from t where flag = TRUE or x is NULL', 'select a from t where flag = ? or x is ?', None),
+            ('SELECT a FROM t ORDER BY a ASC, b ASC, c DESC', 'select a from t order by a, b, c desc',
+             '013A451BAB51060F'),
+            ('select a from t union select a from t union all select a from t',
+             'select a from t /*repeat union all*/', '48A0F45E6652C74D'),
+            ('call my_proc(1, 2)', 'call my_proc', '70BB673DB722ED35'),
+            ('  SELECT\n\t*  FROM t\r\n WHERE a = b - 1\n', 'select * from t where a = b ? ?', None),
+        ]
+        for sql, expected, expected_checksum in cases:
+            sql_fingerprint = self.script.fingerprint(sql)
+            self.assertEqual(sql_fingerprint, expected)
+            if expected_checksum:
+                self.assertEqual(self.script.checksum(sql_fingerprint), expected_checksum)
+
+    def testStats(self):
+        """pct_95按最近秩取值, 中位数取下中位数"""
+        result = self.script.stats('Query_time', [float(v) for v in range(20, 0, -1)])
+        self.assertEqual((result['Query_time_sum'], result['Query_time_min'], result['Query_time_max']),
+                         (210, 1, 20))
+        self.assertEqual((result['Query_time_pct_95'], result['Query_time_median']), (19, 10))
+        self.assertAlmostEqual(result['Query_time_stddev'], 5.766281, places=6)
+        result = self.script.stats('Query_time', [2.0])
+        self.assertEqual((result['Query_time_pct_95'], result['Query_time_median'], result['Query_time_stddev']),
+                         (2.0, 2.0, 0))
+        self.assertIsNone(self.script.stats('Lock_time', [])['Lock_time_pct_95'])
+
+    def testDigest(self):
+        """同一区间同一指纹合并为一行明细, 样例使用最慢的一条"""
+        digest = self.script.SlowLogDigest('some_host:3306', interval=300)
+        for event, _ in self.script.iter_slow_log(io.BytesIO(self.slow_log + b';\n')):
+            digest.add(event)
+        sql = 'SELECT * FROM orders WHERE id = 7'
+        digest.add({'sql': sql, 'epoch': 1546308002, 'timestamp': self.script.local_time(1546308002), 'user': 'app',
+                    'client': '10.0.0.1', 'db': 'shop', 'Query_time': 4.0, 'Bytes': len(sql)})
+        rows = {row['checksum']: row for row in digest.pop()}
+        orders = rows[self.script.checksum('select * from orders where id = ?')]
+        self.assertEqual((orders['ts_cnt'], orders['Query_time_sum'], orders['Query_time_max']), (2, 5.5, 4.0))
+        self.assertEqual(orders['sample'], 'SELECT * FROM orders WHERE id = 7')
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(set(self.script.history_columns) - set(orders), set())
+
+    def testMain(self):
+        """解析日志文件写入指纹和明细, 明细包含实例地址, 已读取的位置不重复写入"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        slowlog = os.path.join(tmp_dir, 'slow.log')
+        with open(slowlog, 'wb') as f:
+            f.write(self.slow_log + b';\n')
+        history = []
+        with patch.object(self.script.pymysql, 'connect') as _connect:
+            cursor = _connect.return_value.cursor.return_value.__enter__.return_value
+            cursor.executemany.side_effect = lambda sql, rows: history.extend(
+                dict(zip(self.script.history_columns, row)) for row in rows if sql == self.script.history_sql)
+            for hostname in ('host1:3306', 'host2:3306', 'host2:3306'):
+                self.script.main(['--hostname', hostname, '--slowlog', slowlog, '--state-dir', tmp_dir])
+        self.assertEqual(len(history), 8)
+        self.assertEqual([row['hostname_max'] for row in history], ['host1:3306'] * 4 + ['host2:3306'] * 4)
+        orders = history[0]
+        self.assertEqual((orders['checksum'], orders['db_max'], orders['user_max'], orders['client_max']),
+                         (self.script.checksum('select * from orders where id = ?'), 'shop', 'app', '10.0.0.1'))
+        self.assertEqual((orders['ts_min'], orders['ts_max'], orders['ts_cnt'], orders['Query_time_sum'],
+                          orders['Rows_examined_sum']),
+                         (datetime.fromtimestamp(1546308001), datetime.fromtimestamp(1546308001), 1, 1.5, 1000))
+        self.assertEqual(sum(row['ts_cnt'] for row in history), 8)
+        # 唯一键冲突时累加次数和sum, 不覆盖唯一键中的实例地址
+        update = self.script.history_sql.split('ON DUPLICATE KEY UPDATE')[1]
+        self.assertIn('`ts_cnt`=IF(`ts_cnt` IS NULL, VALUES(`ts_cnt`), `ts_cnt` + IFNULL(VALUES(`ts_cnt`), 0))',
+                      update)
+        self.assertIn('`Query_time_min`=LEAST(', update)
+        self.assertNotIn('`hostname_max`=', update)
+        self.assertLess(update.index('`sample`='), update.index('`Query_time_max`='))
+
@@ -26,6 +26,7 @@ urlpatterns = [
     path('timingtask/', sql_workflow.timingtask),
     path('cancel/', sql_workflow.cancel),
     path('rollback/', views.rollback),
+    path('rollback/list/', sql_workflow.rollback_list),
     path('sqlquery/', views.sqlquery),
     path('slowquery/', views.slowquery),
     path('sqladvisor/', views.sqladvisor),
@@ -87,9 +88,14 @@ urlpatterns = [
 
     path('binlog2sql/sql/', binlog2sql.binlog2sql),
     path('binlog2sql/binlog_list/', binlog2sql.binlog_list),
+    path('binlog2sql/job/status/', binlog2sql.binlog2sql_job_status),
+    path('binlog2sql/job/cancel/', binlog2sql.binlog2sql_job_cancel),
+    path('binlog2sql/job/resume/', binlog2sql.binlog2sql_job_resume),
+    path('binlog2sql/job/rows/', binlog2sql.binlog2sql_job_rows),
 
     path('slowquery/review/', slowlog.slowquery_review),
     path('slowquery/review_history/', slowlog.slowquery_review_history),
+    path('slowquery/analytics/', slowlog.slowquery_analytics),
     path('slowquery/optimize_sqladvisor/', sql.sql_optimize.optimize_sqladvisor),
     path('slowquery/optimize_sqltuning/', sql.sql_optimize.optimize_sqltuning),
     path('slowquery/optimize_soar/', sql.sql_optimize.optimize_soar),
@@ -2,27 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import json
+import os
+import shutil
+import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 import pymysql
 from pymysqlreplication import BinLogStreamReader
-from pymysqlreplication.event import QueryEvent, RotateEvent, FormatDescriptionEvent
+from pymysqlreplication.event import QueryEvent, RotateEvent, FormatDescriptionEvent, XidEvent
 
-from .binlog2sql_util import command_line_args, concat_sql_from_binlog_event, create_unique_file, temp_open, \
-    reversed_lines, is_dml_event, event_type
+from .binlog2sql_util import command_line_args, concat_sql_from_binlog_event, concat_sql_from_rows_event, \
+    create_unique_file, reversed_lines, is_dml_event, event_type, RowsBatcher
+
+# 解析进程以包的方式启动, 工作目录为项目根目录
+project_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 
 class Binlog2sql(object):
+    checkpoint_interval = 5  # 检查点最小间隔(秒)
 
     def __init__(self, connection_settings, start_file=None, start_pos=None, end_file=None, end_pos=None,
                  start_time=None, stop_time=None, only_schemas=None, only_tables=None, no_pk=False,
-                 flashback=False, stop_never=False, back_interval=1.0, only_dml=True, sql_type=None):
+                 flashback=False, stop_never=False, back_interval=1.0, only_dml=True, sql_type=None,
+                 batch_size=1, back_batch=1000, where_pk_only=False):
         """
         conn_setting: {'host': 127.0.0.1, 'port': 3306, 'user': user, 'passwd': passwd, 'charset': 'utf8'}
+        batch_size: 同一事务中连续的同表行合并为一条语句的最大行数, 1为逐行生成
+        back_batch: flashback时每输出多少行插入一次SELECT SLEEP(back_interval)
+        where_pk_only: UPDATE/DELETE的WHERE只使用主键或非空唯一键, UPDATE的SET只包含变化的列
         """
 
-        if not start_file:
-            raise ValueError('Lack of parameter: start_file')
+        self.check_params(start_file=start_file, end_file=end_file, start_time=start_time, stop_time=stop_time)
 
         self.conn_setting = connection_settings
         self.start_file = start_file
@@ -43,6 +57,10 @@ class Binlog2sql(object):
         self.no_pk, self.flashback, self.stop_never, self.back_interval = (no_pk, flashback, stop_never, back_interval)
         self.only_dml = only_dml
         self.sql_type = [t.upper() for t in sql_type] if sql_type else []
+        self.batch_size = max(int(batch_size or 1), 1)
+        self.back_batch = max(int(back_batch or 1000), 1)
+        self.where_pk_only = where_pk_only
+        self._key_columns = {}
 
         self.binlogList = []
         self.connection = pymysql.connect(**self.conn_setting)
@@ -50,7 +68,9 @@ class Binlog2sql(object):
             cursor.execute("SHOW MASTER STATUS")
             self.eof_file, self.eof_pos = cursor.fetchone()[:2]
             cursor.execute("SHOW MASTER LOGS")
-            bin_index = [row[0] for row in cursor.fetchall()]
+            master_logs = cursor.fetchall()
+            bin_index = [row[0] for row in master_logs]
+            self.binlog_sizes = {row[0]: int(row[1]) for row in master_logs}
             if self.start_file not in bin_index:
                 raise ValueError('parameter error: start_file %s not in mysql server' % self.start_file)
             binlog2i = lambda x: x.split('.')[1]
@@ -63,17 +83,102 @@ class Binlog2sql(object):
             if not self.server_id:
                 raise ValueError('missing server_id in %s:%s' % (self.conn_setting['host'], self.conn_setting['port']))
 
-    def process_binlog(self, filename):
+        if start_time:
+            self.skip_to_start_time()
+
+    @staticmethod
+    def check_params(start_file=None, end_file=None, start_time=None, stop_time=None, **kwargs):
+        """不连接实例校验解析参数, 提交后台任务前调用, 参数错误时抛出ValueError"""
+        if not start_file:
+            raise ValueError('Lack of parameter: start_file')
+        for binlog_file in (start_file, end_file):
+            if binlog_file and not binlog_file.split('.')[-1].isdigit():
+                raise ValueError('parameter error: invalid binlog file %s' % binlog_file)
+        if end_file and end_file.split('.')[-1] < start_file.split('.')[-1]:
+            raise ValueError('parameter error: end_file %s is before start_file %s' % (end_file, start_file))
+        times = [datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S") if t else None for t in (start_time, stop_time)]
+        if times[0] and times[1] and times[0] >= times[1]:
+            raise ValueError('parameter error: start_time must be earlier than stop_time')
+
+    def first_event_time(self, log_file):
+        """读取binlog文件第一个事件的时间, 即文件的创建时间"""
+        stream = BinLogStreamReader(connection_settings=self.conn_setting, server_id=self.server_id,
+                                    log_file=log_file, log_pos=4, resume_stream=True)
+        try:
+            for binlog_event in stream:
+                # 跳过服务端发送的时间戳为0的RotateEvent
+                if binlog_event.timestamp and stream.log_file == log_file:
+                    return datetime.datetime.fromtimestamp(binlog_event.timestamp)
+                if stream.log_file != log_file:
+                    break
+        finally:
+            stream.close()
+        return None
+
+    def skip_to_start_time(self):
+        """
+        按文件创建时间二分查找最后一个在start_time之前创建的binlog文件, 从该文件开始解析,
+        之前的文件中所有事件都早于start_time, 无需读取
+        """
+        lo, hi = 1, len(self.binlogList) - 1
+        first = 0
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            event_time = self.first_event_time(self.binlogList[mid])
+            if event_time is not None and event_time < self.start_time:
+                first, lo = mid, mid + 1
+            else:
+                hi = mid - 1
+        if first > 0:
+            self.start_file, self.start_pos = self.binlogList[first], 4
+            self.binlogList = self.binlogList[first:]
+
+    def process_binlog(self, filename, checkpoint=None, resume=None, overwrite=False):
+        """
+        overwrite: 直接写入filename, 已存在时覆盖, 用于并行解析时写入主进程指定的分段文件
+        checkpoint: 在事务边界每隔checkpoint_interval秒调用checkpoint(state), 返回False时停止解析并返回False
+        resume: 上次检查点的state, 从记录的binlog位置继续解析, 输出文件截断到记录的位置后追加写入
+        """
+        self.rows = resume['rows'] if resume else 0
+        if resume:
+            self.eof_file, self.eof_pos = resume['eof_file'], resume['eof_pos']
+        log_file, log_pos = (resume['log_file'], resume['log_pos']) if resume else (self.start_file, self.start_pos)
         stream = BinLogStreamReader(connection_settings=self.conn_setting, server_id=self.server_id,
-                                    log_file=self.start_file, log_pos=self.start_pos, only_schemas=self.only_schemas,
+                                    log_file=log_file, log_pos=log_pos, only_schemas=self.only_schemas,
                                     only_tables=self.only_tables, resume_stream=True)
 
+        if checkpoint or resume:
+            # 可续传时使用固定的文件名, 续传时截断检查点之后写入的内容
+            tmp_file, save_file = filename + '.tmp', filename
+            f_tmp, f = open(tmp_file, 'a'), open(save_file, 'a')
+            f_tmp.truncate(resume['tmp_offset'] if resume else 0)
+            f.truncate(resume['offset'] if resume else 0)
+        else:
+            # 临时文件和输出文件放在一起, 多个进程同时解析时不会互相覆盖
+            save_file = filename if overwrite else create_unique_file(filename)
+            tmp_file = save_file + '.tmp'
+            f_tmp, f = open(tmp_file, 'w'), open(save_file, 'w')
+        try:
+            return self._process_events(stream, f, f_tmp, tmp_file, save_file, checkpoint)
+        finally:
+            # 可续传时保留临时文件, 完成后再删除
+            if not (checkpoint or resume) and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _process_events(self, stream, f, f_tmp, tmp_file, save_file, checkpoint):
         flag_last_event = False
         e_start_pos, last_pos = stream.log_pos, stream.log_pos
-        # to simplify code, we do not use flock for tmp_file.
-        tmp_file = create_unique_file('%s.%s' % (self.conn_setting['host'], self.conn_setting['port']))
-        save_file = create_unique_file(filename)
-        with temp_open(tmp_file, "w") as f_tmp, open(save_file, "w") as f, self.connection as cursor:
+        checkpoint_time = time.time()
+        with f_tmp, f, self.connection as cursor:
+            f_rows = f_tmp if self.flashback else f
+            batcher = RowsBatcher(cursor.connection.literal, self.batch_size, flashback=self.flashback,
+                                  no_pk=self.no_pk) if self.batch_size > 1 else None
+
+            def write_rows(sqls):
+                if sqls:
+                    f_rows.write('\n'.join(sqls) + '\n')
+                    self.rows += len(sqls)
+
             for binlog_event in stream:
                 if not self.stop_never:
                     try:
@@ -99,43 +204,184 @@ class Binlog2sql(object):
                 if isinstance(binlog_event, QueryEvent) and binlog_event.query == 'BEGIN':
                     e_start_pos = last_pos
 
+                # 合并的语句不跨事务, 遇到事务结束或其他语句前先输出
+                if batcher and isinstance(binlog_event, (QueryEvent, XidEvent)):
+                    write_rows(batcher.flush())
+
                 if isinstance(binlog_event, QueryEvent) and not self.only_dml:
                     sql = concat_sql_from_binlog_event(cursor=cursor, binlog_event=binlog_event,
                                                        flashback=self.flashback, no_pk=self.no_pk)
                     if sql:
                         # print(sql)
                         f.write(sql + '\n')
+                        self.rows += 1
                 elif is_dml_event(binlog_event) and event_type(binlog_event) in self.sql_type:
-                    for row in binlog_event.rows:
-                        sql = concat_sql_from_binlog_event(cursor=cursor, binlog_event=binlog_event, no_pk=self.no_pk,
-                                                           row=row, flashback=self.flashback, e_start_pos=e_start_pos)
-                        if self.flashback:
-                            f_tmp.write(sql + '\n')
-                        else:
-                            # print(sql)
-                            f.write(sql + '\n')
+                    key_columns = self.key_columns(cursor, binlog_event.schema,
+                                                   binlog_event.table) if self.where_pk_only else None
+                    if batcher:
+                        write_rows(batcher.add(binlog_event, e_start_pos=e_start_pos, key_columns=key_columns))
+                    else:
+                        write_rows(concat_sql_from_rows_event(cursor=cursor, binlog_event=binlog_event,
+                                                              no_pk=self.no_pk, flashback=self.flashback,
+                                                              e_start_pos=e_start_pos, key_columns=key_columns))
 
                 if not (isinstance(binlog_event, RotateEvent) or isinstance(binlog_event, FormatDescriptionEvent)):
                     last_pos = binlog_event.packet.log_pos
                 if flag_last_event:
                     break
 
+                # 只在事务边界记录检查点, 续传时从完整的事务开始解析
+                if checkpoint and time.time() - checkpoint_time >= self.checkpoint_interval and (
+                        isinstance(binlog_event, XidEvent) or
+                        (isinstance(binlog_event, QueryEvent) and binlog_event.query != 'BEGIN')):
+                    checkpoint_time = time.time()
+                    f.flush()
+                    f_tmp.flush()
+                    state = {'log_file': stream.log_file, 'log_pos': binlog_event.packet.log_pos,
+                             'offset': f.tell(), 'tmp_offset': f_tmp.tell(), 'rows': self.rows,
+                             'eof_file': self.eof_file, 'eof_pos': self.eof_pos}
+                    if checkpoint(state) is False:
+                        stream.close()
+                        return False
+
+            if batcher:
+                write_rows(batcher.flush())
             stream.close()
             f_tmp.close()
             if self.flashback:
                 self.print_rollback_sql(tmp_filename=tmp_file, filename=save_file)
+        os.remove(tmp_file)
         return True
 
+    def key_columns(self, cursor, schema, table):
+        """
+        获取表的主键列, 没有主键时使用列数最少的非空唯一键, 都没有时返回None, WHERE仍使用全部列
+        每张表只查询一次information_schema
+        """
+        if (schema, table) not in self._key_columns:
+            cursor.execute("""SELECT INDEX_NAME, COLUMN_NAME, NULLABLE FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND NON_UNIQUE=0 ORDER BY INDEX_NAME, SEQ_IN_INDEX;""",
+                           (schema, table))
+            indexes = {}
+            for index_name, column_name, nullable in cursor.fetchall():
+                indexes.setdefault(index_name, []).append((column_name, nullable))
+            if 'PRIMARY' in indexes:
+                columns = tuple(c for c, _ in indexes['PRIMARY'])
+            else:
+                candidates = [tuple(c for c, _ in columns) for columns in indexes.values()
+                              if all(nullable != 'YES' for _, nullable in columns)]
+                columns = min(candidates, key=len) if candidates else None
+            self._key_columns[(schema, table)] = columns
+        return self._key_columns[(schema, table)]
+
+    def process_binlog_parallel(self, filename, workers, on_progress=None, progress_interval=60):
+        """
+        每个binlog文件启动一个解析进程, 最多workers个同时执行, 各文件的结果写入单独的文件后按顺序合并,
+        flashback时每个文件的结果已倒序, 按文件倒序合并
+        on_progress: 每个文件解析完成后, 以及等待解析进程时每progress_interval秒调用on_progress(已完成文件数, 总文件数),
+                     用于更新进度和心跳时间, 返回False时终止解析并返回False
+        """
+        save_file = filename
+        segments = []
+        for index, binlog in enumerate(self.binlogList):
+            part_file = '{}.part{}'.format(save_file, index)
+            segments.append((part_file, {
+                'connection_settings': self.conn_setting,
+                'start_file': binlog,
+                'start_pos': self.start_pos if binlog == self.start_file else 4,
+                'end_file': binlog,
+                'end_pos': self.end_pos if binlog == self.end_file else None,
+                'start_time': self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                'stop_time': self.stop_time.strftime("%Y-%m-%d %H:%M:%S"),
+                'only_schemas': self.only_schemas, 'only_tables': self.only_tables,
+                'no_pk': self.no_pk, 'flashback': self.flashback, 'stop_never': False,
+                'back_interval': self.back_interval, 'only_dml': self.only_dml, 'sql_type': self.sql_type,
+                'batch_size': self.batch_size, 'back_batch': self.back_batch, 'where_pk_only': self.where_pk_only,
+            }))
+
+        processes = []
+        canceled = threading.Event()
+
+        def run_segment(index, segment):
+            part_file, kwargs = segment
+            if canceled.is_set():
+                return 0
+            process = subprocess.Popen([sys.executable, '-m', 'sql.utils.binlog2sql.worker'], cwd=project_dir,
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            processes.append(process)
+            # 参数通过标准输入传递, 避免密码出现在进程列表中
+            # 每个进程使用不同的server_id连接, 相同server_id的复制连接会被主库断开
+            params = {'kwargs': kwargs, 'filename': part_file, 'eof_file': self.eof_file, 'eof_pos': self.eof_pos,
+                      'server_id': 4290000000 + os.getpid() % 40000 * 100 + index % 100}
+            stdout, stderr = process.communicate(json.dumps(params).encode('utf-8'))
+            if process.returncode != 0:
+                if canceled.is_set():
+                    return 0
+                raise RuntimeError('parse {} failed: {}'.format(kwargs['start_file'],
+                                                                stderr.decode('utf-8', 'ignore')))
+            return int(stdout.decode('utf-8').strip() or 0)
+
+        def stop():
+            canceled.set()
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+
+        self.rows = 0
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run_segment, index, segment) for index, segment in enumerate(segments)]
+                pending = set(futures)
+                try:
+                    while pending:
+                        # 单个文件解析时间较长时也按时调用on_progress, 不依赖文件解析完成
+                        finished, pending = wait(pending, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            self.rows += future.result()
+                        if on_progress and on_progress(len(futures) - len(pending), len(futures)) is False:
+                            stop()
+                            return False
+                except BaseException:
+                    stop()
+                    raise
+            part_files = [part_file for part_file, _ in segments]
+            if self.flashback:
+                part_files.reverse()
+            with open(save_file, 'wb') as f:
+                for part_file in part_files:
+                    with open(part_file, 'rb') as f_part:
+                        shutil.copyfileobj(f_part, f, 1024 * 1024)
+            return True
+        finally:
+            for part_file, _ in segments:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+                if os.path.exists(part_file + '.tmp'):
+                    os.remove(part_file + '.tmp')
+
+    def progress(self, log_file, log_pos):
+        """根据binlog文件大小计算解析进度百分比"""
+        total = done = 0
+        for binlog in self.binlogList:
+            size = self.binlog_sizes.get(binlog, 0)
+            if binlog == self.end_file and self.end_pos:
+                size = min(size, self.end_pos)
+            total += size
+            if binlog < log_file:
+                done += size
+            elif binlog == log_file:
+                done += min(log_pos, size)
+        return round(done * 100.0 / total, 2) if total else 0
+
     def print_rollback_sql(self, tmp_filename, filename):
         """print rollback sql from tmp_file"""
         sql_list = []
         with open(tmp_filename, "rb") as f_tmp, open(filename, "w") as f:
-            batch_size = 1000
             i = 0
             for line in reversed_lines(f_tmp):
                 # print(line.rstrip())
                 f.write(line.rstrip() + '\n')
-                if i >= batch_size:
+                if i >= self.back_batch:
                     i = 0
                     if self.back_interval:
                         # print('SELECT SLEEP(%s);' % self.back_interval)
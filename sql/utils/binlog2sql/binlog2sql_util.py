@@ -5,6 +5,7 @@ import sys
 import argparse
 import datetime
 from contextlib import contextmanager
+from functools import lru_cache
 from pymysqlreplication.row_event import (
     WriteRowsEvent,
     UpdateRowsEvent,
@@ -157,6 +158,25 @@ def event_type(event):
     return t
 
 
+def concat_sql_from_rows_event(cursor, binlog_event, e_start_pos=None, flashback=False, no_pk=False,
+                               key_columns=None):
+    """
+    生成一个行事件中所有行的SQL, 事件时间和位置注释只计算一次, 值的转义直接使用连接的literal
+    key_columns: 表的主键或非空唯一键列, 指定时WHERE只使用这些列
+    """
+    if flashback and no_pk:
+        raise ValueError('only one of flashback or no_pk can be True')
+    literal = cursor.connection.literal
+    time = datetime.datetime.fromtimestamp(binlog_event.timestamp)
+    suffix = ' #start %s end %s time %s' % (e_start_pos, binlog_event.packet.log_pos, time)
+    sqls = []
+    for row in binlog_event.rows:
+        pattern = generate_sql_pattern(binlog_event, row=row, flashback=flashback, no_pk=no_pk,
+                                       key_columns=key_columns)
+        sqls.append(pattern['template'] % tuple(map(literal, pattern['values'])) + suffix)
+    return sqls
+
+
 def concat_sql_from_binlog_event(cursor, binlog_event, row=None, e_start_pos=None, flashback=False, no_pk=False):
     if flashback and no_pk:
         raise ValueError('only one of flashback or no_pk can be True')
@@ -180,73 +200,151 @@ def concat_sql_from_binlog_event(cursor, binlog_event, row=None, e_start_pos=Non
     return sql
 
 
-def generate_sql_pattern(binlog_event, row=None, flashback=False, no_pk=False):
-    template = ''
-    values = []
-    if flashback is True:
-        if isinstance(binlog_event, WriteRowsEvent):
-            template = 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(
-                binlog_event.schema, binlog_event.table,
-                ' AND '.join(map(compare_items, row['values'].items()))
-            )
-            values = map(fix_object, row['values'].values())
-        elif isinstance(binlog_event, DeleteRowsEvent):
-            template = 'INSERT INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                binlog_event.schema, binlog_event.table,
-                ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                ', '.join(['%s'] * len(row['values']))
-            )
-            values = map(fix_object, row['values'].values())
-        elif isinstance(binlog_event, UpdateRowsEvent):
-            template = 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
-                binlog_event.schema, binlog_event.table,
-                ', '.join(['`%s`=%%s' % x for x in row['before_values'].keys()]),
-                ' AND '.join(map(compare_items, row['after_values'].items())))
-            values = map(fix_object, list(row['before_values'].values()) + list(row['after_values'].values()))
-    else:
-        if isinstance(binlog_event, WriteRowsEvent):
-            if no_pk:
-                # print binlog_event.__dict__
-                # tableInfo = (binlog_event.table_map)[binlog_event.table_id]
-                # if tableInfo.primary_key:
-                #     row['values'].pop(tableInfo.primary_key)
-                if binlog_event.primary_key:
-                    row['values'].pop(binlog_event.primary_key)
-
-            template = 'INSERT INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
-                binlog_event.schema, binlog_event.table,
-                ', '.join(map(lambda key: '`%s`' % key, row['values'].keys())),
-                ', '.join(['%s'] * len(row['values']))
-            )
-            values = map(fix_object, row['values'].values())
-        elif isinstance(binlog_event, DeleteRowsEvent):
-            template = 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(
-                binlog_event.schema, binlog_event.table, ' AND '.join(map(compare_items, row['values'].items())))
-            values = map(fix_object, row['values'].values())
-        elif isinstance(binlog_event, UpdateRowsEvent):
-            template = 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
-                binlog_event.schema, binlog_event.table,
-                ', '.join(['`%s`=%%s' % k for k in row['after_values'].keys()]),
-                ' AND '.join(map(compare_items, row['before_values'].items()))
-            )
-            values = map(fix_object, list(row['after_values'].values()) + list(row['before_values'].values()))
-
-    return {'template': template, 'values': list(values)}
-
-
-def reversed_lines(fin):
-    """Generate the lines of file in reverse order."""
-    part = ''
-    for block in reversed_blocks(fin):
-        if PY3PLUS:
-            block = block.decode("utf-8", errors='ignore')
-        for c in reversed(block):
-            if c == '\n' and part:
-                yield part[::-1]
-                part = ''
-            part += c
-    if part:
-        yield part[::-1]
+def row_images(binlog_event, row, flashback=False, no_pk=False, key_columns=None):
+    """
+    按事件类型确定生成的语句类型, 返回(语句类型, SET/VALUES部分的值, WHERE部分的值)
+    key_columns: 指定时WHERE只保留键列, UPDATE的SET只保留前后值不同的列
+    """
+    kind, set_values, where_values = _row_images(binlog_event, row, flashback=flashback, no_pk=no_pk)
+    if key_columns and where_values and all(k in where_values for k in key_columns):
+        where_values = {k: where_values[k] for k in key_columns}
+        if kind == 'UPDATE':
+            changed = {k: v for k, v in set_values.items() if row_value(row, k, flashback) != v}
+            set_values = changed or set_values
+    return kind, set_values, where_values
+
+
+def row_value(row, column, flashback):
+    """UPDATE行中WHERE一侧的值"""
+    return row['after_values' if flashback else 'before_values'].get(column)
+
+
+def _row_images(binlog_event, row, flashback=False, no_pk=False):
+    if no_pk and not flashback and isinstance(binlog_event, WriteRowsEvent):
+        # print binlog_event.__dict__
+        # tableInfo = (binlog_event.table_map)[binlog_event.table_id]
+        # if tableInfo.primary_key:
+        #     row['values'].pop(tableInfo.primary_key)
+        if binlog_event.primary_key:
+            row['values'].pop(binlog_event.primary_key)
+
+    if isinstance(binlog_event, UpdateRowsEvent):
+        if flashback:
+            return 'UPDATE', row['before_values'], row['after_values']
+        return 'UPDATE', row['after_values'], row['before_values']
+    elif isinstance(binlog_event, WriteRowsEvent) != flashback:
+        return 'INSERT', row['values'], {}
+    return 'DELETE', {}, row['values']
+
+
+def generate_sql_pattern(binlog_event, row=None, flashback=False, no_pk=False, key_columns=None):
+    kind, set_values, where_values = row_images(binlog_event, row, flashback=flashback, no_pk=no_pk,
+                                                key_columns=key_columns)
+    template = sql_template(kind, binlog_event.schema, binlog_event.table, tuple(set_values),
+                            tuple(where_values), tuple(v is None for v in where_values.values()))
+    values = [fix_object(v) for v in set_values.values()]
+    values += [fix_object(v) for v in where_values.values()]
+    return {'template': template, 'values': values}
+
+
+class RowsBatcher(object):
+    """
+    将同一事务中连续的同表行合并为多行语句: INSERT ... VALUES (...),(...);
+    已知单列主键且主键不为NULL时DELETE合并为DELETE ... WHERE `pk` IN (...); UPDATE仍逐行生成
+    batch_size: 每条语句最多合并的行数
+    """
+
+    def __init__(self, literal, batch_size, flashback=False, no_pk=False):
+        self.literal = literal
+        self.batch_size = batch_size
+        self.flashback = flashback
+        self.no_pk = no_pk
+        self._key = None
+        self._items = []
+        self._comment = ''
+
+    def add(self, binlog_event, e_start_pos=None, key_columns=None):
+        """加入一个行事件, 返回已完成的SQL列表"""
+        sqls = []
+        time = datetime.datetime.fromtimestamp(binlog_event.timestamp)
+        comment = ' #start %s end %s time %s' % (e_start_pos, binlog_event.packet.log_pos, time)
+        for row in binlog_event.rows:
+            kind, set_values, where_values = row_images(binlog_event, row, flashback=self.flashback,
+                                                        no_pk=self.no_pk, key_columns=key_columns)
+            primary_key = binlog_event.primary_key
+            if kind == 'INSERT':
+                key = (kind, binlog_event.schema, binlog_event.table, tuple(set_values))
+                item = '({})'.format(', '.join(self.literal(fix_object(v)) for v in set_values.values()))
+            elif kind == 'DELETE' and isinstance(primary_key, str) and where_values.get(primary_key) is not None:
+                key = (kind, binlog_event.schema, binlog_event.table, primary_key)
+                item = self.literal(fix_object(where_values[primary_key]))
+            else:
+                sqls += self.flush()
+                template = sql_template(kind, binlog_event.schema, binlog_event.table, tuple(set_values),
+                                        tuple(where_values), tuple(v is None for v in where_values.values()))
+                values = [fix_object(v) for v in set_values.values()]
+                values += [fix_object(v) for v in where_values.values()]
+                sqls.append(template % tuple(map(self.literal, values)) + comment)
+                continue
+            if key != self._key:
+                sqls += self.flush()
+                self._key = key
+            self._items.append(item)
+            self._comment = comment
+            if len(self._items) >= self.batch_size:
+                sqls += self.flush()
+        return sqls
+
+    def flush(self):
+        """输出未完成的合并语句, 在事务结束或其他事件前调用"""
+        if not self._items:
+            return []
+        kind, schema, table, columns = self._key
+        if kind == 'INSERT':
+            sql = 'INSERT INTO `{0}`.`{1}`({2}) VALUES {3};'.format(
+                schema, table, ', '.join('`%s`' % key for key in columns), ','.join(self._items))
+        else:
+            sql = 'DELETE FROM `{0}`.`{1}` WHERE `{2}` IN ({3});'.format(schema, table, columns, ','.join(self._items))
+        self._key, self._items = None, []
+        return [sql + self._comment]
+
+
+@lru_cache(maxsize=4096)
+def sql_template(kind, schema, table, set_columns, where_columns, where_nulls):
+    """
+    生成语句模板, 同一张表、相同列和相同NULL分布的行共用模板, 不再逐行拼接
+    where_nulls: WHERE部分每列的值是否为NULL, NULL值使用IS比较
+    """
+    where = ' AND '.join('`%s` IS %%s' % k if is_null else '`%s`=%%s' % k
+                         for k, is_null in zip(where_columns, where_nulls))
+    if kind == 'INSERT':
+        return 'INSERT INTO `{0}`.`{1}`({2}) VALUES ({3});'.format(
+            schema, table, ', '.join(map(lambda key: '`%s`' % key, set_columns)), ', '.join(['%s'] * len(set_columns)))
+    elif kind == 'DELETE':
+        return 'DELETE FROM `{0}`.`{1}` WHERE {2} LIMIT 1;'.format(schema, table, where)
+    return 'UPDATE `{0}`.`{1}` SET {2} WHERE {3} LIMIT 1;'.format(
+        schema, table, ', '.join(['`%s`=%%s' % k for k in set_columns]), where)
+
+
+def reversed_lines(fin, block_size=1024 * 1024):
+    """
+    Generate the lines of file in reverse order.
+    按块倒序读取, 在字节块中用rfind查找换行符切分整行后再解码, 不再逐字符处理,
+    未到行首的部分与前一个块拼接, 多字节字符不会在块边界被截断
+    """
+    tail = b''
+    for block in reversed_blocks(fin, block_size):
+        block += tail
+        end = len(block)
+        while True:
+            pos = block.rfind(b'\n', 0, end - 1)
+            if pos < 0:
+                break
+            yield block[pos + 1:end].decode("utf-8", errors='ignore') if PY3PLUS else block[pos + 1:end]
+            end = pos + 1
+        tail = block[:end]
+    if tail:
+        yield tail.decode("utf-8", errors='ignore') if PY3PLUS else tail
 
 
 def reversed_blocks(fin, block_size=4096):
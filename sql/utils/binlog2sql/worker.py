@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+解析单个binlog文件的进程入口, 由Binlog2sql.process_binlog_parallel启动
+参数以JSON从标准输入传入, 解析完成后向标准输出打印生成的SQL行数
+"""
+import json
+import sys
+
+from .binlog2sql import Binlog2sql
+
+
+def main():
+    params = json.load(sys.stdin)
+    binlog2sql = Binlog2sql(**params['kwargs'])
+    binlog2sql.server_id = params['server_id']
+    # 与主进程使用相同的结束位置
+    binlog2sql.eof_file, binlog2sql.eof_pos = params['eof_file'], params['eof_pos']
+    # 主进程按filename合并分段结果, 必须写入该文件, 不能另取文件名
+    binlog2sql.process_binlog(params['filename'], overwrite=True)
+    print(binlog2sql.rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# -*- coding: UTF-8 -*-
+"""binlog2sql后台解析任务, 由django-q执行, 解析过程中记录检查点和进度, 支持取消和从检查点继续"""
+import datetime
+import gzip
+import itertools
+import logging
+import os
+import time
+import traceback
+
+import pymysql
+import simplejson as json
+from django.conf import settings
+from django.utils import timezone
+from django_q.tasks import async_task
+
+from common.config import SysConfig
+from sql.models import Binlog2sqlJob, Instance
+from sql.utils.binlog2sql.binlog2sql import Binlog2sql
+from sql.utils.jobs import add_binlog2sql_clean_job
+
+logger = logging.getLogger('default')
+
+
+def submit_binlog2sql_job(job):
+    """提交解析任务到django-q, 同时确保输出文件的定时清理任务存在"""
+    add_binlog2sql_clean_job()
+    async_task('sql.utils.binlog2sql_job.run_binlog2sql_job', job.id, timeout=job_timeout())
+
+
+def job_timeout():
+    return getattr(settings, 'BINLOG2SQL_TIMEOUT', 3600)
+
+
+def heartbeat_interval():
+    """并发解析时心跳时间的更新间隔, 需远小于任务超时时间"""
+    return min(60, max(job_timeout() // 10, 1))
+
+
+def fail_stale_jobs():
+    """
+    执行中的任务每个检查点更新update_time, 超过任务超时时间未更新说明执行进程已被django-q终止或异常退出,
+    将这些任务标记为失败(取消中的标记为已取消), 之后可以从检查点继续执行
+    """
+    deadline = timezone.now() - datetime.timedelta(seconds=job_timeout())
+    stale = Binlog2sqlJob.objects.filter(update_time__lt=deadline)
+    stale.filter(status='running').update(status='failed', error='任务执行超时或执行进程已退出, 可从检查点继续执行',
+                                          update_time=timezone.now())
+    stale.filter(status='canceling').update(status='canceled', update_time=timezone.now())
+
+
+def run_binlog2sql_job(job_id):
+    jobs = Binlog2sqlJob.objects.filter(id=job_id)
+    # 只有等待执行的任务可以开始, 避免同一任务被重复提交时两个进程同时写输出文件
+    if not jobs.filter(status='waiting').update(status='running', error='', update_time=timezone.now()):
+        return
+    job = jobs.get()
+    try:
+        instance = Instance.objects.get(instance_name=job.instance_name)
+        conn_setting = {'host': instance.host, 'port': int(instance.port), 'user': instance.user,
+                        'passwd': instance.raw_password, 'charset': 'utf8'}
+        binlog2sql = Binlog2sql(connection_settings=conn_setting, **json.loads(job.params))
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        jobs.update(status='failed', error=str(e))
+        return
+
+    def checkpoint(state):
+        # 保存检查点并更新心跳时间, 任务被取消或不再是执行中时停止解析
+        jobs.update(checkpoint=json.dumps(state), log_file=state['log_file'], log_pos=state['log_pos'],
+                    rows=state['rows'], progress=binlog2sql.progress(state['log_file'], state['log_pos']),
+                    update_time=timezone.now())
+        return jobs.values_list('status', flat=True).first() == 'running'
+
+    def on_progress(done, total):
+        # 并发解析时按已完成的文件数更新进度, 等待解析进程期间也定时更新心跳时间
+        jobs.update(progress=round(done * 100.0 / total, 2), update_time=timezone.now())
+        return jobs.values_list('status', flat=True).first() == 'running'
+
+    resume = json.loads(job.checkpoint) if job.checkpoint else None
+    # 配置了并发数且跨多个binlog文件时按文件并发解析, 并发解析不记录检查点, 继续执行时从头解析
+    workers = int(SysConfig().get('binlog2sql_parallel_workers', 1) or 1)
+    # 获取sql语句，忽略wait_timeout的错误
+    try:
+        if workers > 1 and len(binlog2sql.binlogList) > 1 and not resume:
+            finished = binlog2sql.process_binlog_parallel(job.filename, workers, on_progress=on_progress,
+                                                         progress_interval=heartbeat_interval())
+        else:
+            finished = binlog2sql.process_binlog(job.filename, checkpoint=checkpoint, resume=resume)
+    except pymysql.err.OperationalError:
+        logger.error(traceback.format_exc())
+        finished = True
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        jobs.update(status='failed', error=str(e))
+        return
+    if finished:
+        try:
+            filename, rows = compress_file(job.filename)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            jobs.update(status='failed', error=str(e))
+            return
+        jobs.update(status='finish', progress=100, filename=filename, rows=rows)
+    else:
+        jobs.filter(status='canceling').update(status='canceled')
+
+
+def open_output(filename, mode='r'):
+    """打开解析结果文件, .gz结尾的文件按gzip流读取"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode if 'b' in mode else mode + 't')
+    return open(filename, mode)
+
+
+def compress_file(filename):
+    """
+    解析完成后按块将输出文件压缩为filename.gz并删除原文件, 压缩过程中统计行数
+    解析过程中保持明文输出, 检查点续传需要按偏移截断文件
+    返回(压缩后的文件名, 行数)
+    """
+    if not os.path.exists(filename):
+        return filename, 0
+    gz_filename = filename + '.gz'
+    rows = 0
+    with open(filename, 'rb') as f, gzip.open(gz_filename + '.tmp', 'wb') as f_gz:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            rows += block.count(b'\n')
+            f_gz.write(block)
+    os.rename(gz_filename + '.tmp', gz_filename)
+    os.remove(filename)
+    return gz_filename, rows
+
+
+def count_lines(filename):
+    """统计输出文件行数, 作为分页的总数"""
+    try:
+        with open_output(filename, 'rb') as f:
+            return sum(block.count(b'\n') for block in iter(lambda: f.read(1024 * 1024), b''))
+    except FileNotFoundError:
+        return 0
+
+
+def read_binlog2sql_rows(job, offset=0, limit=100):
+    """分页读取解析结果, 只读取(解压)到offset+limit行, 不加载完整文件"""
+    rows = []
+    try:
+        with open_output(job.filename) as f:
+            for row in itertools.islice(f, offset, offset + limit):
+                row_info = {}
+                try:
+                    row_info['sql'] = row.split('; #')[0] + ";"
+                    row_info['binlog_info'] = row.split('; #')[1].rstrip('\"')
+                except Exception:
+                    row_info['sql'] = row
+                    row_info['binlog_info'] = None
+                rows.append(row_info)
+    except FileNotFoundError:
+        pass
+    return rows
+
+
+def clean_binlog2sql_files():
+    """
+    定时清理解析结果文件, 删除超过保留天数的文件, 总大小超过上限时从最旧的文件开始删除
+    等待和执行中任务的文件不清理, 未配置时默认保留7天、总大小10240MB, 配置为0表示不限制
+    同时将执行超时的任务标记为失败
+    """
+    fail_stale_jobs()
+    path = os.path.join(settings.BASE_DIR, 'downloads/binlog2sql/')
+    if not os.path.isdir(path):
+        return
+    sys_config = SysConfig()
+    retention_days = float(sys_config.get('binlog2sql_retention_days', 7) or 0)
+    retention_size = float(sys_config.get('binlog2sql_retention_size', 10240) or 0) * 1024 * 1024
+    active = [job.filename for job in Binlog2sqlJob.objects.filter(status__in=('waiting', 'running', 'canceling'))]
+    files = []
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        if not os.path.isfile(filename) or any(filename.startswith(active_file) for active_file in active):
+            continue
+        stat = os.stat(filename)
+        files.append((stat.st_mtime, stat.st_size, filename))
+    files.sort()
+    total_size = sum(size for _, size, _ in files)
+    now = time.time()
+    for mtime, size, filename in files:
+        expired = retention_days and now - mtime > retention_days * 86400
+        if not expired and (not retention_size or total_size <= retention_size):
+            continue
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        # 文件已删除的任务不能再从检查点继续, 清空检查点后从头解析
+        Binlog2sqlJob.objects.filter(filename=filename).update(checkpoint='')
+        logger.info('清理binlog2sql解析结果文件:{}'.format(filename))
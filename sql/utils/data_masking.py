@@ -1,7 +1,17 @@
 # -*- coding:utf-8 -*-
+import datetime
 import logging
+import threading
+import time
 import traceback
+import uuid
 
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from common.utils.local_cache import LocalCache
 from sql.engines.inception import InceptionEngine
 from sql.models import DataMaskingRules, DataMaskingColumns, Instance
 import simplejson as json
@@ -9,11 +19,112 @@ import re
 
 logger = logging.getLogger('default')
 
+# inception语法树缓存, 权限校验和脱敏共用, 避免同一语句重复请求inception
+query_tree_cache = LocalCache(max_size=1000, timeout=600)
+
+
+def query_tree_cache_key(sql_content, instance_name, db_name):
+    """语法树缓存的key, 对sql做归一化处理: 合并空白、去掉结尾的分号,
+    LIMIT不影响语法树中的表和列信息, 同时去掉结尾的limit子句, 使权限校验和脱敏(已追加limit)命中同一缓存"""
+    sql = re.sub(r'\s+', ' ', sql_content).strip().rstrip(';').strip()
+    sql = re.sub(r'\s+limit\s+\d+(\s*,\s*\d+|\s+offset\s+\d+)?$', '', sql, flags=re.I)
+    return instance_name, db_name, sql
+
+
+class MaskingIndex(object):
+    """脱敏字段和脱敏规则的进程内索引, 查询时的命中判断只做字典查找
+
+    columns: {(instance_name, table_schema, table_name): {column_name: rule_type}}, 仅包含激活的字段
+    rules: {rule_type: (compiled_regex, hide_group)}
+    DataMaskingColumns/DataMaskingRules保存或删除时更新缓存中的版本号, 各进程发现版本变化后重新加载
+    """
+    version_key = 'data_masking_version'
+    # 缓存不可用时的最长重新加载间隔
+    timeout = 300
+
+    def __init__(self):
+        self._columns = {}
+        self._rules = {}
+        self._version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def table_columns(self, instance_name, table_schema, table_name):
+        """返回表中命中脱敏的字段{column_name: rule_type}, 使用前需调用refresh"""
+        return self._columns.get((instance_name, table_schema, table_name), {})
+
+    def rules(self):
+        """返回全部脱敏规则, 使用前需调用refresh"""
+        return self._rules
+
+    def refresh(self):
+        """版本号变化或超过timeout时重新加载, 每次脱敏处理开始时调用一次"""
+        version = self.current_version()
+        if version == self._version and time.time() - self._loaded_at < self.timeout:
+            return
+        with self._lock:
+            columns = {}
+            for column in DataMaskingColumns.objects.filter(active=1).order_by('column_id'):
+                table_columns = columns.setdefault(
+                    (column.instance_name, column.table_schema, column.table_name), {})
+                table_columns.setdefault(column.column_name, column.rule_type)
+            rules = {}
+            for rule in DataMaskingRules.objects.all():
+                try:
+                    rules[rule.rule_type] = (re.compile(rule.rule_regex), int(rule.hide_group))
+                except Exception:
+                    logger.error(traceback.format_exc())
+            self._columns, self._rules = columns, rules
+            self._version = version
+            self._loaded_at = time.time()
+
+    def current_version(self):
+        try:
+            version = cache.get(self.version_key)
+            if version is None:
+                version = uuid.uuid4().hex
+                cache.add(self.version_key, version, timeout=None)
+                version = cache.get(self.version_key)
+            return version
+        except Exception:
+            logger.error(traceback.format_exc())
+            return None
+
+    def invalidate(self):
+        """配置变更时更新版本号, 使所有进程的索引失效"""
+        self._loaded_at = 0
+        try:
+            cache.set(self.version_key, uuid.uuid4().hex, timeout=None)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+
+masking_index = MaskingIndex()
+
+
+@receiver([post_save, post_delete], sender=DataMaskingColumns)
+@receiver([post_save, post_delete], sender=DataMaskingRules)
+def invalidate_masking_index(sender, **kwargs):
+    masking_index.invalidate()
+    # 事务提交前其他进程可能已按旧数据重新加载, 提交后再次失效
+    transaction.on_commit(masking_index.invalidate)
+
 
 class Masking(object):
     # 脱敏数据
     def data_masking(self, instance_name, db_name, sql, sql_result):
+        result, plan = self.masking_plan(instance_name, db_name, sql, sql_result.get('column_list'))
+        if plan and sql_result.get('rows'):
+            sql_result['rows'] = self.mask_rows(sql_result['rows'], plan)
+        return result
+
+    def masking_plan(self, instance_name, db_name, sql, column_list):
+        """
+        解析语法树获取命中脱敏规则的列, 返回(result, plan), plan为[(列序号, 预编译的规则)]
+        plan只依赖语句和列信息, 流式查询时各批数据共用
+        """
         result = {'status': 0, 'msg': 'ok', 'data': {'hit_rule': 0}}
+        plan = []
         # 通过inception获取语法树,并进行解析
         try:
             print_info = self.query_tree(sql, instance_name, db_name)
@@ -21,7 +132,7 @@ class Masking(object):
             logger.error(traceback.format_exc())
             result['status'] = 1
             result['msg'] = str(msg)
-            return result
+            return result, plan
 
         if print_info is None:
             result['status'] = 1
@@ -40,11 +151,10 @@ class Masking(object):
                 result['status'] = 2
                 result['msg'] = '解析inception语法树获取表信息出错，无法完成脱敏校验，如果需要继续查询请关闭校验：{}\nquery_tree：{}'.format(str(msg),
                                                                                                         print_info)
-                return result
+                return result, plan
 
             # 存在select * 的查询,遍历column_list,获取命中列的index,添加到hit_columns
-            if table_hit_columns and sql_result.get('rows'):
-                column_list = sql_result['column_list']
+            if table_hit_columns and column_list:
                 table_hit_column = {}
                 for column_info in table_hit_columns:
                     table_hit_column_info = {}
@@ -60,21 +170,45 @@ class Masking(object):
                         column['rule_type'] = table_hit_column.get(item)
                         hit_columns.append(column)
 
-            # 对命中规则列hit_columns的数据进行脱敏
-            # 获取全部脱敏规则信息，减少循环查询，提升效率
-            masking_rules = DataMaskingRules.objects.all()
-            if hit_columns and sql_result.get('rows'):
-                rows = list(sql_result['rows'])
+            # 一次性获取全部预编译的脱敏规则, 生成命中规则列的脱敏计划
+            # 命中列的脱敏规则不存在或正则无效时无法保证脱敏, 作为脱敏失败返回
+            if hit_columns:
+                masking_rules = masking_index.rules()
+                missing_columns = []
                 for column in hit_columns:
-                    index = column['index']
-                    for idx, item in enumerate(rows):
-                        rows[idx] = list(item)
-                        rows[idx][index] = self.regex(masking_rules, column['rule_type'], rows[idx][index])
-                    sql_result['rows'] = rows
-        return result
-
-    # 通过inception获取语法树
+                    rule = masking_rules.get(column['rule_type'])
+                    if rule:
+                        plan.append((column['index'], rule))
+                    else:
+                        missing_columns.append('{}(规则类型{})'.format(column['column_name'], column['rule_type']))
+                if missing_columns:
+                    result['status'] = 1
+                    result['msg'] = '脱敏字段{}的脱敏规则不存在或无效，无法完成脱敏，如果需要继续查询请关闭校验'.format(
+                        '、'.join(missing_columns))
+        return result, plan
+
+    @classmethod
+    def mask_rows(cls, rows, plan):
+        """按脱敏计划处理结果集, 将结果集转置为列, 按列整体脱敏后再转置回行"""
+        if not plan or not rows:
+            return rows
+        columns = list(zip(*rows))
+        for index, rule in plan:
+            columns[index] = [cls.regex(rule, value) for value in columns[index]]
+        return [list(row) for row in zip(*columns)]
+
+    # 通过inception获取语法树, 优先从缓存获取
     def query_tree(self, sql_content, instance_name, db_name):
+        cache_key = query_tree_cache_key(sql_content, instance_name, db_name)
+        print_info = query_tree_cache.get(cache_key)
+        if print_info is None:
+            print_info = self._query_tree(sql_content, instance_name, db_name)
+            # 仅缓存解析成功的结果
+            if print_info and print_info['errlevel'] == 0:
+                query_tree_cache.set(cache_key, print_info)
+        return print_info
+
+    def _query_tree(self, sql_content, instance_name, db_name):
         try:
             inception_engine = InceptionEngine()
             instance = Instance.objects.get(instance_name=instance_name)
@@ -154,17 +288,12 @@ class Masking(object):
         query_tree_dict = json.loads(query_tree_str)
         select_list = query_tree_dict.get('select_list')
         table_ref = query_tree_dict.get('table_ref')
-
-        # 获取全部脱敏字段信息，减少循环查询，提升效率
-        masking_columns = DataMaskingColumns.objects.all()
+        masking_index.refresh()
 
         # 判断语句涉及的表是否存在脱敏字段配置
         is_exist = False
         for table in table_ref:
-            if masking_columns.filter(instance_name=instance_name,
-                                      table_schema=table['db'],
-                                      table_name=table['table'],
-                                      active=1).exists():
+            if masking_index.table_columns(instance_name, table['db'], table['table']):
                 is_exist = True
         # 不存在脱敏字段则直接跳过规则解析
         if is_exist:
@@ -196,8 +325,7 @@ class Masking(object):
                 if '*' in select_index:
                     # 涉及表命中的列
                     for table in table_ref:
-                        hit_columns_info = self.hit_table(masking_columns, instance_name, table['db'],
-                                                          table['table'])
+                        hit_columns_info = self.hit_table(instance_name, table['db'], table['table'])
                         table_hit_columns.extend(hit_columns_info)
                     # 几种不同查询格式
                     # [*]
@@ -257,7 +385,7 @@ class Masking(object):
 
             # 格式化命中的列信息
             for column in columns:
-                hit_info = self.hit_column(masking_columns, instance_name, column.get('db'), column.get('table'),
+                hit_info = self.hit_column(instance_name, column.get('db'), column.get('table'),
                                            column.get('field'))
                 if hit_info['is_hit']:
                     hit_info['index'] = column['index']
@@ -268,9 +396,8 @@ class Masking(object):
         return table_hit_columns, hit_columns
 
     # 判断字段是否命中脱敏规则,如果命中则返回脱敏的规则id和规则类型
-    def hit_column(self, masking_columns, instance_name, table_schema, table_name, column_name):
-        column_info = masking_columns.filter(instance_name=instance_name, table_schema=table_schema,
-                                             table_name=table_name, column_name=column_name, active=1)
+    def hit_column(self, instance_name, table_schema, table_name, column_name):
+        rule_type = masking_index.table_columns(instance_name, table_schema, table_name).get(column_name)
 
         hit_column_info = {}
         hit_column_info['instance_name'] = instance_name
@@ -281,76 +408,108 @@ class Masking(object):
         hit_column_info['is_hit'] = False
 
         # 命中规则
-        if column_info:
-            hit_column_info['rule_type'] = column_info[0].rule_type
+        if rule_type is not None:
+            hit_column_info['rule_type'] = rule_type
             hit_column_info['is_hit'] = True
 
         return hit_column_info
 
     # 获取表中所有命中脱敏规则的字段信息，用于select *
-    def hit_table(self, masking_columns, instance_name, table_schema, table_name):
-        columns_info = masking_columns.filter(instance_name=instance_name, table_schema=table_schema,
-                                              table_name=table_name, active=1)
+    def hit_table(self, instance_name, table_schema, table_name):
+        columns_info = masking_index.table_columns(instance_name, table_schema, table_name)
 
         # 命中规则
         hit_columns_info = []
-        for column in columns_info:
+        for column_name, rule_type in columns_info.items():
             hit_column_info = {}
             hit_column_info['instance_name'] = instance_name
             hit_column_info['table_schema'] = table_schema
             hit_column_info['table_name'] = table_name
             hit_column_info['is_hit'] = True
-            hit_column_info['column_name'] = column.column_name
-            hit_column_info['rule_type'] = column.rule_type
+            hit_column_info['column_name'] = column_name
+            hit_column_info['rule_type'] = rule_type
             hit_columns_info.append(hit_column_info)
         return hit_columns_info
 
-    # 利用正则表达式脱敏数据
-    def regex(self, masking_rules, rule_type, value):
-        rules_info = masking_rules.get(rule_type=rule_type)
-        if rules_info:
-            rule_regex = rules_info.rule_regex
-            hide_group = rules_info.hide_group
-            # 正则匹配必须分组，隐藏的组会使用****代替
-            try:
-                p = re.compile(rule_regex)
-                m = p.search(str(value))
-                masking_str = ''
-                for i in range(m.lastindex):
-                    if i == hide_group - 1:
-                        group = '****'
-                    else:
-                        group = m.group(i + 1)
-                    masking_str = masking_str + group
-                return masking_str
-            except Exception:
-                logger.error(traceback.format_exc())
-                return value
-        else:
+    # 利用正则表达式脱敏数据, rule为预编译的(compiled_regex, hide_group)
+    @staticmethod
+    def regex(rule, value):
+        p, hide_group = rule
+        # 正则匹配必须分组，隐藏的组会使用****代替
+        m = p.search(str(value))
+        if m is None or m.lastindex is None:
+            return value
+        try:
+            return ''.join('****' if i == hide_group else m.group(i) for i in range(1, m.lastindex + 1))
+        except Exception:
+            logger.error(traceback.format_exc())
             return value
 
 
+# 不会包含敏感信息的类型, 暴力脱敏时直接跳过
+SKIP_MASK_TYPES = (type(None), bool, float, datetime.date, datetime.time, datetime.timedelta)
+
+# 正则中的反向引用和条件分组, 合并后分组序号会偏移, 不能加入合并正则
+BACKREFERENCE_PATTERN = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def compile_brute_mask_plan(rules):
+    """将脱敏规则编译为暴力脱敏计划
+    rules: {rule_type: (compiled_regex, hide_group)}
+    返回(prefilter, [(compiled_regex, replace_pattern)]), prefilter为全部规则的合并正则,
+    用于一次判断单元格是否可能命中任一规则, 存在反向引用的规则或合并失败时为None, 逐条规则判断"""
+    plan = []
+    for rule_type in sorted(rules):
+        compiled_r, hide_group = rules[rule_type]
+        replace_pattern = r""
+        for i in range(1, compiled_r.groups + 1):
+            if i == hide_group:
+                replace_pattern += r"****"
+            else:
+                replace_pattern += r"\{}".format(i)
+        plan.append((compiled_r, replace_pattern))
+    if any(BACKREFERENCE_PATTERN.search(r.pattern) for r, _ in plan):
+        return None, plan
+    try:
+        prefilter = re.compile('|'.join('(?:{})'.format(r.pattern) for r, _ in plan)) if plan else None
+    except re.error:
+        prefilter = None
+    return prefilter, plan
+
+
 def brute_mask(sql_result):
-    """输入的是一个resultset 
+    """输入的是一个resultset
     sql_result.full_sql
     sql_result.rows 查询结果列表 List , list内的item为tuple
 
+    对每个单元格依次应用全部脱敏规则, 单元格只遍历一次, 未命中任何规则的单元格保持原值和原类型,
+    有单元格被脱敏的行原地替换为新的tuple.
     返回同样结构的sql_result , error 中写入脱敏时产生的错误.
     """
     # 读取所有的脱敏表达
-    masking_rules = DataMaskingRules.objects.all()
-    for reg in masking_rules:
-        compiled_r = re.compile(reg.rule_regex)
-        replace_pattern = r""
-        for i in range(1, compiled_r.groups + 1):
-            if i == int(reg.hide_group):
-                replace_pattern += r"****"
-            else:
-                replace_pattern += r"\{}".format(i)
-        for i in range(len(sql_result.rows)):
-            temp_value_list = []
-            for j in range(len(sql_result.rows[i])):
+    masking_index.refresh()
+    prefilter, plan = compile_brute_mask_plan(masking_index.rules())
+    if not plan:
+        return sql_result
+    if not isinstance(sql_result.rows, list):
+        sql_result.rows = list(sql_result.rows)
+    rows = sql_result.rows
+    for i, row in enumerate(rows):
+        new_row = None
+        for j, value in enumerate(row):
+            if isinstance(value, SKIP_MASK_TYPES):
+                continue
+            str_value = value if isinstance(value, str) else str(value)
+            if prefilter is not None and prefilter.search(str_value) is None:
+                continue
+            masked_value = str_value
+            for compiled_r, replace_pattern in plan:
                 # 进行正则替换
-                temp_value_list += [compiled_r.sub(replace_pattern, str(sql_result.rows[i][j]))]
-            sql_result.rows[i] = tuple(temp_value_list)
+                masked_value = compiled_r.sub(replace_pattern, masked_value)
+            if masked_value != str_value:
+                if new_row is None:
+                    new_row = list(row)
+                new_row[j] = masked_value
+        if new_row is not None:
+            rows[i] = tuple(new_row)
     return sql_result
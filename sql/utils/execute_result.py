@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+"""SQL上线工单执行结果的增量存储, 每段split执行完成后只追加本段的结果"""
+import simplejson as json
+from django.db import connection
+
+from sql.models import SqlWorkflowExecuteResult
+
+
+def clear_execute_result(workflow_id):
+    """清除工单已有的执行结果, 开始执行前调用"""
+    SqlWorkflowExecuteResult.objects.filter(workflow_id=workflow_id).delete()
+
+
+def append_execute_result(workflow_id, chunk_index, review_results):
+    """追加一段split的执行结果, review_results为ReviewResult列表"""
+    execute_results = [SqlWorkflowExecuteResult(workflow_id=workflow_id,
+                                                chunk_index=chunk_index,
+                                                row_index=row_index,
+                                                result=json.dumps(review_result.__dict__))
+                       for row_index, review_result in enumerate(review_results)]
+    # 执行时间较长时连接可能已超时，重连后重试一次
+    try:
+        SqlWorkflowExecuteResult.objects.bulk_create(execute_results)
+    except Exception:
+        connection.close()
+        SqlWorkflowExecuteResult.objects.bulk_create(execute_results)
+
+
+def get_execute_result(workflow):
+    """获取工单执行结果的JSON, 优先读取增量存储, 不存在时兼容读取工单的execute_result"""
+    results = SqlWorkflowExecuteResult.objects.filter(workflow_id=workflow.id).order_by(
+        'chunk_index', 'row_index').values_list('result', flat=True)
+    if results:
+        return '[{}]'.format(','.join(results))
+    return workflow.execute_result
+
+
+def get_executed_count(workflow_id):
+    """已执行完成的语句数"""
+    return SqlWorkflowExecuteResult.objects.filter(workflow_id=workflow_id).count()
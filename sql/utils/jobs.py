@@ -31,3 +31,11 @@ def job_info(job_id):
         return sql_schedule
     except Schedule.DoesNotExist:
         pass
+
+
+# 添加binlog2sql输出文件的定时清理任务, 已存在时不重复添加
+def add_binlog2sql_clean_job():
+    if not Schedule.objects.filter(name='binlog2sql_clean').exists():
+        schedule('sql.utils.binlog2sql_job.clean_binlog2sql_files', name='binlog2sql_clean',
+                 schedule_type=Schedule.HOURLY)
+        logger.debug('add_binlog2sql_clean_job')
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+"""查询日志异步写入, 查询请求只把日志放入进程内队列, 由后台线程按数量或时间批量写入"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import connection, close_old_connections
+
+from sql.models import QueryLog
+
+logger = logging.getLogger('default')
+
+
+class QueryLogWriter(object):
+    """
+    配置项为settings.QUERY_LOG_WRITER:
+    async: 是否异步写入, False时每条日志同步保存
+    batch_size: 每批写入的日志数
+    flush_interval: 最长写入间隔(秒)
+    queue_size: 队列长度, 队列满时阻塞put_timeout秒, 仍无法放入则同步写入, 避免内存无限增长
+    """
+    default_config = {'async': True, 'batch_size': 100, 'flush_interval': 1, 'queue_size': 10000, 'put_timeout': 1}
+    _stop = object()
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        return dict(self.default_config, **getattr(settings, 'QUERY_LOG_WRITER', {}))
+
+    def write(self, query_log):
+        """写入一条QueryLog"""
+        config = self.config
+        if not config['async']:
+            self.save([query_log])
+            return
+        self._start(config)
+        try:
+            self._queue.put(query_log, timeout=config['put_timeout'])
+        except queue.Full:
+            logger.warning('查询日志队列已满，同步写入')
+            self.save([query_log])
+
+    def _start(self, config):
+        """按进程启动后台线程, fork后的子进程重新创建队列和线程"""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=config['queue_size'])
+                atexit.register(self.shutdown)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, args=(config,), name='query-log-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self, config):
+        buffer = []
+        deadline = time.time() + config['flush_interval']
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                item = None
+            if item is self._stop:
+                self.save(buffer)
+                return
+            if item is not None:
+                buffer.append(item)
+            if len(buffer) >= config['batch_size'] or time.time() >= deadline:
+                self.save(buffer)
+                buffer = []
+                deadline = time.time() + config['flush_interval']
+
+    def flush(self):
+        """在当前线程写入队列中的全部日志"""
+        if self._queue is None or self._pid != os.getpid():
+            return
+        buffer = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._stop:
+                buffer.append(item)
+        self.save(buffer)
+
+    def shutdown(self, timeout=10):
+        """进程退出时停止后台线程并写入剩余日志"""
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            try:
+                self._queue.put(self._stop, timeout=timeout)
+                self._thread.join(timeout=timeout)
+            except queue.Full:
+                pass
+        self.flush()
+
+    @staticmethod
+    def save(query_logs):
+        if not query_logs:
+            return
+        close_old_connections()
+        try:
+            QueryLog.objects.bulk_create(query_logs)
+        except Exception:
+            # 防止连接超时，重连后重试一次
+            connection.close()
+            try:
+                QueryLog.objects.bulk_create(query_logs)
+            except Exception:
+                logger.error('查询日志写入失败，丢弃{}条:{}'.format(len(query_logs), traceback.format_exc()))
+
+
+query_log_writer = QueryLogWriter()
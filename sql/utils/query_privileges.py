@@ -0,0 +1,99 @@
+# -*- coding:utf-8 -*-
+"""用户查询权限快照, 查询权限校验时从缓存获取, 避免每次查询对每张表都查询权限表"""
+import datetime
+import logging
+import traceback
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+
+from sql.models import QueryPrivileges
+
+logger = logging.getLogger('default')
+
+# 用户查询权限变更, 审核通过新增权限、修改或删除权限的事务提交后发送
+query_privileges_changed = Signal(providing_args=['user_name'])
+
+
+class UserPrivileges(object):
+    """用户全部有效查询权限的快照, 按(实例, 库)建立索引
+
+    grants: [(instance_name, db_name, table_name, priv_type, valid_date, limit_num)]
+    有效期在每次校验时按当天日期判断, 快照跨天使用也不会放过过期权限
+    """
+    timeout = 3600
+
+    def __init__(self, grants):
+        self._grants = {}
+        for instance_name, db_name, table_name, priv_type, valid_date, limit_num in grants:
+            self._grants.setdefault((instance_name, db_name), []).append(
+                (table_name, priv_type, valid_date, limit_num))
+
+    @staticmethod
+    def cache_key(user_name):
+        return 'query_privileges_{}'.format(user_name)
+
+    @classmethod
+    def load(cls, user_name):
+        """优先从缓存获取用户权限, 缓存不存在则从数据库加载并写入缓存"""
+        cache_key = cls.cache_key(user_name)
+        try:
+            grants = cache.get(cache_key)
+        except Exception:
+            grants = None
+            logger.error(traceback.format_exc())
+        if grants is None:
+            grants = list(QueryPrivileges.objects.filter(
+                user_name=user_name, is_deleted=0, valid_date__gte=datetime.date.today()
+            ).values_list('instance_name', 'db_name', 'table_name', 'priv_type', 'valid_date', 'limit_num'))
+            try:
+                cache.set(cache_key, grants, timeout=cls.timeout)
+            except Exception:
+                logger.error(traceback.format_exc())
+        return cls(grants)
+
+    @classmethod
+    def invalidate(cls, user_name):
+        try:
+            cache.delete(cls.cache_key(user_name))
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def _valid_grants(self, instance_name, db_name):
+        today = datetime.date.today()
+        return [grant for grant in self._grants.get((instance_name, db_name), []) if grant[2] >= today]
+
+    def has_db_priv(self, instance_name, db_name):
+        """是否有整库权限"""
+        return any(priv_type == 1 for _, priv_type, _, _ in self._valid_grants(instance_name, db_name))
+
+    def has_table_priv(self, instance_name, db_name, table_name, priv_type=None):
+        """是否有表权限, priv_type为None时不区分权限类型"""
+        return any(table == table_name and (priv_type is None or grant_type == priv_type)
+                   for table, grant_type, _, _ in self._valid_grants(instance_name, db_name))
+
+    def has_any_priv(self, instance_name, db_name):
+        """是否有该库的任意权限"""
+        return len(self._valid_grants(instance_name, db_name)) > 0
+
+    def min_limit(self, instance_name, db_list, table_list=None):
+        """获取涉及库(表)的最小limit限制, 没有权限时返回None"""
+        limits = [limit_num for db_name in set(db_list)
+                  for table, _, _, limit_num in self._valid_grants(instance_name, db_name)
+                  if table_list is None or table in table_list]
+        return min(limits) if limits else None
+
+
+@receiver(query_privileges_changed)
+def invalidate_user_privileges(sender, user_name, **kwargs):
+    UserPrivileges.invalidate(user_name)
+
+
+@receiver([post_save, post_delete], sender=QueryPrivileges)
+def invalidate_saved_privileges(sender, instance, **kwargs):
+    # 事务提交后再失效缓存, 避免提交前的并发查询把旧权限重新写入缓存
+    user_name = instance.user_name
+    if user_name:
+        transaction.on_commit(lambda: UserPrivileges.invalidate(user_name))
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志分析: 按SQL指纹统计时间序列、跨区间的加权分位数, 以及按周对比的性能退化检测
+慢日志明细每行是一个区间(pt-query-digest每次分析或内置解析每5分钟)的统计结果, 跨区间的分位数以执行次数为权重近似计算
+"""
+import datetime
+
+from django.db.models import Max, Sum
+from django.db.models.functions import TruncDay, TruncHour
+
+from sql.models import SlowQuery, SlowQueryHistory
+
+
+def weighted_percentile(values, weights, percentile):
+    """
+    加权分位数, values为各区间的分位数值, weights为各区间的执行次数
+    按值排序后累计权重, 返回累计权重首次达到percentile的值
+    """
+    items = sorted((v, w) for v, w in zip(values, weights) if v is not None and w)
+    total = sum(w for _, w in items)
+    if not total:
+        return None
+    threshold = total * percentile / 100.0
+    cumulative = 0
+    for value, weight in items:
+        cumulative += weight
+        if cumulative >= threshold:
+            return value
+    return items[-1][0]
+
+
+class IntervalStats(object):
+    """累计多个区间的统计: 执行次数、总时长、最大值, 以及计算加权分位数所需的区间分位数"""
+
+    def __init__(self):
+        self.count = 0
+        self.query_time_sum = 0
+        self.query_time_max = None
+        self.pct_95 = []
+        self.median = []
+        self.weights = []
+
+    def add(self, ts_cnt, query_time_sum, query_time_max, query_time_pct_95, query_time_median):
+        self.add_totals(ts_cnt, query_time_sum, query_time_max)
+        self.add_percentiles(ts_cnt, query_time_pct_95, query_time_median)
+
+    def add_totals(self, ts_cnt, query_time_sum, query_time_max):
+        """累计执行次数、总时长和最大值, 可直接传入数据库聚合的结果"""
+        self.count += ts_cnt or 0
+        self.query_time_sum += query_time_sum or 0
+        if query_time_max is not None:
+            self.query_time_max = max(self.query_time_max or 0, query_time_max)
+
+    def add_percentiles(self, ts_cnt, query_time_pct_95, query_time_median):
+        """记录一个区间的分位数及其权重"""
+        self.pct_95.append(query_time_pct_95)
+        self.median.append(query_time_median)
+        self.weights.append(ts_cnt or 0)
+
+    def result(self):
+        return {'count': self.count,
+                'query_time_sum': round(self.query_time_sum, 6),
+                'query_time_avg': round(self.query_time_sum / self.count, 6) if self.count else None,
+                'query_time_max': self.query_time_max,
+                'query_time_pct_95': weighted_percentile(self.pct_95, self.weights, 95),
+                'query_time_median': weighted_percentile(self.median, self.weights, 50)}
+
+
+stat_fields = ('ts_cnt', 'query_time_sum', 'query_time_max', 'query_time_pct_95', 'query_time_median')
+
+
+def fingerprint_trend(hostname, checksum, start_time, end_time, granularity='hour'):
+    """
+    单个SQL指纹的时间序列, granularity为hour或day
+    返回每个时间点的执行次数、平均/最大耗时和加权的95%、中位数耗时, 以及整个时间范围的汇总
+    """
+    trunc = TruncDay if granularity == 'day' else TruncHour
+    rows = SlowQueryHistory.objects.filter(
+        hostname_max=hostname, checksum=checksum, ts_min__gte=start_time, ts_min__lt=end_time
+    ).annotate(bucket=trunc('ts_min')).order_by('ts_min').values_list('bucket', *stat_fields)
+    series, summary = {}, IntervalStats()
+    for row in rows.iterator():
+        series.setdefault(row[0], IntervalStats()).add(*row[1:])
+        summary.add(*row[1:])
+    return {'series': [dict(time=bucket, **stats.result()) for bucket, stats in sorted(series.items())],
+            'summary': summary.result()}
+
+
+def detect_regression(hostname, end_time, days=7, threshold=1.5, min_count=10, db_name=None):
+    """
+    对比最近days天和之前days天每个SQL指纹的平均耗时和加权95%耗时,
+    两个时间段的执行次数都不少于min_count, 且任一指标变化倍数不小于threshold时认为性能退化, 按变化倍数倒序返回
+    执行次数、总时长和最大值在数据库中按SQL指纹聚合, 只有满足min_count的SQL指纹才读取明细计算加权分位数
+    """
+    current_start = end_time - datetime.timedelta(days=days)
+    previous_start = current_start - datetime.timedelta(days=days)
+    rows = SlowQueryHistory.objects.filter(hostname_max=hostname)
+    if db_name:
+        rows = rows.filter(db_max=db_name)
+    windows = {'previous': (previous_start, current_start), 'current': (current_start, end_time)}
+    stats = {}
+    for window, (start_time, stop_time) in windows.items():
+        totals = rows.filter(ts_min__gte=start_time, ts_min__lt=stop_time).values('checksum').annotate(
+            cnt=Sum('ts_cnt'), query_time=Sum('query_time_sum'), query_time_max=Max('query_time_max')
+        ).filter(cnt__gte=min_count).values_list('checksum', 'cnt', 'query_time', 'query_time_max')
+        for checksum, *total in totals:
+            stats.setdefault(checksum, {}).setdefault(window, IntervalStats()).add_totals(*total)
+    candidates = [checksum for checksum, window_stats in stats.items() if len(window_stats) == 2]
+    if candidates:
+        percentiles = rows.filter(checksum__in=candidates, ts_min__gte=previous_start, ts_min__lt=end_time)
+        for checksum, ts_min, *row in percentiles.values_list(
+                'checksum', 'ts_min', 'ts_cnt', 'query_time_pct_95', 'query_time_median').iterator():
+            window = 'current' if ts_min >= current_start else 'previous'
+            stats[checksum][window].add_percentiles(*row)
+
+    regressions = []
+    for checksum in candidates:
+        current, previous = stats[checksum]['current'].result(), stats[checksum]['previous'].result()
+        avg_ratio = ratio(current['query_time_avg'], previous['query_time_avg'])
+        pct_95_ratio = ratio(current['query_time_pct_95'], previous['query_time_pct_95'])
+        change = max(r for r in (avg_ratio, pct_95_ratio, 0) if r is not None)
+        if change >= threshold:
+            regressions.append({'SQLId': checksum, 'current': current, 'previous': previous,
+                                'avg_ratio': avg_ratio, 'pct_95_ratio': pct_95_ratio, 'change': change})
+    regressions.sort(key=lambda item: item['change'], reverse=True)
+    fingerprints = dict(SlowQuery.objects.filter(
+        checksum__in=[item['SQLId'] for item in regressions]).values_list('checksum', 'fingerprint'))
+    for item in regressions:
+        item['SQLText'] = fingerprints.get(item['SQLId'])
+    return regressions
+
+
+def ratio(current, previous):
+    if current is None or not previous:
+        return None
+    return round(current / previous, 2)
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+慢日志按小时预聚合, 定时任务以汇总表中记录的最大明细ID为水位, 只重新计算新增明细所在的(实例, 小时),
+慢日志统计的时间范围超过一天时, 已完整汇总的小时读取汇总表, 之后未汇总的部分读取明细表并合并
+"""
+import datetime
+import logging
+import time
+
+from django.db import transaction
+from django.db.models import F, Max, Min, Sum
+from django.db.models.functions import TruncHour
+
+from sql.models import SlowQuery, SlowQueryHistory, SlowQueryRollup
+
+logger = logging.getLogger('default')
+
+
+def rollup_slow_query(batch_size=20000, max_seconds=40):
+    """
+    增量汇总慢日志明细, 每批处理batch_size个明细ID, 一批在同一个事务中完成, 中断后从上一批继续
+    max_seconds: 单次执行的最长时间, 需小于django-q的任务超时时间, 剩余的明细由下次调度继续处理
+    """
+    watermark = SlowQueryRollup.objects.aggregate(history_id=Max('history_id'))['history_id'] or 0
+    max_id = SlowQueryHistory.objects.aggregate(history_id=Max('id'))['history_id'] or 0
+    deadline = time.time() + max_seconds
+    while watermark < max_id and time.time() < deadline:
+        upper = min(watermark + batch_size, max_id)
+        buckets = SlowQueryHistory.objects.filter(id__gt=watermark, id__lte=upper).annotate(
+            bucket=TruncHour('ts_min')).values_list('hostname_max', 'bucket').distinct()
+        with transaction.atomic():
+            for hostname, bucket in buckets:
+                rollup_bucket(hostname, bucket, upper)
+        logger.debug('slow query rollup: history id {} -> {}'.format(watermark, upper))
+        watermark = upper
+
+
+def rollup_bucket(hostname, bucket, history_id):
+    """重新计算一个实例一个小时的汇总数据, 迟到的明细也会计入"""
+    rows = SlowQueryHistory.objects.filter(
+        hostname_max=hostname,
+        ts_min__gte=bucket,
+        ts_min__lt=bucket + datetime.timedelta(hours=1)
+    ).values('db_max', 'checksum').annotate(
+        cnt=Sum('ts_cnt'),
+        query_time=Sum('query_time_sum'),
+        rows_examined=Sum('rows_examined_sum'),
+        rows_sent=Sum('rows_sent_sum'),
+        last_seen=Max('ts_max'),
+    )
+    rollups = [SlowQueryRollup(hostname=hostname, db_name=row['db_max'], checksum_id=row['checksum'], bucket=bucket,
+                               ts_cnt=row['cnt'] or 0, query_time_sum=row['query_time'] or 0,
+                               rows_examined_sum=row['rows_examined'] or 0, rows_sent_sum=row['rows_sent'] or 0,
+                               ts_max=row['last_seen'], history_id=history_id)
+               for row in rows]
+    SlowQueryRollup.objects.filter(hostname=hostname, bucket=bucket).delete()
+    SlowQueryRollup.objects.bulk_create(rollups)
+
+
+def rollup_covered_until(hostname, start_time, end_time):
+    """
+    返回时间范围内已完整汇总到的整点, 即该实例ID大于汇总水位的明细中最早的ts_min所在小时,
+    没有未汇总的明细时返回end_time, 尚未汇总或时间范围开始的小时即未汇总时返回None
+    """
+    watermark = SlowQueryRollup.objects.aggregate(history_id=Max('history_id'))['history_id']
+    if watermark is None:
+        return None
+    first_pending = SlowQueryHistory.objects.filter(
+        id__gt=watermark, hostname_max=hostname, ts_min__gte=start_time, ts_min__lt=end_time
+    ).aggregate(ts_min=Min('ts_min'))['ts_min']
+    if first_pending is None:
+        return end_time
+    covered_until = first_pending.replace(minute=0, second=0, microsecond=0)
+    return covered_until if covered_until > start_time else None
+
+
+def rollup_review(hostname, db_name, start_time, covered_until, end_time, offset, limit):
+    """
+    从汇总表获取[start_time, covered_until)的慢日志统计, 与明细表[covered_until, end_time]的统计按checksum合并,
+    字段与慢日志统计接口一致, 先按checksum分页, 只查询当前页的SQL指纹
+    """
+    rollups = SlowQueryRollup.objects.filter(hostname=hostname, bucket__gte=start_time, bucket__lt=covered_until)
+    if db_name:
+        rollups = rollups.filter(db_name=db_name)
+    slowsql_obj = rollups.annotate(SQLId=F('checksum_id')).values('SQLId').annotate(
+        CreateTime=Max('ts_max'),
+        DBName=Max('db_name'),  # 数据库
+        QueryTimeAvg=Sum('query_time_sum') / Sum('ts_cnt'),  # 平均执行时长
+        MySQLTotalExecutionCounts=Sum('ts_cnt'),  # 执行总次数
+        MySQLTotalExecutionTimes=Sum('query_time_sum'),  # 执行总时长
+        ParseTotalRowCounts=Sum('rows_examined_sum'),  # 扫描总行数
+        ReturnTotalRowCounts=Sum('rows_sent_sum'),  # 返回总行数
+    )
+    if covered_until >= end_time:
+        # 全部已汇总, 直接在数据库中分页
+        slow_sql_count = slowsql_obj.count()
+        slow_sql_list = list(slowsql_obj.order_by('-MySQLTotalExecutionCounts')[offset:limit])  # 执行总次数倒序排列
+    else:
+        # 未汇总的部分按checksum聚合明细表, 与汇总结果合并后分页
+        history = SlowQueryHistory.objects.filter(hostname_max=hostname, ts_min__gte=covered_until,
+                                                  ts_min__lte=end_time)
+        if db_name:
+            history = history.filter(db_max=db_name)
+        tail = history.annotate(SQLId=F('checksum_id')).values('SQLId').annotate(
+            CreateTime=Max('ts_max'),
+            DBName=Max('db_max'),
+            MySQLTotalExecutionCounts=Sum('ts_cnt'),
+            MySQLTotalExecutionTimes=Sum('query_time_sum'),
+            ParseTotalRowCounts=Sum('rows_examined_sum'),
+            ReturnTotalRowCounts=Sum('rows_sent_sum'),
+        )
+        merged = {row['SQLId']: row for row in slowsql_obj}
+        for row in tail:
+            merge_review_row(merged, row)
+        slow_sql_count = len(merged)
+        slow_sql_list = sorted(merged.values(), key=lambda row: -(row['MySQLTotalExecutionCounts'] or 0))[offset:limit]
+    fingerprints = dict(SlowQuery.objects.filter(
+        checksum__in=[row['SQLId'] for row in slow_sql_list]).values_list('checksum', 'fingerprint'))
+    for row in slow_sql_list:
+        row['SQLText'] = fingerprints.get(row['SQLId'])
+    return {"total": slow_sql_count, "rows": slow_sql_list}
+
+
+def merge_review_row(merged, row):
+    """把明细表的统计合并到汇总表同一checksum的统计中, 重新计算平均执行时长"""
+    total = merged.get(row['SQLId'])
+    if total is None:
+        total = merged[row['SQLId']] = dict(row)
+    else:
+        for key in ('MySQLTotalExecutionCounts', 'MySQLTotalExecutionTimes',
+                    'ParseTotalRowCounts', 'ReturnTotalRowCounts'):
+            total[key] = (total[key] or 0) + (row[key] or 0)
+        total['CreateTime'] = max(filter(None, (total['CreateTime'], row['CreateTime'])), default=None)
+        total['DBName'] = max(filter(None, (total['DBName'], row['DBName'])), default=None)
+    counts = total['MySQLTotalExecutionCounts']
+    total['QueryTimeAvg'] = total['MySQLTotalExecutionTimes'] / counts if counts else None
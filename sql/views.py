@@ -1,17 +1,18 @@
 # -*- coding: UTF-8 -*-
-import traceback
+import zlib
 
 import simplejson as json
 
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.models import Group
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.urls import reverse
 
 from sql.engines import get_engine
 from common.utils.permission import superuser_required
 from sql.engines.models import ReviewResult, ReviewSet
+from sql.utils.execute_result import get_execute_result
 from sql.utils.jobs import job_info
 
 from .models import Users, SqlWorkflow, QueryPrivileges, ResourceGroup, \
@@ -56,10 +57,12 @@ def submit_sql(request):
 # 展示SQL工单详细页面
 def detail(request, workflow_id):
     workflow_detail = get_object_or_404(SqlWorkflow, pk=workflow_id)
-    if workflow_detail.status in ['workflow_finish', 'workflow_exception'] \
+    rows = None
+    if workflow_detail.status in ['workflow_finish', 'workflow_exception', 'workflow_executing'] \
             and workflow_detail.is_manual == 0:
-        rows = workflow_detail.execute_result
-    else:
+        rows = get_execute_result(workflow_detail)
+    # 执行中尚未完成任何语句时展示审核结果
+    if not rows:
         rows = workflow_detail.review_content
     # 自动审批不通过的不需要获取下列信息
     if workflow_detail.status != 'workflow_autoreviewwrong':
@@ -116,21 +119,42 @@ def rollback(request):
     workflow_id = int(workflow_id)
     workflow = SqlWorkflow.objects.get(id=workflow_id)
 
-    try:
-        query_engine = get_engine(workflow=workflow)
-        list_backup_sql = query_engine.get_rollback()
-    except Exception as msg:
-        logger.error(traceback.format_exc())
-        context = {'errMsg': msg}
-        return render(request, 'error.html', context)
-    workflow_detail = SqlWorkflow.objects.get(id=workflow_id)
-    workflow_title = workflow_detail.workflow_name
-    rollback_workflow_name = "【回滚工单】原工单Id:%s ,%s" % (workflow_id, workflow_title)
-    context = {'list_backup_sql': list_backup_sql, 'workflow_detail': workflow_detail,
-               'rollback_workflow_name': rollback_workflow_name}
+    # 下载回滚脚本, 边读取边输出, compress=gzip时压缩输出
+    if request.GET.get('download'):
+        return rollback_download(request, workflow, request.GET.get('compress') == 'gzip')
+
+    # 回滚语句由页面通过/rollback/list/分批加载并展示进度
+    rollback_workflow_name = "【回滚工单】原工单Id:%s ,%s" % (workflow_id, workflow.workflow_name)
+    context = {'workflow_detail': workflow, 'rollback_workflow_name': rollback_workflow_name}
     return render(request, 'rollback.html', context)
 
 
+def rollback_download(request, workflow, compress=False):
+    """流式下载回滚脚本"""
+    query_engine = get_engine(workflow=workflow)
+    rollback_script = query_engine.get_rollback_script()
+    if rollback_script is None:
+        return render(request, 'error.html', {'errMsg': '该实例不支持下载回滚脚本'})
+    script = (block.encode('utf-8') for block in rollback_script)
+    filename = 'rollback_{}.sql'.format(workflow.id)
+    if compress:
+        script = gzip_stream(script)
+        filename += '.gz'
+    response = StreamingHttpResponse(script, content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
+def gzip_stream(chunks):
+    """对bytes迭代器做流式gzip压缩"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 # SQL文档页面
 @permission_required('sql.menu_document', raise_exception=True)
 def dbaprinciples(request):
@@ -116,6 +116,11 @@ CREATE TABLE `mysql_slow_query_review_history` (
   `Bytes_stddev` float DEFAULT NULL,
   `Bytes_median` float DEFAULT NULL,
   PRIMARY KEY (`id`),
-  UNIQUE KEY (checksum, ts_min, ts_max),
-  KEY `idx_hostname_max_ts_min` (`hostname_max`,`ts_min`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
+  UNIQUE KEY `uniq_hostname_checksum_ts` (`hostname_max`,`checksum`,`ts_min`,`ts_max`),
+  KEY `idx_hostname_max_ts_min` (`hostname_max`,`ts_min`),
+  KEY `idx_hostname_max_db_max_ts_min_checksum` (`hostname_max`,`db_max`,`ts_min`,`checksum`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+-- 注册慢日志汇总的定时任务, 每5分钟增量汇总一次
+INSERT INTO `django_q_schedule` (`name`, `func`, `schedule_type`, `minutes`, `repeats`, `next_run`)
+SELECT 'slow_query_rollup', 'sql.utils.slowquery_rollup.rollup_slow_query', 'I', 5, -1, NOW() FROM DUAL
+WHERE NOT EXISTS (SELECT 1 FROM `django_q_schedule` WHERE `name` = 'slow_query_rollup');
@@ -0,0 +1,63 @@
+-- 增加SQL工单逐条执行结果表
+CREATE TABLE `sql_workflow_execute_result` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `workflow_id` int(11) NOT NULL COMMENT '工单ID',
+  `chunk_index` int(11) NOT NULL COMMENT 'split段序号',
+  `row_index` int(11) NOT NULL COMMENT '段内序号',
+  `result` longtext NOT NULL COMMENT '单条执行结果的JSON格式',
+  `create_time` datetime(6) NOT NULL COMMENT '写入时间',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_workflow_chunk_row` (`workflow_id`,`chunk_index`,`row_index`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- 增加binlog2sql解析任务表
+CREATE TABLE `binlog2sql_job` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `instance_name` varchar(50) NOT NULL COMMENT '实例名称',
+  `user_name` varchar(30) NOT NULL COMMENT '发起人',
+  `params` longtext NOT NULL COMMENT '解析参数的JSON格式',
+  `filename` varchar(255) NOT NULL COMMENT '输出文件',
+  `status` varchar(20) NOT NULL COMMENT '状态',
+  `progress` double NOT NULL COMMENT '解析进度',
+  `rows` bigint(20) NOT NULL COMMENT '已生成SQL行数',
+  `log_file` varchar(100) NOT NULL COMMENT '检查点binlog文件',
+  `log_pos` bigint(20) NOT NULL COMMENT '检查点binlog位置',
+  `checkpoint` longtext NOT NULL COMMENT '检查点的JSON格式',
+  `error` longtext NOT NULL COMMENT '错误信息',
+  `create_time` datetime(6) NOT NULL COMMENT '创建时间',
+  `update_time` datetime(6) NOT NULL COMMENT '更新时间',
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- 增加慢日志按小时汇总表
+CREATE TABLE `mysql_slow_query_rollup` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `hostname` varchar(64) NOT NULL COMMENT '实例地址',
+  `db_name` varchar(64) DEFAULT NULL COMMENT '数据库',
+  `checksum` char(32) NOT NULL COMMENT 'SQL指纹checksum',
+  `bucket` datetime(6) NOT NULL COMMENT '统计小时',
+  `ts_cnt` double NOT NULL COMMENT '执行次数',
+  `query_time_sum` double NOT NULL COMMENT '执行总时长',
+  `rows_examined_sum` double NOT NULL COMMENT '扫描总行数',
+  `rows_sent_sum` double NOT NULL COMMENT '返回总行数',
+  `ts_max` datetime(6) NOT NULL COMMENT '最后出现时间',
+  `history_id` int(11) NOT NULL COMMENT '已聚合的最大明细ID',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uniq_host_db_checksum_bucket` (`hostname`,`db_name`,`checksum`,`bucket`),
+  KEY `idx_hostname_bucket` (`hostname`,`bucket`),
+  KEY `idx_history_id` (`history_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- 慢日志明细按实例、数据库和时间筛选的索引
+ALTER TABLE `mysql_slow_query_review_history`
+  ADD KEY `idx_hostname_max_db_max_ts_min_checksum` (`hostname_max`,`db_max`,`ts_min`,`checksum`);
+
+-- 慢日志明细唯一键增加实例, 不同实例相同指纹、相同时间范围的明细不再互相覆盖
+ALTER TABLE `mysql_slow_query_review_history`
+  DROP INDEX `checksum`,
+  ADD UNIQUE KEY `uniq_hostname_checksum_ts` (`hostname_max`,`checksum`,`ts_min`,`ts_max`);
+
+-- 注册慢日志汇总的定时任务, 每5分钟增量汇总一次
+INSERT INTO `django_q_schedule` (`name`, `func`, `schedule_type`, `minutes`, `repeats`, `next_run`)
+SELECT 'slow_query_rollup', 'sql.utils.slowquery_rollup.rollup_slow_query', 'I', 5, -1, NOW() FROM DUAL
+WHERE NOT EXISTS (SELECT 1 FROM `django_q_schedule` WHERE `name` = 'slow_query_rollup');
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+解析MySQL慢日志并写入archery的mysql_slow_query_review和mysql_slow_query_review_history表, 替代pt-query-digest
+在数据库服务器上由analysis_slow_query.sh定时执行, 只依赖pymysql
+每次从上次读取的位置继续读取新增的日志, 按SQL指纹和时间区间(默认5分钟)聚合后批量写入, 重复写入同一区间时覆盖
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+from functools import lru_cache
+
+import pymysql
+
+# 慢日志头部
+user_host_pattern = re.compile(rb'# User@Host: ([^\[]*)\[([^\]]*)\] @ ([^\[]*)\[([^\]]*)\]')
+attribute_pattern = re.compile(rb'(\w+): (\S+)')
+timestamp_pattern = re.compile(rb'SET timestamp=(\d+)')
+use_pattern = re.compile(rb'use `?([^`;\s]+)`?;', re.I)
+
+# SQL指纹, 逐条移植pt-query-digest(QueryRewriter::fingerprint)的规则, 按字节处理, 与pt-query-digest生成的checksum一致
+mysqldump_pattern = re.compile(rb'\ASELECT /\*!40001 SQL_NO_CACHE \*/ \* FROM `')
+pt_pattern = re.compile(rb'/\*\w+\.\w+:[0-9]/[0-9]\*/')
+call_pattern = re.compile(rb'\A\s*(call\s+\S+)\(', re.I)
+multi_insert_pattern = re.compile(rb'\A((?:INSERT|REPLACE)(?: IGNORE)?\s+INTO.+?VALUES\s*\(.*?\))\s*,\s*\(', re.I | re.S)
+multi_comment_pattern = re.compile(rb'/\*[^!].*?\*/', re.S | re.M)
+one_comment_pattern = re.compile(rb'(?:--|#)[^\'"\r\n]*(?=[\r\n]|\Z)')
+use_db_pattern = re.compile(rb'\Ause \S+\Z', re.I)
+quote_patterns = [(re.compile(rb"([^\\])(\\')", re.S), rb'\1'),
+                  (re.compile(rb'([^\\])(\\")', re.S), rb'\1'),
+                  (re.compile(rb'\\\\', re.S), b''),
+                  (re.compile(rb"\\'", re.S), b''),
+                  (re.compile(rb'\\"', re.S), b''),
+                  (re.compile(rb'([^\\])(".*?[^\\]?")', re.S), rb'\1?'),
+                  (re.compile(rb"([^\\])('.*?[^\\]?')", re.S), rb'\1?')]
+bool_pattern = re.compile(rb'\bfalse\b|\btrue\b', re.I | re.S)
+number_pattern = re.compile(rb'[0-9+-][0-9a-f.xb+-]*')
+leftover_pattern = re.compile(rb'[xb.+-]\?')
+whitespace_pattern = re.compile(rb'[ \n\t\r\f]+')
+null_pattern = re.compile(rb'\bnull\b')
+in_list_pattern = re.compile(rb'\b(in|values?)(?:[\s,]*\([\s?,]*\))+')
+union_pattern = re.compile(rb'\b(select\s.*?)(?:(\sunion(?:\sall)?)\s\1)+')
+limit_pattern = re.compile(rb'\blimit \?(?:, ?\?| offset \?)?')
+order_by_pattern = re.compile(rb'\border by ', re.I)
+asc_pattern = re.compile(rb'(.+?)\s+asc', re.I)
+
+metrics = ('Query_time', 'Lock_time', 'Rows_sent', 'Rows_examined', 'Rows_affected', 'Bytes')
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(sql):
+    """
+    将SQL中的常量替换为?, IN和VALUES列表合并为(?+), 统一大小写和空白, 完全相同的SQL直接使用缓存的结果
+    规则和处理顺序与pt-query-digest一致, 包括其特有的行为(如标识符中的数字也替换为?)
+    """
+    query = sql.encode('utf-8')
+    if mysqldump_pattern.match(query):
+        return 'mysqldump'
+    if pt_pattern.search(query):
+        return 'percona-toolkit'
+    if query.startswith(b'administrator command: '):
+        return sql
+    match = call_pattern.match(query)
+    if match:
+        return match.group(1).lower().decode('utf-8', errors='replace')
+    match = multi_insert_pattern.match(query)
+    if match:
+        query = match.group(1)
+    if b'/*' in query:
+        query = multi_comment_pattern.sub(b'', query)
+    if b'--' in query or b'#' in query:
+        query = one_comment_pattern.sub(b'', query)
+    query, is_use = use_db_pattern.subn(b'use ?', query)
+    if is_use:
+        return query.decode('utf-8', errors='replace')
+    if b"'" in query or b'"' in query:
+        # 前5条规则只处理转义字符, 没有反斜杠时跳过
+        for pattern, repl in quote_patterns if b'\\' in query else quote_patterns[5:]:
+            query = pattern.sub(repl, query)
+    query = bool_pattern.sub(b'?', query)
+    query = number_pattern.sub(b'?', query)
+    query = leftover_pattern.sub(b'?', query)
+    query = query.lstrip(b' \n\t\r\f\v')
+    if query.endswith(b'\n'):
+        query = query[:-1]
+    query = whitespace_pattern.sub(b' ', query)
+    query = query.lower()
+    query = null_pattern.sub(b'?', query)
+    query = in_list_pattern.sub(rb'\1(?+)', query)
+    if b'union' in query:
+        query = union_pattern.sub(rb'\1 /*repeat\2*/', query)
+    query = limit_pattern.sub(b'limit ?', query, count=1)
+    match = order_by_pattern.search(query)
+    if match:
+        query = query[:match.end()] + asc_pattern.sub(rb'\1', query[match.end():])
+    return query.decode('utf-8', errors='replace')
+
+
+def checksum(sql_fingerprint):
+    """与pt-query-digest一致, 取指纹md5的后16位并转为大写"""
+    return hashlib.md5(sql_fingerprint.encode('utf-8')).hexdigest()[-16:].upper()
+
+
+def iter_slow_log(f, offset=0):
+    """
+    流式解析二进制模式打开的慢日志, 从offset开始, 不完整的最后一行不读取
+    返回(事件, 已读取位置), 事件包含timestamp/epoch/user/client/db/sql和metrics中的指标,
+    # administrator command: 的事件以administrator command: xxx作为sql
+    """
+    f.seek(offset)
+    event, sql_lines, time_header = None, [], None
+    # 慢日志只在数据库变化时记录use db, 没有记录时沿用上一条的数据库, 与pt-query-digest的--inherit-attributes一致
+    inherit = {'db': None}
+
+    def finish():
+        if event is None or not sql_lines:
+            return None
+        # 与pt-query-digest一致, 语句不包含末尾的分号, Bytes为语句的字节数
+        sql = b''.join(sql_lines).strip()
+        if sql.endswith(b';'):
+            sql = sql[:-1].rstrip()
+        event['sql'] = sql.decode('utf-8', errors='replace')
+        event['Bytes'] = len(sql)
+        if event.get('epoch') is None:
+            # 缺少SET timestamp时才解析# Time行
+            ts = parse_time_header(time_header) if time_header else None
+            event['epoch'] = int(ts.timestamp()) if ts else None
+        event['timestamp'] = local_time(event['epoch']) if event['epoch'] is not None else None
+        if event.get('db'):
+            inherit['db'] = event['db']
+        else:
+            event['db'] = inherit['db']
+        return event
+
+    for line in f:
+        if line[-1:] != b'\n':
+            break
+        offset += len(line)
+        if line[:1] == b'#':
+            if line.startswith(b'# Time:'):
+                done = finish()
+                if done:
+                    yield done, offset - len(line)
+                event, sql_lines, time_header = None, [], line
+            elif line.startswith(b'# User@Host:'):
+                done = finish()
+                if done:
+                    yield done, offset - len(line)
+                match = user_host_pattern.match(line)
+                event, sql_lines = {}, []
+                if match:
+                    event['user'] = match.group(1).strip().decode('utf-8', errors='replace')
+                    event['client'] = (match.group(4) or match.group(3)).strip().decode('utf-8', errors='replace')
+            elif event is not None and not sql_lines and line.startswith(b'# administrator command: '):
+                sql_lines.append(line[2:])
+            elif event is not None and not sql_lines:
+                for key, value in attribute_pattern.findall(line):
+                    key = key.decode()
+                    if key in metrics:
+                        event[key] = float(value)
+                    elif key == 'Schema':
+                        event['db'] = value.decode('utf-8', errors='replace')
+            continue
+        if event is None:
+            continue
+        if line.endswith(b'started with:\n'):
+            # 实例重启时写入的文件头
+            done = finish()
+            if done:
+                yield done, offset - len(line)
+            event, sql_lines = None, []
+        elif sql_lines:
+            sql_lines.append(line)
+        elif line.startswith(b'SET timestamp='):
+            match = timestamp_pattern.match(line)
+            event['epoch'] = int(match.group(1)) if match else None
+        elif line[:4].lower() == b'use ' and use_pattern.match(line):
+            event['db'] = use_pattern.match(line).group(1).decode('utf-8', errors='replace')
+        else:
+            sql_lines.append(line)
+    done = finish()
+    if done:
+        yield done, offset
+    elif event is None:
+        yield None, offset
+
+
+@lru_cache(maxsize=1024)
+def local_time(epoch):
+    return datetime.datetime.fromtimestamp(epoch)
+
+
+def parse_time_header(line):
+    """
+    # Time: 2018-12-01T10:00:00.123456Z(5.7, UTC) 或 # Time: 181201 10:00:00(5.6, 本地时间), 转换为本地时间
+    只在缺少SET timestamp时使用
+    """
+    value = line[7:].strip().decode()
+    if value.endswith('Z'):
+        try:
+            ts = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc)
+            return ts.astimezone().replace(tzinfo=None)
+        except ValueError:
+            return None
+    try:
+        return datetime.datetime.strptime(' '.join(value.split()), '%y%m%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+class SlowLogDigest(object):
+    """按(时间区间, SQL指纹)聚合慢日志"""
+
+    def __init__(self, hostname, interval=300):
+        self.hostname = hostname
+        self.interval = interval
+        self.groups = {}
+        self.fingerprints = {}
+
+    def add(self, event):
+        if event['timestamp'] is None:
+            return
+        sql_fingerprint = fingerprint(event['sql'])
+        key = checksum(sql_fingerprint)
+        self.fingerprints.setdefault(key, (sql_fingerprint, event['sql']))
+        ts = event['timestamp']
+        bucket = event['epoch'] // self.interval
+        group = self.groups.get((bucket, key))
+        if group is None:
+            group = self.groups[(bucket, key)] = {
+                'checksum': key, 'ts_min': ts, 'ts_max': ts, 'sample': event['sql'], 'sample_time': 0, 'count': 0,
+                'user_max': event.get('user', ''), 'client_max': event.get('client'), 'db_max': event.get('db'),
+                'values': {metric: [] for metric in metrics}}
+        group['ts_min'], group['ts_max'] = min(group['ts_min'], ts), max(group['ts_max'], ts)
+        # 样例SQL使用区间内最慢的一条
+        if event.get('Query_time', 0) > group['sample_time']:
+            group['sample'], group['sample_time'] = event['sql'], event['Query_time']
+        group['count'] += 1
+        for column in ('user_max', 'client_max', 'db_max'):
+            value = event.get(column[:-4])
+            if value is not None and (group[column] is None or value > group[column]):
+                group[column] = value
+        for metric in metrics:
+            if metric in event:
+                group['values'][metric].append(event[metric])
+
+    def pop(self, before=None):
+        """输出区间早于before的聚合结果, before为None时输出全部"""
+        keys = [key for key in self.groups if before is None or key[0] < before]
+        return [self.history(self.groups.pop(key)) for key in sorted(keys)]
+
+    def history(self, group):
+        row = {'hostname_max': self.hostname, 'client_max': group['client_max'], 'user_max': group['user_max'],
+               'db_max': group['db_max'], 'checksum': group['checksum'], 'sample': group['sample'],
+               'ts_min': group['ts_min'], 'ts_max': group['ts_max'],
+               'ts_cnt': group['count']}
+        for metric, values in group['values'].items():
+            row.update(stats(metric, values))
+        return row
+
+
+def stats(metric, values):
+    """指标的sum/min/max/pct_95/stddev/median"""
+    if not values:
+        return {'{}_{}'.format(metric, name): None for name in ('sum', 'min', 'max', 'pct_95', 'stddev', 'median')}
+    values = sorted(values)
+    count = len(values)
+    total = sum(values)
+    mean = total / count
+    return {'{}_sum'.format(metric): total,
+            '{}_min'.format(metric): values[0],
+            '{}_max'.format(metric): values[-1],
+            '{}_pct_95'.format(metric): values[max(int(math.ceil(count * 0.95)) - 1, 0)],
+            '{}_stddev'.format(metric): math.sqrt(sum((v - mean) ** 2 for v in values) / count),
+            '{}_median'.format(metric): values[(count - 1) // 2]}
+
+
+history_columns = ['hostname_max', 'client_max', 'user_max', 'db_max', 'checksum', 'sample', 'ts_min', 'ts_max',
+                   'ts_cnt'] + ['{}_{}'.format(metric, name) for metric in metrics
+                                for name in ('sum', 'min', 'max', 'pct_95', 'stddev', 'median')]
+
+review_sql = """INSERT INTO mysql_slow_query_review (checksum, fingerprint, sample, first_seen, last_seen)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE first_seen=LEAST(IFNULL(first_seen, VALUES(first_seen)), VALUES(first_seen)),
+last_seen=GREATEST(IFNULL(last_seen, VALUES(last_seen)), VALUES(last_seen))"""
+
+
+
+def merge_column(column):
+    """
+    同一实例、指纹和时间范围的明细已存在时(同一区间跨两次运行读取)合并而不是覆盖:
+    次数和sum累加, min/max取较小/较大值, pct_95/stddev/median无法精确合并, 取较大值作为近似值
+    样例SQL在Query_time_max更新前按更慢的一条选取
+    """
+    if column == 'sample':
+        return '`sample`=IF(VALUES(`Query_time_max`) > IFNULL(`Query_time_max`, -1), VALUES(`sample`), `sample`)'
+    if column == 'ts_cnt' or column.endswith('_sum'):
+        expr = 'IF(`{0}` IS NULL, VALUES(`{0}`), `{0}` + IFNULL(VALUES(`{0}`), 0))'
+    elif column.endswith('_min'):
+        expr = 'LEAST(IFNULL(`{0}`, VALUES(`{0}`)), IFNULL(VALUES(`{0}`), `{0}`))'
+    else:
+        expr = 'GREATEST(IFNULL(`{0}`, VALUES(`{0}`)), IFNULL(VALUES(`{0}`), `{0}`))'
+    return '`{0}`='.format(column) + expr.format(column)
+
+
+# 唯一键为(hostname_max, checksum, ts_min, ts_max), 不同实例的相同指纹不会互相覆盖
+history_update_columns = [c for c in history_columns if c not in ('hostname_max', 'checksum', 'ts_min', 'ts_max')]
+history_sql = """INSERT INTO mysql_slow_query_review_history ({}) VALUES ({})
+ON DUPLICATE KEY UPDATE {}""".format(', '.join('`{}`'.format(c) for c in history_columns),
+                                     ', '.join(['%s'] * len(history_columns)),
+                                     ', '.join(merge_column(c) for c in history_update_columns))
+
+
+def save(conn, digest, rows):
+    """批量写入指纹和明细, 同一指纹只更新首次和最后出现时间"""
+    if not rows:
+        return
+    reviews = {}
+    for row in rows:
+        first, last = reviews.get(row['checksum'], (row['ts_min'], row['ts_max']))
+        reviews[row['checksum']] = (min(first, row['ts_min']), max(last, row['ts_max']))
+    with conn.cursor() as cursor:
+        cursor.executemany(review_sql, [(key,) + digest.fingerprints[key] + seen for key, seen in reviews.items()])
+        for i in range(0, len(rows), 500):
+            cursor.executemany(history_sql, [[row[c] for c in history_columns] for row in rows[i:i + 500]])
+    conn.commit()
+
+
+def load_state(state_file, slowlog):
+    """读取上次的读取位置, 日志文件被轮转或截断时从头读取"""
+    stat = os.stat(slowlog)
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return 0
+    if state.get('inode') != stat.st_ino or state.get('offset', 0) > stat.st_size:
+        return 0
+    return state.get('offset', 0)
+
+
+def save_state(state_file, slowlog, offset):
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump({'inode': os.stat(slowlog).st_ino, 'offset': offset}, f)
+    os.rename(state_file + '.tmp', state_file)
+
+
+def analysis(slowlog, digest, offset=0, since=None, on_rows=None):
+    """解析慢日志并聚合, 每得到一批完成的聚合结果调用on_rows(rows), 返回读取到的位置"""
+    last_bucket = None
+    with open(slowlog, 'rb') as f:
+        for event, offset in iter_slow_log(f, offset):
+            if event is None or event['timestamp'] is None or (since and event['timestamp'] < since):
+                continue
+            digest.add(event)
+            # 日志基本按时间顺序写入, 进入新的区间时输出早于上一个区间的聚合结果, 不在内存中保留全部区间
+            bucket = event['epoch'] // digest.interval
+            if bucket != last_bucket:
+                last_bucket = bucket
+                rows = digest.pop(before=bucket - 1)
+                if rows and on_rows:
+                    on_rows(rows)
+    rows = digest.pop()
+    if rows and on_rows:
+        on_rows(rows)
+    return offset
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='解析MySQL慢日志并写入archery')
+    parser.add_argument('--host', default='127.0.0.1', help='archery数据库地址')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', default='archery')
+    parser.add_argument('--hostname', required=True, help='实例连接信息mysql_host:mysql_port, 和archery实例配置保持一致')
+    parser.add_argument('--slowlog', required=True, help='实例慢日志文件')
+    parser.add_argument('--interval', type=int, default=300, help='聚合的时间区间(秒)')
+    parser.add_argument('--since', help='只解析该时间之后的日志, 格式为%%Y-%%m-%%d %%H:%%M:%%S')
+    parser.add_argument('--state-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='保存读取位置的目录')
+    args = parser.parse_args(argv)
+
+    state_file = os.path.join(args.state_dir, 'last_analysis_offset_{}'.format(args.hostname))
+    since = datetime.datetime.strptime(args.since, '%Y-%m-%d %H:%M:%S') if args.since else None
+    conn = pymysql.connect(host=args.host, port=args.port, user=args.user, password=args.password,
+                           database=args.database, charset='utf8mb4')
+    digest = SlowLogDigest(args.hostname, interval=args.interval)
+    try:
+        offset = analysis(args.slowlog, digest, offset=load_state(state_file, args.slowlog), since=since,
+                          on_rows=lambda rows: save(conn, digest, rows))
+    finally:
+        conn.close()
+    save_state(state_file, args.slowlog, offset)
+
+
+if __name__ == '__main__':
+    sys.exit(main())